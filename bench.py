@@ -0,0 +1,471 @@
+"""IPTV播放器性能基准
+
+在本机启动模拟湖南电信IPTV接口的假服务器（/000000002000/<频道>/1000.m3u8?starttime=...），
+可配置延迟、抖动、丢包和失效节点，运行标准场景并把结果保存为JSON，便于比较不同版本：
+
+    python bench.py                         运行全部场景，结果写入 bench_results/
+    python bench.py resolve probe           只运行指定场景
+    python bench.py --compare 旧结果.json   与之前的结果对比
+
+场景：resolve（播放地址生成吞吐量）、probe（服务器测速）、switch（换台到拿到首个分片的时间）、
+import（导入5万行频道列表）、fanout（本地HLS中继扇出）、playlist（并发请求 /playlist.m3u）。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import main
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class FakeIPTVHandler(BaseHTTPRequestHandler):
+    """假IPTV节点的请求处理：播放列表按当前时间滑动，分片为合成的TS数据"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(head_only=True)
+
+    def do_GET(self):
+        self._respond()
+
+    def _respond(self, head_only=False):
+        node = self.server.node
+        node.requests += 1
+        delay = node.latency + random.uniform(-node.jitter, node.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if node.loss and random.random() < node.loss:
+            # 丢包：不回应直接断开
+            self.close_connection = True
+            return
+
+        path = self.path.split("?", 1)[0]
+        parts = path.strip("/").split("/")
+        if path.endswith(".m3u8") and len(parts) == 3:
+            body = node.playlist(parts[1]).encode("utf-8")
+            content_type = "application/vnd.apple.mpegurl"
+        elif path.endswith(".ts") and len(parts) == 3:
+            body = node.segment
+            content_type = "video/mp2t"
+        elif path == "/":
+            body = b"ok"
+            content_type = "text/plain"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+class FakeIPTVNode:
+    """一个假IPTV节点
+
+    latency/jitter 为每个请求的附加延迟和抖动（秒），loss 为请求被直接断开的概率，
+    dead=True 时端口没有监听（连接被拒绝）。
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, dead=False,
+                 segment_duration=2.0, bitrate_kbps=4000, window=6):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.dead = dead
+        self.segment_duration = segment_duration
+        self.window = window
+        self.requests = 0
+        # 合成TS分片：以0x47同步字节开头的188字节包
+        packets = max(int(bitrate_kbps * 1000 / 8 * segment_duration / 188), 1)
+        packet = b"\x47" + bytes(187)
+        self.segment = packet * packets
+        self._server = None
+        self.port = None
+
+    def start(self):
+        if self.dead:
+            # 先绑定取得一个空闲端口再关闭，之后连接会被拒绝
+            sock = socket.socket()
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+            sock.close()
+            return self
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), FakeIPTVHandler)
+        self._server.daemon_threads = True
+        self._server.node = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    def playlist(self, channel):
+        """当前时间的直播播放列表（带节目时间，序号随时间递增）"""
+        now = time.time()
+        sequence = int(now / self.segment_duration)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(self.segment_duration + 0.999)}",
+            f"#EXT-X-MEDIA-SEQUENCE:{sequence - self.window + 1}",
+        ]
+        for number in range(sequence - self.window + 1, sequence + 1):
+            pdt = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(number * self.segment_duration))
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{pdt}.000Z")
+            lines.append(f"#EXTINF:{self.segment_duration:.3f},")
+            lines.append(f"{channel}_{number}.ts")
+        return "\n".join(lines) + "\n"
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def summarize(samples_ms):
+    """耗时样本（毫秒）的统计"""
+    return {
+        "count": len(samples_ms),
+        "median_ms": round(statistics.median(samples_ms), 2) if samples_ms else None,
+        "p95_ms": round(percentile(samples_ms, 0.95), 2) if samples_ms else None,
+        "max_ms": round(max(samples_ms), 2) if samples_ms else None,
+    }
+
+class Bench:
+    """基准场景：每个场景在独立的临时目录中创建引擎，互不影响"""
+
+    CHANNELS = 200
+
+    def __init__(self, args):
+        self.args = args
+        self.nodes = []
+        self.workdir = tempfile.mkdtemp(prefix="iptv_bench_")
+        self._cwd = os.getcwd()
+
+    def start_nodes(self):
+        """启动假节点：正常节点 + 高抖动节点 + 丢包节点 + 失效节点"""
+        args = self.args
+        latency = args.latency / 1000
+        jitter = args.jitter / 1000
+        for _ in range(args.nodes):
+            self.nodes.append(FakeIPTVNode(latency, jitter).start())
+        if args.jittery:
+            self.nodes.append(FakeIPTVNode(latency * 4, latency * 3).start())
+        if args.loss:
+            self.nodes.append(FakeIPTVNode(latency, jitter, loss=args.loss).start())
+        for _ in range(args.dead):
+            self.nodes.append(FakeIPTVNode(dead=True).start())
+
+    def stop_nodes(self):
+        for node in self.nodes:
+            node.stop()
+
+    def make_engine(self, live_nodes_only=False):
+        """在临时目录中创建引擎并加载 CHANNELS 个频道"""
+        directory = tempfile.mkdtemp(dir=self.workdir)
+        os.chdir(directory)
+        options = main.parse_args(["--http-port", str(free_port()), "--metrics-log", ""])
+        engine = main.IPTVEngine(options)
+        engine.load_channel_config()
+        nodes = [node for node in self.nodes if not (live_nodes_only and (node.dead or node.loss))]
+        engine.server_list = [node.address for node in nodes]
+        engine.add_channels(
+            {"name": f"频道{i}", "url": f"http://{{server}}/000000002000/{201500000000 + i}/1000.m3u8?starttime={{timestamp}}"}
+            for i in range(self.CHANNELS)
+        )
+        return engine
+
+    def close_engine(self, engine):
+        engine.shutdown()
+        os.chdir(self._cwd)
+
+    # ---- 场景 ----
+
+    def scenario_resolve(self):
+        """播放地址生成吞吐量（不联网，生成模板地址）"""
+        engine = self.make_engine()
+        templates = [channel["url"] for channel in engine.channel_list]
+        iterations = self.args.resolve_iterations
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            for i in range(iterations):
+                engine.generate_play_url(templates[i % len(templates)])
+            elapsed = time.perf_counter() - started
+        self.close_engine(engine)
+        return {"iterations": iterations, "seconds": round(elapsed, 4), "per_second": round(iterations / elapsed)}
+
+    def scenario_probe(self):
+        """一轮并发服务器测速的耗时，以及排名是否把失效节点排在后面"""
+        engine = self.make_engine()
+        prober = engine.server_prober
+        rounds = []
+        for _ in range(self.args.rounds):
+            started = time.perf_counter()
+            prober.probe_all()
+            rounds.append((time.perf_counter() - started) * 1000)
+        ranking = [server for server, stat in prober.snapshot()]
+        dead = {node.address for node in self.nodes if node.dead}
+        result = summarize(rounds)
+        result.update(
+            servers=len(engine.server_list),
+            best_is_dead=prober.best in dead,
+            dead_ranked_last=set(ranking[len(ranking) - len(dead):]) == dead,
+        )
+        self.close_engine(engine)
+        return result
+
+    def scenario_switch(self):
+        """换台时间：从生成地址（含直播边缘定位）到拿到首个分片的耗时"""
+        results = {}
+        for live_edge in (False, True):
+            engine = self.make_engine(live_nodes_only=True)
+            engine.live_edge_enabled = live_edge
+            session = engine.http_session
+            samples = []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(self.args.switches):
+                    channel = engine.channel_list[i % len(engine.channel_list)]
+                    key = engine.channel_key(channel)
+                    started = time.perf_counter()
+                    url = engine.resolve_play_url(channel["url"], key)
+                    response = session.get(url, timeout=5)
+                    playlist = main.parse_m3u8(response.text, response.url)
+                    session.get(playlist["segments"][0]["uri"], timeout=5).content
+                    samples.append((time.perf_counter() - started) * 1000)
+            results["live_edge" if live_edge else "direct"] = summarize(samples)
+            self.close_engine(engine)
+        return results
+
+    def scenario_import(self):
+        """导入5万行扩展M3U（以及仓库自带的TXT频道列表）"""
+        engine = self.make_engine()
+        path = os.path.join(self.workdir, "bench.m3u")
+        lines = self.args.import_lines
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("#EXTM3U\n")
+            for i in range(lines):
+                f.write(f'#EXTINF:-1 tvg-id="ch{i}" group-title="分组{i % 30}",频道 {i}\n')
+                f.write(f"http://example{i % 97}.com/live/{i}/index.m3u8\n")
+        started = time.perf_counter()
+        added, skipped = engine.import_channels(path)
+        elapsed = time.perf_counter() - started
+        started = time.perf_counter()
+        again = engine.import_channels(path)
+        duplicate_elapsed = time.perf_counter() - started
+        result = {
+            "lines": lines,
+            "added": added,
+            "seconds": round(elapsed, 3),
+            "channels_per_second": round(added / elapsed),
+            "duplicate_seconds": round(duplicate_elapsed, 3),
+            "duplicate_skipped": again[1],
+        }
+        txt = os.path.join(REPO_DIR, "湖南邵阳电信频道列表-iptv.txt")
+        if os.path.exists(txt):
+            started = time.perf_counter()
+            result["txt_added"] = engine.import_channels(txt)[0]
+            result["txt_seconds"] = round(time.perf_counter() - started, 4)
+        self.close_engine(engine)
+        return result
+
+    def scenario_fanout(self):
+        """本地HLS中继扇出：多个客户端同时拉同一频道，统计上游请求数和分片延迟"""
+        engine = self.make_engine(live_nodes_only=True)
+        engine.relay_enabled = True
+        server = engine.ensure_local_server()
+        key = engine.channel_key(engine.channel_list[0])
+        clients = self.args.clients
+        playlist_url = server.url(f"/hls/{key}.m3u8")
+        upstream_before = sum(node.requests for node in self.nodes)
+
+        def client(_):
+            session = main.create_http_session(pool_size=2)
+            samples = []
+            for _ in range(self.args.fanout_rounds):
+                started = time.perf_counter()
+                response = session.get(playlist_url, timeout=10)
+                playlist = main.parse_m3u8(response.text, response.url)
+                session.get(playlist["segments"][-1]["uri"], timeout=10).content
+                samples.append((time.perf_counter() - started) * 1000)
+            return samples
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                samples = [sample for result in pool.map(client, range(clients)) for sample in result]
+            elapsed = time.perf_counter() - started
+        upstream = sum(node.requests for node in self.nodes) - upstream_before
+        stats = engine.hls_relay.snapshot()
+        result = summarize(samples)
+        result.update(
+            clients=clients,
+            seconds=round(elapsed, 3),
+            upstream_requests=upstream,
+            hit_ratio=round(stats["hit_ratio"], 3),
+            bytes_served=stats["bytes_served"],
+            bytes_upstream=stats["bytes_upstream"],
+        )
+        self.close_engine(engine)
+        return result
+
+    def scenario_playlist(self):
+        """/playlist.m3u：多个客户端并发请求解析后的播放列表"""
+        engine = self.make_engine()
+        engine.add_channels(
+            {"name": f"扩展频道{i}", "url": f"http://{{server}}/000000002000/{201600000000 + i}/1000.m3u8?starttime={{timestamp}}"}
+            for i in range(self.args.playlist_channels - len(engine.channel_list))
+        )
+        iterations = 1000
+        started = time.perf_counter()
+        for _ in range(iterations):
+            engine.render_playlist()
+        render_ms = (time.perf_counter() - started) * 1000 / iterations
+        url = engine.ensure_local_server().url("/playlist.m3u")
+        clients = self.args.clients
+
+        def client(_):
+            session = main.create_http_session(pool_size=2)
+            samples = []
+            for _ in range(self.args.fanout_rounds * 4):
+                started = time.perf_counter()
+                session.get(url, timeout=10).content
+                samples.append((time.perf_counter() - started) * 1000)
+            return samples
+
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            samples = [sample for result in pool.map(client, range(clients)) for sample in result]
+        result = summarize(samples)
+        result.update(channels=len(engine.channel_list), clients=clients, render_ms=round(render_ms, 4))
+        self.close_engine(engine)
+        return result
+
+    SCENARIOS = ("resolve", "probe", "switch", "import", "fanout", "playlist")
+
+    def run(self, names):
+        self.start_nodes()
+        results = {}
+        try:
+            for name in names:
+                print(f"运行场景: {name}")
+                started = time.perf_counter()
+                try:
+                    results[name] = getattr(self, f"scenario_{name}")()
+                except Exception as e:
+                    results[name] = {"error": str(e) or e.__class__.__name__}
+                    os.chdir(self._cwd)
+                results[name]["wall_seconds"] = round(time.perf_counter() - started, 3)
+                print(f"  {json.dumps(results[name], ensure_ascii=False)}")
+        finally:
+            self.stop_nodes()
+            os.chdir(self._cwd)
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        return results
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(previous, current):
+    """逐项打印与之前结果的差异（数值字段）"""
+    for name, result in current["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        for field, value in result.items():
+            before = old.get(field)
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)) and not isinstance(value, bool):
+                change = f"{(value - before) / before:+.1%}" if before else "n/a"
+                print(f"{name}.{field}: {before} -> {value} ({change})")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPTV播放器性能基准")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help=f"要运行的场景（{'/'.join(Bench.SCENARIOS)}，默认全部）")
+    parser.add_argument("--nodes", type=int, default=3, help="正常节点数")
+    parser.add_argument("--dead", type=int, default=1, help="失效节点数（连接被拒绝）")
+    parser.add_argument("--loss", type=float, default=0.05, help="丢包节点的请求丢弃概率（0表示不启动丢包节点）")
+    parser.add_argument("--no-jittery", dest="jittery", action="store_false", help="不启动高抖动节点")
+    parser.add_argument("--latency", type=float, default=20, help="每个请求的附加延迟（毫秒）")
+    parser.add_argument("--jitter", type=float, default=5, help="延迟抖动（毫秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机数种子（抖动和丢包）")
+    parser.add_argument("--rounds", type=int, default=5, help="probe场景的测速轮数")
+    parser.add_argument("--switches", type=int, default=30, help="switch场景的换台次数")
+    parser.add_argument("--resolve-iterations", type=int, default=100000, help="resolve场景的生成次数")
+    parser.add_argument("--import-lines", type=int, default=50000, help="import场景的频道数")
+    parser.add_argument("--clients", type=int, default=16, help="fanout场景的并发客户端数")
+    parser.add_argument("--playlist-channels", type=int, default=1000, help="playlist场景的频道数")
+    parser.add_argument("--fanout-rounds", type=int, default=5, help="fanout场景每个客户端的请求轮数")
+    parser.add_argument("--output", help="结果文件（默认 bench_results/时间_版本.json）")
+    parser.add_argument("--compare", metavar="FILE", help="与之前的结果文件对比")
+    return parser.parse_args(argv)
+
+def main_bench():
+    args = parse_args()
+    random.seed(args.seed)
+    names = args.scenarios or list(Bench.SCENARIOS)
+    unknown = [name for name in names if name not in Bench.SCENARIOS]
+    if unknown:
+        sys.exit(f"未知场景: {', '.join(unknown)}")
+    scenarios = Bench(args).run(names)
+    revision = git_revision()
+    result = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": revision,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "scenarios")},
+        "scenarios": scenarios,
+    }
+    output = args.output
+    if not output:
+        directory = os.path.join(REPO_DIR, "bench_results")
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, f"{time.strftime('%Y%m%d_%H%M%S')}_{revision or 'unknown'}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+if __name__ == "__main__":
+    main_bench()
@@ -1,3 +1,6 @@
+import time
+# 进程启动时刻，用于 --startup-profile 统计启动耗时
+_PROCESS_START = time.perf_counter()
 import os
 import sys
 import urllib.parse
@@ -5,35 +8,4063 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog  # 添加了simpledialog导入
 import threading
 import datetime
-import ntplib
-import vlc
-import requests
+import importlib
 import re
-import time
 from datetime import timezone, timedelta
 import json
+import logging
+import logging.handlers
 import os.path
+import random
+import http.client
+import hashlib
+import hmac
+import asyncio
+import argparse
+import csv
+import email.utils
+import socket
+import sqlite3
+import struct
+import mmap
+import queue
+import tempfile
+import bisect
+import calendar
+import gzip
+import xml.etree.ElementTree as ElementTree
+from array import array
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+
+# 本地HTTP服务默认端口（HLS中继等功能共用）
+LOCAL_HTTP_PORT = 8090
+
+class StartupProfiler:
+    """记录启动各阶段耗时，--startup-profile 时输出"""
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.last = origin
+        self.steps = []  # (阶段, 耗时毫秒, 距进程启动毫秒)
+        self.enabled = False
+        self.reported = False
+
+    def mark(self, name):
+        """记录从上一个阶段结束到现在的耗时"""
+        now = time.perf_counter()
+        self.steps.append((name, (now - self.last) * 1000, (now - self.origin) * 1000))
+        self.last = now
+
+    def record(self, name, started):
+        """记录一个独立事件（如延迟导入）的耗时"""
+        now = time.perf_counter()
+        self.steps.append((name, (now - started) * 1000, (now - self.origin) * 1000))
+        if self.enabled and self.reported:
+            print(f"[启动分析] {name}: {(now - started) * 1000:.1f} ms（延迟执行）")
+
+    def report(self):
+        """打印各阶段耗时"""
+        self.reported = True
+        print("[启动分析] 阶段                      耗时(ms)   累计(ms)")
+        for name, duration, at in self.steps:
+            print(f"[启动分析] {name:<24}{duration:>10.1f}{at:>11.1f}")
+        return self.steps
+
+STARTUP_PROFILE = StartupProfiler(_PROCESS_START)
+
+class LazyModule:
+    """首次访问属性时才导入的模块代理，避免启动时加载vlc、requests等较重的模块"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            self._module = module
+            STARTUP_PROFILE.record(f"导入 {self._name}", started)
+        return getattr(module, attr)
+
+ntplib = LazyModule("ntplib")
+vlc = LazyModule("vlc")
+requests = LazyModule("requests")
+numpy = LazyModule("numpy")  # 可选，仅流分析使用
+
+def create_http_session(pool_size=16):
+    """创建带连接池的共享HTTP会话，keep-alive复用TCP连接"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=0
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class AvailabilityCache:
+    """按主机缓存可用性检查结果，可用与不可用结果分别设置有效期（秒）"""
+
+    def __init__(self, ttl=60, negative_ttl=10):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # 主机 -> (是否可用, 过期时间)
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """返回缓存的检查结果，未缓存或已过期时返回None"""
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is None:
+                return None
+            available, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[host]
+                return None
+            return available
+
+    def put(self, host, available):
+        """写入检查结果"""
+        ttl = self.ttl if available else self.negative_ttl
+        with self._lock:
+            self._entries[host] = (available, time.monotonic() + ttl)
+
+    def invalidate(self, host=None):
+        """清除指定主机（或全部）的缓存"""
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(host, None)
+
+class BackgroundLoop:
+    """在后台线程中运行的asyncio事件循环，供本地服务共用"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """在事件循环中执行协程，返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, func, *args):
+        """在事件循环线程中调用普通函数"""
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def stop(self):
+        """停止事件循环"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class HTTPRequest:
+    """解析后的HTTP请求"""
+
+    def __init__(self, method, target, version, headers, body=b""):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # 小写头名 -> 值
+        self.body = body
+        self.reader = None  # 连接的读取流（流式响应用来检测客户端断开）
+        self.peer = None  # 客户端地址
+        self.local = None  # 请求到达的本机地址
+        parsed = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(parsed.path)
+        self.query = dict(urllib.parse.parse_qsl(parsed.query))
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+async def read_http_request(reader):
+    """从流中读取一个HTTP请求，连接关闭时返回None"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        return None
+    method, target, version = parts
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    body = b""
+    length = int(headers.get("content-length", 0) or 0)
+    if length:
+        body = await reader.readexactly(length)
+    return HTTPRequest(method, target, version, headers, body)
+
+def build_http_head(status, content_type, length=None, keep_alive=False, extra_headers=None):
+    """构造HTTP响应头"""
+    lines = [
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+        f"Content-Type: {content_type}",
+        "Connection: " + ("keep-alive" if keep_alive else "close"),
+        "Access-Control-Allow-Origin: *",
+    ]
+    if length is not None:
+        lines.append(f"Content-Length: {length}")
+    for name, value in (extra_headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+def json_response(data, status=200):
+    """生成JSON响应元组"""
+    return status, "application/json; charset=utf-8", json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+class Metrics:
+    """进程内指标，按Prometheus文本格式输出
+
+    值在采样或被抓取时写入，读写只是字典操作，不影响播放。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # 指标名 -> (类型, 说明)
+        self._values = {}  # 指标名 -> {标签元组: 值}
+
+    def describe(self, name, kind, help_text):
+        """登记指标类型（gauge/counter）和说明"""
+        self._meta[name] = (kind, help_text)
+
+    def set(self, name, value, **labels):
+        if value is None:
+            return
+        with self._lock:
+            self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def clear(self, prefix):
+        """删除以prefix开头的全部指标的值（如切换播放会话时）"""
+        with self._lock:
+            for name in [name for name in self._values if name.startswith(prefix)]:
+                del self._values[name]
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        escaped = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """Prometheus文本格式"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                kind, help_text = self._meta.get(name, ("gauge", ""))
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in self._values[name].items():
+                    lines.append(f"{name}{self._format_labels(labels)} {float(value):g}")
+        return "\n".join(lines) + "\n"
+
+class RollingLog:
+    """按大小滚动的JSON行日志（每行一个事件），用于事后分析卡顿"""
+
+    def __init__(self, path, max_bytes=2 * 1024 * 1024, backups=3):
+        self.path = path
+        self.logger = logging.getLogger(f"iptv.metrics.{path}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def write(self, event, **fields):
+        record = {"time": datetime.datetime.now().isoformat(timespec="milliseconds"), "event": event}
+        record.update(fields)
+        try:
+            self.logger.info(json.dumps(record, ensure_ascii=False, default=str))
+        except Exception:
+            pass
+
+# 请求Host头中可以原样用于生成地址的值：主机名、IPv4或方括号括起的IPv6，可带端口
+HOST_HEADER_RE = re.compile(r"^(?:[A-Za-z0-9.\-]+|\[[0-9A-Fa-f:.]+\])(?::\d{1,5})?$")
+
+class LocalHTTPServer:
+    """本地HTTP服务（asyncio），按路径前缀把请求分发给各功能模块
+
+    处理函数签名为 async handler(request, writer)，返回 (状态码, 内容类型, 正文)；
+    返回None表示处理函数已自行写出流式响应，连接随后关闭。
+    """
+
+    def __init__(self, background, host="0.0.0.0", port=LOCAL_HTTP_PORT, advertise_host=None):
+        self.background = background
+        self.host = host
+        self.port = port
+        self.advertise_host = advertise_host  # 返回给其它设备的地址中使用的主机名（--advertise-host）
+        self.routes = []  # (路径前缀, 处理函数)，按前缀长度降序
+        self._server = None
+
+    def add_route(self, prefix, handler):
+        """注册路径前缀对应的处理函数"""
+        self.routes.append((prefix, handler))
+        self.routes.sort(key=lambda route: len(route[0]), reverse=True)
+
+    @property
+    def running(self):
+        return self._server is not None
+
+    def start(self):
+        """启动服务（阻塞直到端口监听成功）"""
+        if self._server is None:
+            self._server = self.background.run(
+                asyncio.start_server(self._handle_client, self.host, self.port)
+            ).result()
+
+    def stop(self):
+        """停止服务"""
+        if self._server is not None:
+            self.background.call(self._server.close)
+            self._server = None
+
+    def url(self, path):
+        """返回本机访问指定路径的URL（只用于本进程内的播放器）"""
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def public_url(self, path, request=None):
+        """返回其它设备访问指定路径的URL
+
+        依次使用 --advertise-host、请求的Host头、监听地址、请求到达的本机地址；
+        都不可用时（监听所有地址且没有请求）取默认路由所在网卡的地址。
+        """
+        if self.advertise_host:
+            return f"http://{self._authority(self.advertise_host)}{path}"
+        if request is not None:
+            host = request.headers.get("host", "").strip()
+            if HOST_HEADER_RE.match(host):
+                return f"http://{host}{path}"
+        if self.host not in ("", "0.0.0.0", "::"):
+            return f"http://{self._authority(self.host)}{path}"
+        if request is not None and request.local:
+            return f"http://{self._authority(request.local[0])}{path}"
+        return f"http://{self._authority(self._default_address())}{path}"
+
+    def _authority(self, host):
+        """主机名或地址加上端口（已带端口的原样返回）"""
+        if host.startswith("[") or host.count(":") == 1:
+            return host
+        if ":" in host:
+            return f"[{host}]:{self.port}"
+        return f"{host}:{self.port}"
+
+    @staticmethod
+    def _default_address():
+        """默认路由所在网卡的IPv4地址（UDP connect不发送数据），取不到时返回127.0.0.1"""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.connect(("192.0.2.1", 9))
+                return sock.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                request.reader = reader
+                request.peer = writer.get_extra_info("peername")
+                request.local = writer.get_extra_info("sockname")
+                handler = None
+                for prefix, route_handler in self.routes:
+                    if request.path.startswith(prefix):
+                        handler = route_handler
+                        break
+                if handler is None:
+                    response = (404, "text/plain; charset=utf-8", b"not found")
+                else:
+                    try:
+                        response = await handler(request, writer)
+                    except KeyError:
+                        # 未知或已淘汰的频道、分片
+                        response = (404, "text/plain; charset=utf-8", b"not found")
+                    except Exception as e:
+                        # 详细原因（可能含上游地址）只记在本机日志中，不返回给客户端
+                        print(f"处理请求出错 {request.path}: {e!r}")
+                        response = (502, "text/plain; charset=utf-8", b"bad gateway")
+                if response is None:
+                    break
+                status, content_type, body = response
+                if request.method == "HEAD":
+                    writer.write(build_http_head(status, content_type, len(body), request.keep_alive))
+                else:
+                    writer.write(build_http_head(status, content_type, len(body), request.keep_alive) + body)
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+class SegmentCache:
+    """按字节数限制容量的LRU分片缓存"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._items[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+class HLSRelay:
+    """HLS扇出中继：每个频道的播放列表和分片只向上游拉取一次，由任意数量的本地客户端共享
+
+    访问路径：
+      /hls/<频道>.m3u8      频道播放列表（频道由resolve_channel解析为上游地址）
+      /hls/sub/<id>.m3u8    子播放列表（多码率）
+      /hls/seg/<id>.ts      分片
+      /hls/stats            缓存统计
+    """
+
+    # 频道会话空闲多久后释放（秒），下次访问时重新解析上游地址
+    SESSION_IDLE = 60
+    # 播放列表最短/最长缓存时间（秒）
+    PLAYLIST_MIN_TTL = 0.5
+    PLAYLIST_MAX_TTL = 3.0
+
+    def __init__(self, session, resolve_channel, cache_bytes=256 * 1024 * 1024, timeout=10):
+        self.session = session
+        self.resolve_channel = resolve_channel  # 频道标识 -> 上游播放列表URL（在线程池中调用）
+        self.timeout = timeout
+        self.segments = SegmentCache(cache_bytes)
+        self._urls = OrderedDict()  # 资源id -> 上游地址
+        self._channels = {}  # 频道标识 -> {"url", "last_access"}
+        self._playlists = {}  # 播放列表缓存键 -> (过期时间, 文本)
+        self._inflight = {}  # 缓存键 -> asyncio.Future，合并并发请求
+        self.stats = {
+            "requests": 0, "hits": 0, "misses": 0, "coalesced": 0,
+            "bytes_upstream": 0, "bytes_served": 0
+        }
+
+    def register(self, server):
+        """注册到本地HTTP服务"""
+        server.add_route("/hls/", self.handle)
+
+    async def handle(self, request, writer):
+        path = request.path[len("/hls/"):]
+        if path == "stats":
+            return json_response(self.snapshot())
+        if path.startswith("seg/"):
+            data = await self._get_segment(path[len("seg/"):].rsplit(".", 1)[0])
+            return 200, "video/mp2t", data
+        if path.startswith("sub/"):
+            resource_id = path[len("sub/"):].rsplit(".", 1)[0]
+            url = self._urls.get(resource_id)
+            if url is None:
+                return 404, "text/plain; charset=utf-8", b"unknown playlist"
+            text = await self._get_playlist("sub:" + resource_id, url)
+            return 200, "application/vnd.apple.mpegurl", text.encode("utf-8")
+        if path.endswith(".m3u8"):
+            key = path[:-len(".m3u8")]
+            text = await self._get_channel_playlist(key)
+            return 200, "application/vnd.apple.mpegurl", text.encode("utf-8")
+        return 404, "text/plain; charset=utf-8", b"not found"
+
+    async def prefetch(self, key):
+        """预先拉取频道播放列表"""
+        try:
+            await self._get_channel_playlist(key)
+        except Exception as e:
+            print(f"中继预取失败 {key}: {e}")
+
+    def release(self, key):
+        """释放频道会话（需在事件循环线程中调用）"""
+        self._channels.pop(key, None)
+        self._playlists.pop("ch:" + key, None)
+
+    async def _coalesce(self, key, factory, counted=False):
+        """同一缓存键同时只发起一次上游请求，其余请求等待同一结果"""
+        future = self._inflight.get(key)
+        if future is not None:
+            if counted:
+                self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await factory()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # 避免无人等待时出现未获取异常的警告
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def _fetch(self, url):
+        """阻塞获取上游资源，返回 (最终URL, 内容)"""
+        with self.session.get(url, timeout=self.timeout) as response:
+            response.raise_for_status()
+            return response.url, response.content
+
+    async def _get_segment(self, resource_id):
+        self.stats["requests"] += 1
+        data = self.segments.get(resource_id)
+        if data is not None:
+            self.stats["hits"] += 1
+        else:
+            url = self._urls.get(resource_id)
+            if url is None:
+                raise KeyError(f"未知分片: {resource_id}")
+
+            async def download():
+                loop = asyncio.get_running_loop()
+                _, content = await loop.run_in_executor(None, self._fetch, url)
+                self.stats["misses"] += 1
+                self.stats["bytes_upstream"] += len(content)
+                self.segments.put(resource_id, content)
+                return content
+
+            data = await self._coalesce("seg:" + resource_id, download, counted=True)
+        self.stats["bytes_served"] += len(data)
+        return data
+
+    async def _get_channel_playlist(self, key):
+        now = time.monotonic()
+        channel = self._channels.get(key)
+        if channel is None or now - channel["last_access"] > self.SESSION_IDLE:
+            loop = asyncio.get_running_loop()
+            url = await loop.run_in_executor(None, self.resolve_channel, key)
+            channel = {"url": url}
+            self._channels[key] = channel
+            self._playlists.pop("ch:" + key, None)
+        channel["last_access"] = now
+        return await self._get_playlist("ch:" + key, channel["url"])
+
+    async def _get_playlist(self, cache_key, url):
+        cached = self._playlists.get(cache_key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        async def download():
+            loop = asyncio.get_running_loop()
+            final_url, content = await loop.run_in_executor(None, self._fetch, url)
+            text, target_duration = self._rewrite_playlist(content.decode("utf-8", "replace"), final_url)
+            ttl = min(max(target_duration / 2, self.PLAYLIST_MIN_TTL), self.PLAYLIST_MAX_TTL)
+            self._playlists[cache_key] = (time.monotonic() + ttl, text)
+            return text
+
+        return await self._coalesce(cache_key, download)
+
+    def _register_url(self, url):
+        """为上游地址分配稳定的资源id"""
+        resource_id = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
+        self._urls[resource_id] = url
+        self._urls.move_to_end(resource_id)
+        while len(self._urls) > 8192:
+            self._urls.popitem(last=False)
+        return resource_id
+
+    def _rewrite_playlist(self, text, base_url):
+        """把播放列表中的上游地址改写为本地中继地址，返回 (文本, 目标分片时长)"""
+        is_master = "#EXT-X-STREAM-INF" in text
+        target_duration = 2.0
+        lines = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                if line.startswith("#EXT-X-TARGETDURATION:"):
+                    try:
+                        target_duration = float(line.split(":", 1)[1])
+                    except ValueError:
+                        pass
+                elif 'URI="' in line:
+                    # 密钥、初始化分片等属性中的地址
+                    line = re.sub(
+                        r'URI="([^"]+)"',
+                        lambda m: f'URI="/hls/seg/{self._register_url(urllib.parse.urljoin(base_url, m.group(1)))}.ts"',
+                        line
+                    )
+                lines.append(line)
+                continue
+            absolute = urllib.parse.urljoin(base_url, line)
+            resource_id = self._register_url(absolute)
+            if is_master or urllib.parse.urlsplit(absolute).path.endswith(".m3u8"):
+                lines.append(f"/hls/sub/{resource_id}.m3u8")
+            else:
+                lines.append(f"/hls/seg/{resource_id}.ts")
+        return "\n".join(lines) + "\n", target_duration
+
+    def snapshot(self):
+        """返回缓存统计"""
+        stats = dict(self.stats)
+        requests_count = stats["requests"]
+        stats["hit_ratio"] = (stats["hits"] + stats["coalesced"]) / requests_count if requests_count else 0.0
+        stats["bytes_saved"] = max(stats["bytes_served"] - stats["bytes_upstream"], 0)
+        stats["cached_segments"] = len(self.segments)
+        stats["cached_bytes"] = self.segments.size
+        stats["channels"] = len(self._channels)
+        return stats
+
+class TimeshiftRing:
+    """固定大小的内存映射环形文件，按顺序保存最近的TS分片并维护分片索引
+
+    写到文件末尾放不下时从头开始，覆盖最旧的分片。内存占用只有索引和操作系统
+    按需映射的页面（可随时换出），与时移窗口长度无关。需在同一线程中读写。
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._file = open(path, "w+b")
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self.index = deque()  # 按序号排列：{"sequence", "offset", "length", "duration", "pdt"}
+        self.position = 0
+        self.next_sequence = 0
+        self.bytes_written = 0
+        self.duration = 0.0  # 环中分片的总时长（秒）
+
+    def reset(self):
+        """清空索引（切换频道时），文件保留复用"""
+        self.index.clear()
+        self.position = 0
+        self.duration = 0.0
+
+    def _evict(self):
+        self.duration -= self.index.popleft()["duration"]
+
+    def append(self, data, duration, pdt=None):
+        """写入一个分片，返回其序号；分片比整个环还大时返回None"""
+        length = len(data)
+        if not length or length > self.size:
+            return None
+        if self.position + length > self.size:
+            # 末尾放不下：末尾剩余空间中的分片是最旧的，一并淘汰后从头写
+            while self.index and self.index[0]["offset"] >= self.position:
+                self._evict()
+            self.position = 0
+        start = self.position
+        end = start + length
+        # 淘汰将被覆盖的最旧分片
+        while self.index and self.index[0]["offset"] < end and self.index[0]["offset"] + self.index[0]["length"] > start:
+            self._evict()
+        self._map[start:end] = data
+        entry = {
+            "sequence": self.next_sequence,
+            "offset": start,
+            "length": length,
+            "duration": duration,
+            "pdt": pdt,
+        }
+        self.index.append(entry)
+        self.duration += duration
+        self.next_sequence += 1
+        self.position = end
+        self.bytes_written += length
+        return entry["sequence"]
+
+    def get(self, sequence):
+        """按序号读取分片，已被覆盖或不存在时返回None"""
+        if not self.index:
+            return None
+        position = sequence - self.index[0]["sequence"]
+        if not 0 <= position < len(self.index):
+            return None
+        entry = self.index[position]
+        return self._map[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class TimeshiftService:
+    """本地时移：持续把当前频道的HLS分片写入环形文件，由本地HTTP服务提供可回看的播放列表
+
+    访问路径：
+      /timeshift/<频道>.m3u8?behind=秒   播放列表，最新分片截止到直播边缘之前behind秒
+      /timeshift/seg/<序号>.ts           分片（直接从环形文件读取）
+      /timeshift/stats                   录制状态
+    同时只录制一个频道。正在录制时，只有带 switch=1 的请求（本程序的播放器）才会切换录制频道，
+    其它客户端请求别的频道返回409，不会清掉正在观看的回看窗口。
+    后退、暂停后继续和回到直播只需换一个behind参数重新打开本地播放列表，不再向上游重新请求。
+    """
+
+    # 开始录制时从上游窗口末尾取几个分片
+    START_SEGMENTS = 3
+    # 等待首批分片的最长时间（秒）
+    READY_TIMEOUT = 15
+
+    def __init__(self, session, resolve_channel, path, size, timeout=10):
+        self.session = session
+        self.resolve_channel = resolve_channel  # 频道标识 -> 上游播放列表URL（在线程池中调用）
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.ring = None  # 首次录制时才创建环形文件
+        self.key = None
+        self._task = None
+        self._ready = None
+        self.stats = {"segments": 0, "bytes": 0, "errors": 0, "last_error": ""}
+
+    def register(self, server):
+        """注册到本地HTTP服务"""
+        server.add_route("/timeshift/", self.handle)
+
+    async def handle(self, request, writer):
+        path = request.path[len("/timeshift/"):]
+        if path == "stats":
+            return json_response(self.snapshot())
+        if path.startswith("seg/"):
+            try:
+                sequence = int(path[len("seg/"):].rsplit(".", 1)[0])
+            except ValueError:
+                return 400, "text/plain; charset=utf-8", b"bad segment"
+            data = self.ring.get(sequence) if self.ring else None
+            if data is None:
+                return 404, "text/plain; charset=utf-8", b"segment expired"
+            return 200, "video/mp2t", data
+        if path.endswith(".m3u8"):
+            key = path[:-len(".m3u8")]
+            try:
+                behind = float(request.query.get("behind", 0) or 0)
+            except ValueError:
+                return 400, "text/plain; charset=utf-8", b"bad behind"
+            if key != self.key and self.recording and request.query.get("switch") != "1":
+                return 409, "text/plain; charset=utf-8", b"timeshift is recording another channel"
+            self.start(key)
+            try:
+                await asyncio.wait_for(asyncio.shield(self._ready.wait()), self.READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                return 504, "text/plain; charset=utf-8", self.stats["last_error"].encode("utf-8") or b"timeout"
+            return 200, "application/vnd.apple.mpegurl", self.build_playlist(behind).encode("utf-8")
+        return 404, "text/plain; charset=utf-8", b"not found"
+
+    @property
+    def recording(self):
+        """是否正在录制某个频道"""
+        return self._task is not None and not self._task.done()
+
+    def start(self, key):
+        """开始录制指定频道（需在事件循环线程中调用），已在录制则不变"""
+        if key == self.key and self.recording:
+            return
+        self.stop()
+        if self.ring is None:
+            self.ring = TimeshiftRing(self.path, self.size)
+        self.ring.reset()
+        self.key = key
+        self._ready = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._record(key))
+
+    def stop(self):
+        """停止录制（需在事件循环线程中调用）"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.key = None
+
+    def close(self):
+        """停止录制并删除环形文件（需在事件循环线程中调用）"""
+        self.stop()
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+
+    def _fetch(self, url):
+        with self.session.get(url, timeout=self.timeout) as response:
+            response.raise_for_status()
+            return response.url, response.content
+
+    async def _record(self, key):
+        """录制循环：定时刷新上游播放列表，下载新分片写入环形文件"""
+        loop = asyncio.get_running_loop()
+        url = None
+        last_sequence = None
+        while True:
+            delay = 1.0
+            try:
+                if url is None:
+                    url = await loop.run_in_executor(None, self.resolve_channel, key)
+                final_url, content = await loop.run_in_executor(None, self._fetch, url)
+                playlist = parse_m3u8(content.decode("utf-8", errors="replace"), final_url)
+                if playlist["variants"] and not playlist["segments"]:
+                    # 多码率：录制第一个子播放列表
+                    url = playlist["variants"][0]
+                    continue
+                segments = playlist["segments"]
+                if last_sequence is None or (segments and segments[-1]["sequence"] < last_sequence - 10):
+                    # 首次（或上游序号重置）：只取窗口末尾几个分片
+                    segments = segments[-self.START_SEGMENTS:]
+                else:
+                    segments = [segment for segment in segments if segment["sequence"] > last_sequence]
+                for segment in segments:
+                    _, data = await loop.run_in_executor(None, self._fetch, segment["uri"])
+                    self.ring.append(data, segment["duration"], segment["pdt"])
+                    last_sequence = segment["sequence"]
+                    self.stats["segments"] += 1
+                    self.stats["bytes"] += len(data)
+                if self.ring.index:
+                    # 首批分片全部写入后才返回播放列表，播放器起播时就有足够的缓冲
+                    self._ready.set()
+                if playlist["endlist"]:
+                    return
+                delay = max((playlist["target_duration"] or 2.0) / 2, 0.5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.stats["last_error"] = str(e) or e.__class__.__name__
+                print(f"时移录制出错 {key}: {e}")
+                # 地址可能已失效（服务器故障或starttime过期），下次重新解析
+                url = None
+                delay = 2.0
+            await asyncio.sleep(delay)
+
+    def build_playlist(self, behind=0.0):
+        """生成本地播放列表：包含环中最早的分片到直播边缘之前behind秒的分片"""
+        entries = list(self.ring.index)
+        end = len(entries)
+        skipped = 0.0
+        while end > 1 and skipped < behind:
+            end -= 1
+            skipped += entries[end]["duration"]
+        entries = entries[:end]
+        target = max((entry["duration"] for entry in entries), default=2.0)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(target + 0.999)}",
+            f"#EXT-X-MEDIA-SEQUENCE:{entries[0]['sequence'] if entries else 0}",
+        ]
+        for entry in entries:
+            if entry["pdt"] is not None:
+                lines.append("#EXT-X-PROGRAM-DATE-TIME:" + entry["pdt"].isoformat(timespec="milliseconds"))
+            lines.append(f"#EXTINF:{entry['duration']:.3f},")
+            lines.append(f"seg/{entry['sequence']}.ts")
+        return "\n".join(lines) + "\n"
+
+    def window_seconds(self):
+        """可回看的秒数，尚未创建或已释放环形文件时返回None
+
+        可在其它线程调用：停止录制时事件循环线程会把ring置为None，只读取一次。
+        """
+        ring = self.ring
+        return ring.duration if ring else None
+
+    def snapshot(self):
+        """录制状态"""
+        ring = self.ring
+        stats = dict(self.stats)
+        stats["channel"] = self.key
+        stats["ring_bytes"] = self.size
+        stats["window_segments"] = len(ring.index) if ring else 0
+        stats["window_seconds"] = ring.duration if ring else 0.0
+        return stats
+
+def strip_rtp_header(packet):
+    """去掉RTP头，返回MPEG-TS负载的memoryview（不复制数据）；裸UDP承载的TS原样返回"""
+    view = memoryview(packet)
+    if len(view) < 12 or view[0] == 0x47 or view[0] >> 6 != 2:
+        return view
+    first = view[0]
+    offset = 12 + (first & 0x0F) * 4
+    if first & 0x10:
+        # 扩展头：2字节profile + 2字节长度（32位字数）
+        if len(view) < offset + 4:
+            return view[0:0]
+        offset += 4 + int.from_bytes(view[offset + 2:offset + 4], "big") * 4
+    end = len(view)
+    if first & 0x20:
+        # 填充：最后一个字节是填充长度
+        end -= view[-1]
+    if offset >= end:
+        return view[0:0]
+    return view[offset:end]
+
+def open_multicast_socket(group, port, interface="0.0.0.0", rcvbuf=4 * 1024 * 1024):
+    """创建加入组播组的UDP套接字（阻塞模式）"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError:
+        pass
+    # Windows不能绑定组播地址，其它平台绑定组播地址以过滤其它组的数据
+    sock.bind(("" if sys.platform == "win32" else group, port))
+    membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton(interface))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return sock
+
+MULTICAST_PATH_RE = re.compile(r"^/(?:udp|rtp)/@?(\d+\.\d+\.\d+\.\d+):(\d+)/?$")
+MULTICAST_URL_RE = re.compile(r"^(?:(?:rtp|udp)://@?|https?://[^/]+/(?:udp|rtp)/@?)(\d+\.\d+\.\d+\.\d+):(\d+)")
+
+class _MulticastClient:
+    """组播中继的一个HTTP客户端"""
+
+    def __init__(self, writer, peer):
+        self.writer = writer
+        self.transport = writer.transport
+        self.peer = peer
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.connected_at = time.monotonic()
+
+    @property
+    def backlog(self):
+        """尚未发出的字节数"""
+        return self.transport.get_write_buffer_size()
+
+class _MulticastGroup(asyncio.DatagramProtocol):
+    """一个已加入的组播组：收到的每个包去掉RTP头后原样分发给全部客户端"""
+
+    def __init__(self, relay, group, port):
+        self.relay = relay
+        self.group = group
+        self.port = port
+        self.clients = set()
+        self.sinks = set()  # 本进程内的接收者（如录制），每个包调用一次
+        self.transport = None
+        self.sock = None
+        self.packets = 0
+        self.bytes_in = 0
+        self.joined_at = time.monotonic()
+        self.leave_handle = None
+
+    def datagram_received(self, data, addr):
+        # 同一个memoryview交给所有客户端，不为每个客户端复制数据
+        payload = strip_rtp_header(data)
+        size = len(payload)
+        self.packets += 1
+        self.bytes_in += size
+        max_backlog = self.relay.max_backlog
+        sent = 0
+        for client in self.clients:
+            if client.transport.is_closing():
+                continue
+            if client.backlog > max_backlog:
+                # 慢客户端：丢包而不是无限堆积内存
+                client.bytes_dropped += size
+                continue
+            client.transport.write(payload)
+            client.bytes_sent += size
+            sent += 1
+        # 只统计实际写出的客户端
+        self.relay.bytes_out += size * sent
+        for sink in self.sinks:
+            sink(payload)
+
+    def error_received(self, exc):
+        print(f"组播接收错误 {self.group}:{self.port}: {exc}")
+
+class MulticastRelay:
+    """RTP组播转HTTP单播中继（替代udpxy）
+
+    访问 /udp/<组播地址>:<端口> 或 /rtp/<组播地址>:<端口>（与udpxy路径兼容）。
+    同一组播组只加入一次，首个客户端连接时加入IGMP组，最后一个客户端断开后离开。
+    /mcast/stats 返回吞吐量（每核Mbit/s）和各客户端积压量。
+    """
+
+    # 最后一个客户端断开后保留组播组的时间（秒），便于快速切回
+    LEAVE_DELAY = 3.0
+
+    def __init__(self, interface="0.0.0.0", max_backlog=4 * 1024 * 1024, rcvbuf=4 * 1024 * 1024):
+        self.interface = interface
+        self.max_backlog = max_backlog
+        self.rcvbuf = rcvbuf
+        self.groups = {}  # (组播地址, 端口) -> _MulticastGroup
+        self._joining = {}  # (组播地址, 端口) -> 正在加入时的Future，并发的首批客户端等待同一次加入
+        self.bytes_out = 0
+        self._started = None  # (单调时间, 线程CPU时间)，首次加入组时在事件循环线程记录
+
+    def register(self, server):
+        """注册到本地HTTP服务"""
+        server.add_route("/udp/", self.handle)
+        server.add_route("/rtp/", self.handle)
+        server.add_route("/mcast/stats", self.handle_stats)
+
+    @staticmethod
+    def local_path(url):
+        """把rtp://、udp://或udpxy格式的地址转换为本中继的路径，不是组播地址时返回None"""
+        match = MULTICAST_URL_RE.match(url)
+        if not match:
+            return None
+        return f"/udp/{match.group(1)}:{match.group(2)}"
+
+    def _open_socket(self, group, port):
+        """创建加入组播组的UDP套接字"""
+        sock = open_multicast_socket(group, port, self.interface, self.rcvbuf)
+        sock.setblocking(False)
+        return sock
+
+    async def _join(self, group, port):
+        key = (group, port)
+        entry = self.groups.get(key)
+        if entry is not None:
+            if entry.leave_handle:
+                entry.leave_handle.cancel()
+                entry.leave_handle = None
+            return entry
+        pending = self._joining.get(key)
+        if pending is not None:
+            # 另一个请求正在加入同一组：等它完成后复用（失败时由本请求重新尝试）
+            await pending
+            return await self._join(group, port)
+        if self._started is None:
+            self._started = (time.monotonic(), time.thread_time())
+        loop = asyncio.get_running_loop()
+        pending = self._joining[key] = loop.create_future()
+        try:
+            entry = _MulticastGroup(self, group, port)
+            entry.sock = self._open_socket(group, port)
+            try:
+                entry.transport, _ = await loop.create_datagram_endpoint(lambda: entry, sock=entry.sock)
+            except BaseException:
+                entry.sock.close()
+                raise
+            self.groups[key] = entry
+        finally:
+            del self._joining[key]
+            pending.set_result(None)
+        print(f"已加入组播组 {group}:{port}")
+        return entry
+
+    def _release(self, entry):
+        """组内没有客户端和本地接收者时，延迟离开组播组"""
+        if entry.clients or entry.sinks:
+            return
+        if entry.leave_handle:
+            entry.leave_handle.cancel()
+        entry.leave_handle = asyncio.get_running_loop().call_later(self.LEAVE_DELAY, self._leave, entry)
+
+    def _leave(self, entry):
+        """离开组播组（IGMP Leave）"""
+        if entry.clients or entry.sinks or self.groups.get((entry.group, entry.port)) is not entry:
+            return
+        del self.groups[(entry.group, entry.port)]
+        try:
+            membership = struct.pack("4s4s", socket.inet_aton(entry.group), socket.inet_aton(self.interface))
+            entry.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, membership)
+        except OSError:
+            pass
+        entry.transport.close()
+        print(f"已离开组播组 {entry.group}:{entry.port}")
+
+    async def subscribe(self, group, port, sink):
+        """在本进程内接收组播数据：sink(负载memoryview) 在事件循环线程中对每个包调用"""
+        entry = await self._join(group, port)
+        entry.sinks.add(sink)
+        return entry
+
+    def unsubscribe(self, entry, sink):
+        entry.sinks.discard(sink)
+        self._release(entry)
+
+    async def handle(self, request, writer):
+        match = MULTICAST_PATH_RE.match(request.path)
+        if not match:
+            return 400, "text/plain; charset=utf-8", b"bad multicast address"
+        group, port = match.group(1), int(match.group(2))
+        first_octet = int(group.split(".")[0])
+        if not 224 <= first_octet <= 239:
+            return 400, "text/plain; charset=utf-8", b"not a multicast address"
+        try:
+            entry = await self._join(group, port)
+        except OSError as e:
+            return 503, "text/plain; charset=utf-8", f"join failed: {e}".encode("utf-8")
+
+        client = None
+        try:
+            writer.write(build_http_head(200, "video/mp2t"))
+            if request.method == "HEAD":
+                await writer.drain()
+                return None
+            client = _MulticastClient(writer, request.peer)
+            entry.clients.add(client)
+            # 数据由datagram_received直接写入，这里读到EOF即客户端已断开（组播暂时没有数据时也能发现）
+            while await request.reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            entry.clients.discard(client)
+            self._release(entry)
+        return None
+
+    async def handle_stats(self, request, writer):
+        return json_response(self.snapshot())
+
+    def snapshot(self):
+        """吞吐量与积压统计（需在事件循环线程中调用，CPU时间按该线程统计）"""
+        elapsed = cpu = 0.0
+        if self._started is not None:
+            elapsed = time.monotonic() - self._started[0]
+            cpu = time.thread_time() - self._started[1]
+        megabits = self.bytes_out * 8 / 1e6
+        groups = []
+        for entry in self.groups.values():
+            groups.append({
+                "group": f"{entry.group}:{entry.port}",
+                "packets": entry.packets,
+                "bytes_in": entry.bytes_in,
+                "clients": [
+                    {
+                        "peer": str(client.peer),
+                        "bytes_sent": client.bytes_sent,
+                        "bytes_dropped": client.bytes_dropped,
+                        "backlog": client.backlog,
+                    }
+                    for client in entry.clients
+                ],
+            })
+        return {
+            "groups": groups,
+            "bytes_out": self.bytes_out,
+            "mbit_per_s": megabits / elapsed if elapsed else 0.0,
+            "mbit_per_s_per_core": megabits / cpu if cpu else 0.0,
+            "cpu_seconds": cpu,
+        }
+
+class RecordingWriter:
+    """录制文件的缓冲写入：数据先攒在内存中，每满 CHUNK_SIZE 交给独立的写线程，事件循环不等待磁盘
+
+    磁盘跟不上时最多积压 MAX_QUEUED 块，超出的数据丢弃并计数，不会无限占用内存。
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    MAX_QUEUED = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb", buffering=0)
+        self.bytes_received = 0
+        self.bytes_written = 0
+        self.bytes_dropped = 0
+        self.error = None
+        self._buffer = bytearray()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        """追加数据（事件循环线程中调用，不阻塞）"""
+        self.bytes_received += len(data)
+        if len(data) >= self.CHUNK_SIZE and not self._buffer:
+            # 整个HLS分片直接交给写线程，不再复制
+            self._enqueue(data)
+            return
+        self._buffer += data
+        if len(self._buffer) >= self.CHUNK_SIZE:
+            chunk, self._buffer = self._buffer, bytearray()
+            self._enqueue(chunk)
+
+    def _enqueue(self, chunk):
+        if self.error or self._queue.qsize() >= self.MAX_QUEUED:
+            self.bytes_dropped += len(chunk)
+            return
+        self._queue.put(chunk)
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            try:
+                self.file.write(chunk)
+                self.bytes_written += len(chunk)
+            except OSError as e:
+                self.error = str(e)
+                self.bytes_dropped += len(chunk)
+        self.file.close()
+
+    def close(self):
+        """写出剩余数据并关闭文件（写线程在后台完成，可用 join 等待）"""
+        if self._buffer:
+            chunk, self._buffer = self._buffer, bytearray()
+            self._enqueue(chunk)
+        self._queue.put(None)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+class StreamRecorder:
+    """录制：把频道的TS数据原样写入文件（不转码），可多路同时录制，支持定时开始和结束
+
+    M3U8频道跟随播放列表下载新分片并依次写入；组播频道通过组播中继接收，去掉RTP头后写入。
+    每路录制是事件循环中的一个任务，写盘由 RecordingWriter 的写线程完成，CPU占用只有数据拷贝。
+    预约和最近的录制保存在状态文件中，重启后未完成的预约继续有效。
+    """
+
+    KEEP_FINISHED = 50  # 状态文件中保留的已结束录制数
+    PADDING = 60  # 按节目单录制时前后多录的秒数
+    NAME_RE = re.compile(r'[\\/:*?"<>|\s]+')
+
+    def __init__(self, loop, session, resolve_channel, multicast_relay, directory, state_file=None, timeout=10):
+        self.loop = loop
+        self.session = session
+        self.resolve_channel = resolve_channel  # 频道标识 -> 上游播放列表URL（在线程池中调用）
+        self.multicast_relay = multicast_relay
+        self.directory = directory
+        self.state_file = state_file
+        self.timeout = timeout
+        self.recordings = {}  # 录制ID -> 录制信息
+        self._tasks = {}
+        self._writers = {}
+        self._next_id = 1
+        self._closing = False
+        # 状态文件在单独的线程中依次写入，不阻塞事件循环
+        self._saver = ThreadPoolExecutor(max_workers=1)
+        self.load_state()
+
+    @staticmethod
+    def source_of(template):
+        """录制方式：组播返回 ("multicast", (地址, 端口))，M3U8返回 ("hls", None)，不支持时返回 (None, None)"""
+        match = MULTICAST_URL_RE.match(template)
+        if match:
+            return "multicast", (match.group(1), int(match.group(2)))
+        if ".m3u8" in template:
+            return "hls", None
+        return None, None
+
+    def add(self, key, name, template, start_at=None, stop_at=None, program=""):
+        """添加一路录制（可在任意线程调用），返回录制信息"""
+        source, _ = self.source_of(template)
+        if source is None:
+            raise ValueError(f"频道不支持录制: {name}")
+        now = time.time()
+        if stop_at is not None and stop_at <= max(start_at or now, now):
+            raise ValueError("结束时间已过")
+        rec = {
+            "id": str(self._next_id),
+            "channel": key,
+            "name": name,
+            "template": template,
+            "program": program,
+            "source": source,
+            "start_at": start_at,
+            "stop_at": stop_at,
+            "state": "scheduled",
+            "path": "",
+            "bytes": 0,
+            "segments": 0,  # 已写入的HLS分片数
+            "packets": 0,  # 已写入的组播报文数
+            "dropped": 0,
+            "error": "",
+        }
+        self._next_id += 1
+        self.recordings[rec["id"]] = rec
+        self.loop.call_soon_threadsafe(self._spawn, rec)
+        self.save_state()
+        return rec
+
+    def _spawn(self, rec):
+        if rec["state"] == "scheduled":
+            self._tasks[rec["id"]] = self.loop.create_task(self._run(rec))
+
+    def cancel(self, rec_id):
+        """停止或取消一路录制（可在任意线程调用），返回是否存在"""
+        rec = self.recordings.get(rec_id)
+        if rec is None or rec["state"] not in ("scheduled", "recording"):
+            return False
+        self.loop.call_soon_threadsafe(self._cancel, rec_id)
+        return True
+
+    def _cancel(self, rec_id):
+        task = self._tasks.get(rec_id)
+        if task:
+            task.cancel()
+
+    def active(self, key=None):
+        """未结束的录制（可按频道过滤）"""
+        return [
+            rec for rec in list(self.recordings.values())
+            if rec["state"] in ("scheduled", "recording") and (key is None or rec["channel"] == key)
+        ]
+
+    def snapshot(self):
+        """全部录制的状态副本（不含内部字段）"""
+        result = []
+        for rec in list(self.recordings.values()):
+            info = {name: value for name, value in rec.items() if name != "template"}
+            writer = self._writers.get(rec["id"])
+            if writer is not None:
+                info["bytes"] = writer.bytes_received
+                info["dropped"] = writer.bytes_dropped
+            result.append(info)
+        return result
+
+    def _file_path(self, rec):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        title = "_".join(part for part in (rec["name"], rec["program"]) if part)
+        base = os.path.join(self.directory, f"{self.NAME_RE.sub('_', title)}_{stamp}")
+        path = base + ".ts"
+        number = 1
+        while os.path.exists(path):
+            # 同一秒内开始的同名录制
+            number += 1
+            path = f"{base}_{number}.ts"
+        return path
+
+    async def _run(self, rec):
+        """一路录制：等到开始时间，录制到结束时间或被取消"""
+        writer = None
+        try:
+            if rec["start_at"] is not None:
+                await asyncio.sleep(max(rec["start_at"] - time.time(), 0))
+            rec["path"] = self._file_path(rec)
+            writer = self._writers[rec["id"]] = RecordingWriter(rec["path"])
+            rec["segments"] = rec["packets"] = rec["bytes"] = rec["dropped"] = 0
+            rec["state"] = "recording"
+            rec["started"] = time.time()
+            self.save_state()
+            print(f"开始录制 {rec['name']}: {rec['path']}")
+            if rec["source"] == "multicast":
+                record = self._record_multicast(rec, writer)
+            else:
+                record = self._record_hls(rec, writer)
+            if rec["stop_at"] is None:
+                await record
+            else:
+                try:
+                    await asyncio.wait_for(record, max(rec["stop_at"] - time.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            rec["state"] = "done"
+        except asyncio.CancelledError:
+            if not self._closing:
+                rec["state"] = "cancelled" if writer is None else "done"
+            # 程序退出时保留状态，下次启动继续未完成的预约和录制
+        except Exception as e:
+            rec["state"] = "failed"
+            rec["error"] = str(e) or e.__class__.__name__
+            print(f"录制失败 {rec['name']}: {rec['error']}")
+        finally:
+            rec["ended"] = time.time()
+            self._tasks.pop(rec["id"], None)
+            if writer is not None:
+                writer.close()
+                await self.loop.run_in_executor(None, writer.join)
+                rec["bytes"] = writer.bytes_written
+                rec["dropped"] = writer.bytes_dropped
+                if writer.error:
+                    rec["error"] = writer.error
+                self._writers.pop(rec["id"], None)
+                print(f"录制结束 {rec['name']}: {rec['bytes'] / 1048576:.1f} MB")
+            self.save_state()
+
+    def _fetch(self, url):
+        with self.session.get(url, timeout=self.timeout) as response:
+            response.raise_for_status()
+            return response.url, response.content
+
+    async def _record_hls(self, rec, writer):
+        """跟随播放列表下载新分片，按序号依次写入"""
+        loop = self.loop
+        url = None
+        last_sequence = None
+        while True:
+            delay = 1.0
+            try:
+                if url is None:
+                    url = await loop.run_in_executor(None, self.resolve_channel, rec["channel"])
+                final_url, content = await loop.run_in_executor(None, self._fetch, url)
+                playlist = parse_m3u8(content.decode("utf-8", errors="replace"), final_url)
+                if playlist["variants"] and not playlist["segments"]:
+                    url = playlist["variants"][0]
+                    continue
+                segments = playlist["segments"]
+                if last_sequence is None or (segments and segments[-1]["sequence"] < last_sequence - 10):
+                    # 从直播边缘的最后一个分片开始
+                    segments = segments[-1:]
+                else:
+                    segments = [segment for segment in segments if segment["sequence"] > last_sequence]
+                for segment in segments:
+                    _, data = await loop.run_in_executor(None, self._fetch, segment["uri"])
+                    writer.write(data)
+                    last_sequence = segment["sequence"]
+                    rec["segments"] += 1
+                if playlist["endlist"]:
+                    return
+                delay = max((playlist["target_duration"] or 2.0) / 2, 0.5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                rec["error"] = str(e) or e.__class__.__name__
+                print(f"录制出错 {rec['name']}: {rec['error']}")
+                # 地址可能已失效（服务器故障），下次重新解析
+                url = None
+                delay = 2.0
+            await asyncio.sleep(delay)
+
+    async def _record_multicast(self, rec, writer):
+        """通过组播中继接收数据，直到被取消"""
+        _, (group, port) = self.source_of(rec["template"])
+
+        def sink(payload):
+            writer.write(payload)
+            rec["packets"] += 1
+
+        entry = await self.multicast_relay.subscribe(group, port, sink)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.multicast_relay.unsubscribe(entry, sink)
+
+    async def close(self):
+        """停止全部录制并等待文件写完（事件循环线程中），未完成的预约保留到下次启动"""
+        self._closing = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.loop.run_in_executor(None, self._saver.shutdown)
+
+    def load_state(self):
+        """恢复上次保存的录制：未结束的预约继续有效，中断的录制从现在起继续到原结束时间"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except Exception as e:
+            print(f"读取录制计划失败: {e}")
+            return
+        now = time.time()
+        for rec in saved:
+            self._next_id = max(self._next_id, int(rec["id"]) + 1)
+            if rec["state"] in ("scheduled", "recording"):
+                if rec["stop_at"] is None or rec["stop_at"] <= now:
+                    # 没有结束时间的录制不随重启自动恢复
+                    rec["state"] = "done" if rec["state"] == "recording" else "cancelled"
+                else:
+                    rec["state"] = "scheduled"
+                    self.loop.call_soon_threadsafe(self._spawn, rec)
+            self.recordings[rec["id"]] = rec
+
+    @staticmethod
+    def has_pending(state_file):
+        """状态文件中是否有未到结束时间的预约（用于启动时决定是否要创建录制器）"""
+        try:
+            with open(state_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        now = time.time()
+        return any(
+            rec.get("state") in ("scheduled", "recording") and (rec.get("stop_at") or 0) > now
+            for rec in saved
+        )
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        recordings = list(self.recordings.values())
+        finished = [rec for rec in recordings if rec["state"] not in ("scheduled", "recording")]
+        keep = [rec for rec in recordings if rec["state"] in ("scheduled", "recording")]
+        keep += finished[-self.KEEP_FINISHED:]
+        # 在调用线程中序列化（录制信息随后还会变化），写文件交给保存线程
+        text = json.dumps([dict(rec) for rec in sorted(keep, key=lambda rec: int(rec["id"]))], ensure_ascii=False)
+        try:
+            self._saver.submit(self._write_state, text)
+        except RuntimeError:
+            # 已关闭（程序退出中）
+            pass
+
+    def _write_state(self, text):
+        try:
+            with open(self.state_file + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        except OSError:
+            pass
+
+PCAP_LINK_OFFSETS = {1: 14, 12: 0, 101: 0, 113: 16, 276: 20}  # 链路层类型 -> 链路层头长度
+
+def read_pcap_udp(path):
+    """读取pcap文件中的IPv4 UDP报文，逐个返回 (时间戳, 目的地址, 目的端口, 负载memoryview)
+
+    支持以太网（含VLAN标签）、Linux cooked（SLL/SLL2）和裸IP链路层，不支持pcapng（可先用 editcap -F pcap 转换）。
+    分片报文只取第一片以外的会被跳过。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    view = memoryview(data)
+    magic = data[:4]
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = ">"
+    elif magic == b"\x0a\x0d\x0d\x0a":
+        raise ValueError("不支持pcapng格式，请先用 editcap -F pcap 转换")
+    else:
+        raise ValueError("不是pcap文件")
+    scale = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e-6
+    linktype = struct.unpack_from(endian + "I", data, 20)[0] & 0xFFFF
+    link = PCAP_LINK_OFFSETS.get(linktype)
+    if link is None:
+        raise ValueError(f"不支持的链路层类型: {linktype}")
+    record = struct.Struct(endian + "IIII")
+    position = 24
+    end = len(data)
+    while position + 16 <= end:
+        seconds, fraction, captured, _ = record.unpack_from(data, position)
+        position += 16
+        frame = view[position:position + captured]
+        position += captured
+        offset = link
+        if linktype == 1:
+            # 以太网：跳过VLAN标签，只处理IPv4
+            ethertype = int.from_bytes(frame[12:14], "big")
+            while ethertype in (0x8100, 0x88A8) and len(frame) >= offset + 4:
+                ethertype = int.from_bytes(frame[offset + 2:offset + 4], "big")
+                offset += 4
+            if ethertype != 0x0800:
+                continue
+        if len(frame) < offset + 28 or frame[offset] >> 4 != 4 or frame[offset + 9] != 17:
+            continue
+        if int.from_bytes(frame[offset + 6:offset + 8], "big") & 0x1FFF:
+            continue
+        header_length = (frame[offset] & 0x0F) * 4
+        udp = offset + header_length
+        destination = socket.inet_ntoa(frame[offset + 16:offset + 20])
+        port = int.from_bytes(frame[udp + 2:udp + 4], "big")
+        length = int.from_bytes(frame[udp + 4:udp + 6], "big")
+        yield seconds + fraction * scale, destination, port, frame[udp + 8:udp + max(length, 8)]
+
+class StreamAnalyzer:
+    """组播/TS流分析：RTP丢包与乱序、到达抖动、TS连续计数错误、PCR抖动和各PID码率
+
+    抓包时只把报文追加到数组（到达时间、RTP头、对齐的TS包），保证高码率下接收不掉包；
+    统计在结束后按列一次算完：装有numpy时向量化计算，否则按步长切片取出各列后逐包统计。
+    """
+
+    RTP_CLOCK = 90000
+    PCR_CLOCK = 27000000
+    PCR_WRAP = (1 << 33) * 300 / 27000000  # PCR回绕周期（秒）
+    PCR_INTERVAL_LIMIT = 0.04  # TR 101 290：同一PID的PCR间隔不应超过40毫秒
+    NULL_PID = 0x1FFF
+
+    def __init__(self, source="", use_numpy=None):
+        self.source = source
+        if use_numpy is None:
+            try:
+                numpy.frombuffer
+                use_numpy = True
+            except ImportError:
+                use_numpy = False
+        self.use_numpy = use_numpy
+        self.arrivals = array("d")  # 每个报文的到达时间（秒）
+        self.headers = bytearray()  # 每个报文的前12字节（RTP头）
+        self.ts_counts = array("I")  # 每个报文中对齐的TS包数
+        self.ts = bytearray()  # 对齐的TS包
+        self.unaligned = 0  # 负载不以同步字节开头或长度不是188整数倍的报文
+
+    # ---- 输入 ----
+
+    def add_datagram(self, arrival, data):
+        """追加一个UDP负载（RTP或裸UDP承载的TS）"""
+        view = memoryview(data)
+        self.arrivals.append(arrival)
+        header = view[:12]
+        self.headers += header
+        if len(header) < 12:
+            self.headers += bytes(12 - len(header))
+        payload = strip_rtp_header(view)
+        count = len(payload) // 188
+        if count == 0 or payload[0] != 0x47:
+            self.unaligned += 1
+            count = 0
+        elif len(payload) % 188:
+            self.unaligned += 1
+        self.ts_counts.append(count)
+        self.ts += payload[:count * 188]
+
+    def capture(self, group, port, seconds, interface="0.0.0.0", progress=None):
+        """加入组播组抓包 seconds 秒，到达时间取接收时刻"""
+        sock = open_multicast_socket(group, port, interface, rcvbuf=16 * 1024 * 1024)
+        sock.settimeout(0.5)
+        buffer = bytearray(65536)
+        recv_into = sock.recv_into
+        add = self.add_datagram
+        clock = time.monotonic
+        started = clock()
+        deadline = started + seconds
+        next_report = started + 5
+        try:
+            while True:
+                try:
+                    size = recv_into(buffer)
+                except socket.timeout:
+                    size = 0
+                now = clock()
+                if size:
+                    add(now, buffer[:size])
+                if now >= deadline:
+                    break
+                if progress and now >= next_report:
+                    progress(now - started, len(self.arrivals))
+                    next_report += 5
+        finally:
+            sock.close()
+
+    def load_pcap(self, path, group=None, port=None):
+        """读取pcap文件，分析指定的UDP流，未指定时取报文最多的流；返回 (地址, 端口)"""
+        if group is None:
+            flows = {}
+            for _, destination, destination_port, _ in read_pcap_udp(path):
+                key = (destination, destination_port)
+                flows[key] = flows.get(key, 0) + 1
+            if not flows:
+                raise ValueError("pcap文件中没有UDP报文")
+            group, port = max(flows, key=flows.get)
+        for arrival, destination, destination_port, payload in read_pcap_udp(path):
+            if destination == group and destination_port == port:
+                self.add_datagram(arrival, payload)
+        return group, port
+
+    def load_ts(self, path):
+        """读取TS文件（没有报文层，PCR抖动按包位置计算）"""
+        with open(path, "rb") as f:
+            data = f.read()
+        start = 0
+        # 找到连续三个包都以同步字节开头的位置
+        while start + 376 < len(data) and not (data[start] == data[start + 188] == data[start + 376] == 0x47):
+            start += 1
+        count = (len(data) - start) // 188
+        if count == 0:
+            raise ValueError("文件中没有TS包")
+        self.ts = bytearray(memoryview(data)[start:start + count * 188])
+
+    # ---- 统计 ----
+
+    def analyze(self):
+        """计算全部统计，返回报告（可直接序列化为JSON）"""
+        if not self.arrivals and not self.ts:
+            raise ValueError("没有收到数据")
+        started = time.perf_counter()
+        report = {"source": self.source, "engine": "numpy" if self.use_numpy else "python"}
+        arrivals = self.arrivals
+        duration = arrivals[-1] - arrivals[0] if len(arrivals) > 1 else None
+        if arrivals:
+            report["datagrams"] = len(arrivals)
+            report["unaligned_datagrams"] = self.unaligned
+            report["arrival"] = self._arrival_stats()
+            first = self.headers[0]
+            report["rtp"] = self._rtp_stats() if first >> 6 == 2 and first != 0x47 else None
+        ts, pids, pcr_samples = self._ts_stats()
+        report["ts"] = ts
+        report["pcr"] = [
+            dict(self._pcr_stats(positions, values), pid=pid)
+            for pid, (positions, values) in sorted(pcr_samples.items())
+        ]
+        if duration is None and report["pcr"]:
+            # TS文件：按PCR拟合的复用码率换算时长
+            pcr = report["pcr"][0]
+            duration = ts["packets"] * 188 * 8 / (pcr["mux_kbps"] * 1000) if pcr.get("mux_kbps") else pcr["span"]
+        report["duration"] = duration
+        total = ts["packets"] or 1
+        report["pids"] = [
+            {
+                "pid": pid,
+                "packets": packets,
+                "share": packets / total,
+                "kbps": packets * 188 * 8 / duration / 1000 if duration else None,
+                "cc_errors": cc_errors,
+            }
+            for pid, packets, cc_errors in sorted(pids, key=lambda item: -item[1])
+        ]
+        report["bitrate_kbps"] = ts["packets"] * 188 * 8 / duration / 1000 if duration else None
+        report["analysis_seconds"] = time.perf_counter() - started
+        return report
+
+    @staticmethod
+    def _percentile(values, fraction):
+        """已排序序列的百分位数（取最近的样本）"""
+        return values[min(int(len(values) * fraction), len(values) - 1)] if len(values) else None
+
+    def _arrival_stats(self):
+        """报文到达间隔（毫秒）"""
+        if len(self.arrivals) < 2:
+            return None
+        if self.use_numpy:
+            gaps = numpy.sort(numpy.diff(numpy.frombuffer(self.arrivals, numpy.float64))) * 1000
+            mean = float(gaps.mean())
+        else:
+            arrivals = self.arrivals
+            gaps = sorted((arrivals[i + 1] - arrivals[i]) * 1000 for i in range(len(arrivals) - 1))
+            mean = sum(gaps) / len(gaps)
+        return {
+            "mean_ms": mean,
+            "p99_ms": float(self._percentile(gaps, 0.99)),
+            "max_ms": float(gaps[-1]),
+        }
+
+    def _rtp_stats(self):
+        """RTP序号缺口、乱序、重复和RFC 3550到达抖动"""
+        headers = self.headers
+        count = len(self.arrivals)
+        if self.use_numpy:
+            np = numpy
+            columns = np.frombuffer(headers, np.uint8).reshape(-1, 12).astype(np.int64)
+            sequence = columns[:, 2] << 8 | columns[:, 3]
+            steps = (np.diff(sequence) + 32768) % 65536 - 32768
+            extended = np.concatenate(([0], np.cumsum(steps)))
+            unique = len(np.unique(extended))
+            expected = int(extended.max() - extended.min()) + 1
+            gaps = steps[steps > 1] - 1
+            reordered = int(np.count_nonzero(steps < 0))
+            timestamps = columns[:, 4] << 24 | columns[:, 5] << 16 | columns[:, 6] << 8 | columns[:, 7]
+            clock_steps = (np.diff(timestamps) + (1 << 31)) % (1 << 32) - (1 << 31)
+            transit = np.frombuffer(self.arrivals, np.float64) * self.RTP_CLOCK
+            transit -= np.concatenate(([0], np.cumsum(clock_steps)))
+            deviations = np.abs(np.diff(transit))
+            # J(i) = J(i-1) + (|D| - J(i-1)) / 16 展开为指数加权和，更早的项权重可以忽略
+            tail = deviations[-2000:]
+            weights = (15 / 16) ** np.arange(len(tail) - 1, -1, -1)
+            jitter = float((tail * weights).sum() / 16)
+            gap_count, max_gap = len(gaps), int(gaps.max()) if len(gaps) else 0
+        else:
+            sequence = [high << 8 | low for high, low in zip(headers[2::12], headers[3::12])]
+            timestamps = [
+                int.from_bytes(headers[offset + 4:offset + 8], "big") for offset in range(0, len(headers), 12)
+            ]
+            arrivals = self.arrivals
+            extended = [0]
+            position = 0
+            clock = 0
+            previous_transit = arrivals[0] * self.RTP_CLOCK
+            gap_count = max_gap = reordered = 0
+            jitter = 0.0
+            for i in range(1, count):
+                step = (sequence[i] - sequence[i - 1] + 32768) % 65536 - 32768
+                position += step
+                extended.append(position)
+                if step > 1:
+                    gap_count += 1
+                    max_gap = max(max_gap, step - 1)
+                elif step < 0:
+                    reordered += 1
+                clock += (timestamps[i] - timestamps[i - 1] + (1 << 31)) % (1 << 32) - (1 << 31)
+                transit = arrivals[i] * self.RTP_CLOCK - clock
+                jitter += (abs(transit - previous_transit) - jitter) / 16
+                previous_transit = transit
+            unique = len(set(extended))
+            expected = max(extended) - min(extended) + 1
+        lost = expected - unique
+        return {
+            "packets": count,
+            "expected": expected,
+            "lost": lost,
+            "loss_rate": lost / expected if expected else 0.0,
+            "gaps": gap_count,
+            "max_gap": max_gap,
+            "reordered": reordered,
+            "duplicates": count - unique,
+            "jitter_ms": jitter * 1000 / self.RTP_CLOCK,
+        }
+
+    def _ts_stats(self):
+        """TS包统计，返回 (汇总, [(PID, 包数, 连续计数错误)], {PCR的PID: (位置或到达时间, PCR秒)})"""
+        ts = self.ts
+        packets = len(ts) // 188
+        with_arrivals = len(self.arrivals) > 0
+        if self.use_numpy:
+            np = numpy
+            table = np.frombuffer(ts, np.uint8, packets * 188).reshape(-1, 188)
+            sync_errors = int(np.count_nonzero(table[:, 0] != 0x47))
+            tei_errors = int(np.count_nonzero(table[:, 1] & 0x80))
+            pid = (table[:, 1].astype(np.int64) & 0x1F) << 8 | table[:, 2]
+            control = table[:, 3] >> 4
+            counter = table[:, 3] & 0x0F
+            adaptation = ((control & 2) != 0) & (table[:, 4] > 0)
+            discontinuity = adaptation & ((table[:, 5] & 0x80) != 0)
+            has_pcr = adaptation & (table[:, 4] >= 7) & ((table[:, 5] & 0x10) != 0)
+            counts = np.bincount(pid, minlength=8192)
+            # 连续计数：按PID稳定排序后比较相邻包，重复包（差0）允许，不连续标志处重新开始
+            checked = np.nonzero(((control & 1) != 0) & (pid != self.NULL_PID))[0]
+            order = checked[np.argsort(pid[checked], kind="stable")]
+            same_pid = pid[order][1:] == pid[order][:-1]
+            step = (counter[order][1:].astype(np.int64) - counter[order][:-1]) % 16
+            errors = same_pid & (step > 1) & ~discontinuity[order][1:]
+            cc_counts = np.bincount(pid[order][1:][errors], minlength=8192)
+            pids = [(int(p), int(counts[p]), int(cc_counts[p])) for p in np.nonzero(counts)[0]]
+            pcr_rows = np.nonzero(has_pcr)[0]
+            fields = table[pcr_rows, 6:12].astype(np.int64)
+            base = fields[:, 0] << 25 | fields[:, 1] << 17 | fields[:, 2] << 9 | fields[:, 3] << 1 | fields[:, 4] >> 7
+            pcr = (base * 300 + ((fields[:, 4] & 1) << 8 | fields[:, 5])) / self.PCR_CLOCK
+            if with_arrivals:
+                owners = np.repeat(np.arange(len(self.arrivals)), np.frombuffer(self.ts_counts, np.uint32))
+                positions = np.frombuffer(self.arrivals, np.float64)[owners[pcr_rows]]
+            else:
+                positions = pcr_rows.astype(np.float64)
+            pcr_pids = pid[pcr_rows]
+            pcr_samples = {
+                int(p): (positions[pcr_pids == p].tolist(), pcr[pcr_pids == p].tolist())
+                for p in np.unique(pcr_pids)
+            }
+            cc_total = int(errors.sum())
+        else:
+            view = memoryview(ts)[:packets * 188]
+            sync_errors = packets - bytes(view[0::188]).count(0x47)
+            counts = {}
+            cc_counts = {}
+            last_counter = {}
+            pcr_samples = {}
+            tei_errors = cc_total = 0
+            if with_arrivals:
+                owners = []
+                for index, count in enumerate(self.ts_counts):
+                    owners.extend([index] * count)
+            for index, (b1, b2, b3, b4, b5) in enumerate(
+                zip(view[1::188], view[2::188], view[3::188], view[4::188], view[5::188])
+            ):
+                pid = (b1 & 0x1F) << 8 | b2
+                counts[pid] = counts.get(pid, 0) + 1
+                if b1 & 0x80:
+                    tei_errors += 1
+                adaptation = b3 & 0x20 and b4 > 0
+                if b3 & 0x10 and pid != self.NULL_PID:
+                    previous = last_counter.get(pid)
+                    counter = b3 & 0x0F
+                    if previous is not None and (counter - previous) % 16 > 1 and not (adaptation and b5 & 0x80):
+                        cc_counts[pid] = cc_counts.get(pid, 0) + 1
+                        cc_total += 1
+                    last_counter[pid] = counter
+                if adaptation and b4 >= 7 and b5 & 0x10:
+                    offset = index * 188 + 6
+                    raw = int.from_bytes(view[offset:offset + 6], "big")
+                    pcr = ((raw >> 15) * 300 + (raw & 0x1FF)) / self.PCR_CLOCK
+                    position = self.arrivals[owners[index]] if with_arrivals else float(index)
+                    positions, values = pcr_samples.setdefault(pid, ([], []))
+                    positions.append(position)
+                    values.append(pcr)
+            pids = [(pid, counts[pid], cc_counts.get(pid, 0)) for pid in sorted(counts)]
+        summary = {
+            "packets": packets,
+            "sync_errors": sync_errors,
+            "tei_errors": tei_errors,
+            "cc_errors": cc_total,
+        }
+        return summary, pids, pcr_samples
+
+    def _pcr_stats(self, positions, values):
+        """一个PID的PCR间隔和抖动
+
+        有到达时间时，抖动为 到达时间-PCR 去掉线性漂移后的峰峰值（网络抖动加复用器PCR误差）；
+        只有TS文件时，按包位置线性拟合PCR（恒定码率），抖动为PCR偏离拟合直线的峰峰值。
+        """
+        # PCR回绕和不连续（跳变超过1秒或倒退）处把时间轴接上，按正常间隔继续
+        timeline = [0.0]
+        intervals = []
+        discontinuities = 0
+        for i in range(1, len(values)):
+            step = values[i] - values[i - 1]
+            if step < -self.PCR_WRAP / 2:
+                step += self.PCR_WRAP
+            if step <= 0 or step > 1:
+                discontinuities += 1
+                step = intervals[-1] if intervals else 0.0
+            else:
+                intervals.append(step)
+            timeline.append(timeline[-1] + step)
+        result = {
+            "count": len(values),
+            "span": timeline[-1],
+            "discontinuities": discontinuities,
+            "interval_mean_ms": sum(intervals) / len(intervals) * 1000 if intervals else None,
+            "interval_max_ms": max(intervals) * 1000 if intervals else None,
+            "interval_errors": sum(1 for step in intervals if step > self.PCR_INTERVAL_LIMIT),
+            "jitter_ms": None,
+            "drift_ppm": None,
+        }
+        if len(values) < 3:
+            return result
+        # 最小二乘拟合 y = a + b*x
+        if self.arrivals:
+            xs, ys = timeline, [position - pcr for position, pcr in zip(positions, timeline)]
+        else:
+            xs, ys = positions, timeline
+        count = len(xs)
+        mean_x = sum(xs) / count
+        mean_y = sum(ys) / count
+        variance = sum((x - mean_x) ** 2 for x in xs)
+        if variance == 0:
+            return result
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+        residuals = [y - mean_y - slope * (x - mean_x) for x, y in zip(xs, ys)]
+        result["jitter_ms"] = (max(residuals) - min(residuals)) * 1000
+        if self.arrivals:
+            result["drift_ppm"] = slope * 1e6
+        elif slope > 0:
+            # 每个包对应的PCR时长 -> 复用码率
+            result["mux_kbps"] = 188 * 8 / slope / 1000
+        return result
+
+def format_analysis_report(report):
+    """把分析报告整理成便于阅读的文本"""
+    def number(value, unit="", digits=2):
+        return "-" if value is None else f"{value:.{digits}f}{unit}"
+
+    lines = [f"分析对象: {report['source']}（{report['engine']}，统计用时 {report['analysis_seconds']:.3f} 秒）"]
+    if report["duration"]:
+        lines.append(f"时长: {report['duration']:.1f} 秒，总码率: {number(report['bitrate_kbps'], ' kbps', 0)}")
+    if report.get("datagrams"):
+        arrival = report["arrival"] or {}
+        lines.append(
+            f"报文: {report['datagrams']} 个，未对齐 {report['unaligned_datagrams']} 个；到达间隔 平均 "
+            f"{number(arrival.get('mean_ms'), ' ms')}，P99 {number(arrival.get('p99_ms'), ' ms')}，"
+            f"最大 {number(arrival.get('max_ms'), ' ms')}"
+        )
+    rtp = report.get("rtp")
+    if rtp:
+        lines.append(
+            f"RTP: 丢失 {rtp['lost']}/{rtp['expected']}（{rtp['loss_rate'] * 100:.3f}%），缺口 {rtp['gaps']} 处"
+            f"（最大 {rtp['max_gap']}），乱序 {rtp['reordered']}，重复 {rtp['duplicates']}，"
+            f"到达抖动 {rtp['jitter_ms']:.2f} ms"
+        )
+    elif "rtp" in report:
+        lines.append("RTP: 无（裸UDP承载TS）")
+    ts = report["ts"]
+    lines.append(
+        f"TS: {ts['packets']} 包，同步字节错误 {ts['sync_errors']}，传输错误标志 {ts['tei_errors']}，"
+        f"连续计数错误 {ts['cc_errors']}"
+    )
+    for pcr in report["pcr"]:
+        line = (
+            f"PCR（PID {pcr['pid']}）: {pcr['count']} 个，间隔 平均 {number(pcr['interval_mean_ms'], ' ms')}，"
+            f"最大 {number(pcr['interval_max_ms'], ' ms')}，超过40毫秒 {pcr['interval_errors']} 次，"
+            f"不连续 {pcr['discontinuities']} 次，抖动 {number(pcr['jitter_ms'], ' ms', 3)}"
+        )
+        if pcr.get("drift_ppm") is not None:
+            line += f"，时钟偏差 {pcr['drift_ppm']:.1f} ppm"
+        if pcr.get("mux_kbps") is not None:
+            line += f"，复用码率 {pcr['mux_kbps']:.0f} kbps"
+        lines.append(line)
+    lines.append("PID        包数    占比        码率  连续计数错误")
+    for entry in report["pids"]:
+        lines.append(
+            f"{entry['pid']:>5} (0x{entry['pid']:04X}) {entry['packets']:>8} {entry['share'] * 100:>6.2f}% "
+            f"{number(entry['kbps'], ' kbps', 0):>12} {entry['cc_errors']:>6}"
+        )
+    return "\n".join(lines)
+
+def parse_program_date_time(value):
+    """解析EXT-X-PROGRAM-DATE-TIME的值，返回带时区的datetime，无法解析时返回None"""
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def parse_m3u8(text, base_url=""):
+    """解析M3U8播放列表
+
+    返回字典：media_sequence、target_duration、endlist、
+    segments（每项含uri、duration、sequence、pdt）和variants（多码率子播放列表地址）。
+    没有PROGRAM-DATE-TIME标签的分片按前一分片的时间顺推。
+    """
+    playlist = {
+        "media_sequence": 0,
+        "target_duration": None,
+        "endlist": False,
+        "segments": [],
+        "variants": [],
+    }
+    segments = playlist["segments"]
+    duration = None
+    pdt = None
+    expect_variant = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            tag, _, value = line.partition(":")
+            try:
+                if tag == "#EXT-X-MEDIA-SEQUENCE":
+                    playlist["media_sequence"] = int(value)
+                elif tag == "#EXT-X-TARGETDURATION":
+                    playlist["target_duration"] = float(value)
+                elif tag == "#EXTINF":
+                    duration = float(value.split(",", 1)[0])
+                elif tag == "#EXT-X-PROGRAM-DATE-TIME":
+                    pdt = parse_program_date_time(value)
+                elif tag == "#EXT-X-STREAM-INF":
+                    expect_variant = True
+                elif tag == "#EXT-X-ENDLIST":
+                    playlist["endlist"] = True
+            except ValueError:
+                pass
+            continue
+        uri = urllib.parse.urljoin(base_url, line)
+        if expect_variant:
+            playlist["variants"].append(uri)
+            expect_variant = False
+            continue
+        if duration is None:
+            duration = playlist["target_duration"] or 0.0
+        if pdt is None and segments and segments[-1]["pdt"] is not None:
+            previous = segments[-1]
+            pdt = previous["pdt"] + timedelta(seconds=previous["duration"])
+        segments.append({
+            "uri": uri,
+            "duration": duration,
+            "sequence": playlist["media_sequence"] + len(segments),
+            "pdt": pdt,
+        })
+        duration = None
+        pdt = None
+    if playlist["target_duration"] is None and segments:
+        playlist["target_duration"] = max(segment["duration"] for segment in segments)
+    return playlist
+
+class LiveEdgeResolver:
+    """直播边缘起播：解析服务器返回的m3u8，求出服务器实际能提供的最新starttime
+
+    服务器对 starttime=当前时间 返回的是较早的内容（比组播慢约1分钟）。
+    按播放列表中的节目时间（PROGRAM-DATE-TIME）或分片总时长算出需要前移的秒数，
+    使播放从距直播边缘HOLD_SEGMENTS个分片处开始。结果按（服务器, 频道）缓存。
+    """
+
+    # 起播位置与直播边缘之间保留的分片数
+    HOLD_SEGMENTS = 2
+
+    def __init__(self, get_session, timeout=3, ttl=300):
+        self.get_session = get_session  # 返回共享HTTP会话的函数（会话按需创建）
+        self.timeout = timeout
+        self.ttl = ttl
+        self._cache = {}  # (服务器, 频道标识) -> 测量结果
+        self._lock = threading.Lock()
+
+    def cached(self, server, key):
+        """返回未过期的测量结果，没有时返回None"""
+        with self._lock:
+            info = self._cache.get((server, key))
+        if info is None or info["expires"] < time.monotonic():
+            return None
+        return info
+
+    def shifts(self):
+        """全部未过期结果的起播偏移：{(服务器, 频道标识): 秒}"""
+        now = time.monotonic()
+        with self._lock:
+            return {cache_key: info["shift"] for cache_key, info in self._cache.items() if info["expires"] >= now}
+
+    def _fetch_media_playlist(self, url):
+        """获取媒体播放列表，遇到多码率主列表时取第一个子列表"""
+        for _ in range(2):
+            with self.get_session().get(url, timeout=self.timeout) as response:
+                response.raise_for_status()
+                playlist = parse_m3u8(response.text, response.url)
+            if playlist["segments"] or not playlist["variants"]:
+                return playlist
+            url = playlist["variants"][0]
+        return playlist
+
+    def measure(self, server, key, render, now):
+        """测量直播边缘（阻塞）
+
+        render(offset) 返回starttime比当前时间晚offset秒的播放地址，now() 返回校正后的UTC时间。
+        返回字典：shift（starttime应前移的秒数）、delay（起播时与直播的延迟秒数，无法测量时为None）。
+        """
+        requested_at = now()
+        playlist = self._fetch_media_playlist(render(0.0))
+        segments = playlist["segments"]
+        if not segments:
+            raise ValueError("播放列表中没有分片")
+        target = playlist["target_duration"] or segments[-1]["duration"]
+        hold = min(self.HOLD_SEGMENTS, len(segments)) * target
+
+        first, last = segments[0], segments[-1]
+        if first["pdt"] is not None and last["pdt"] is not None:
+            edge = last["pdt"] + timedelta(seconds=last["duration"])
+            shift = ((edge - timedelta(seconds=hold)) - first["pdt"]).total_seconds()
+        else:
+            # 没有节目时间时，认为第一个分片对应请求的starttime、最后一个分片到达直播边缘
+            shift = sum(segment["duration"] for segment in segments) - hold
+        shift = max(shift, 0.0)
+
+        delay = None
+        if first["pdt"] is not None:
+            delay = (requested_at - first["pdt"]).total_seconds()
+        if shift > 0:
+            # 用新的starttime再取一次，确认服务器确实能提供并测出实际延迟
+            try:
+                verified_at = now()
+                verified = self._fetch_media_playlist(render(shift))
+                if not verified["segments"]:
+                    raise ValueError("播放列表中没有分片")
+                if verified["segments"][0]["pdt"] is not None:
+                    delay = (verified_at - verified["segments"][0]["pdt"]).total_seconds()
+                elif delay is not None:
+                    delay -= shift
+            except (requests.exceptions.RequestException, ValueError):
+                shift = 0.0
+
+        info = {
+            "shift": shift,
+            "delay": delay,
+            "target_duration": target,
+            "expires": time.monotonic() + self.ttl,
+        }
+        with self._lock:
+            self._cache[(server, key)] = info
+        return info
+
+class ServerProber:
+    """后台服务器探测器：定时并发探测全部服务器，维护按延迟排序的加权排名表"""
+
+    # 连续失败多少次后判定服务器不可用
+    FAIL_THRESHOLD = 2
+    # 指数加权平均系数
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, get_servers, make_probe_url, interval=30, timeout=3, max_workers=8, on_update=None):
+        self.get_servers = get_servers  # 返回当前服务器列表的函数
+        self.make_probe_url = make_probe_url  # 根据服务器生成探测URL的函数
+        self.interval = interval
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.on_update = on_update  # 排名更新后的回调（在探测线程中调用）
+        self.stats = {}  # 服务器 -> 探测统计
+        self.ranking = []  # 按得分排序的服务器列表（可用的在前）
+        self.best = None  # 当前最快的可用服务器，供O(1)读取
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动后台探测线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._probe_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台探测"""
+        self._stop.set()
+        self._wake.set()
+
+    def probe_now(self):
+        """立即触发一轮探测"""
+        self._wake.set()
+
+    def _probe_loop(self):
+        """定时探测循环"""
+        while not self._stop.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                print(f"服务器探测出错: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def probe_all(self):
+        """并发探测所有服务器并重建排名"""
+        servers = list(self.get_servers())
+        if not servers:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(servers))) as pool:
+            results = list(pool.map(self.probe_server, servers))
+        with self._lock:
+            # 删除已不在列表中的服务器
+            for server in list(self.stats):
+                if server not in servers:
+                    del self.stats[server]
+            for server, result in zip(servers, results):
+                self._update_stats(server, result)
+            self._rebuild_ranking()
+        if self.on_update:
+            self.on_update(self.snapshot())
+
+    def probe_server(self, server):
+        """探测单个服务器：测量TCP连接时间、首字节时间和播放列表获取时间（毫秒）"""
+        result = {"ok": False, "connect": None, "ttfb": None, "fetch": None, "error": ""}
+        conn = None
+        try:
+            parsed = urllib.parse.urlparse(self.make_probe_url(server))
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?" + parsed.query
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=self.timeout)
+
+            start = time.perf_counter()
+            conn.connect()
+            connected = time.perf_counter()
+            conn.request("GET", path, headers={"Connection": "close"})
+            response = conn.getresponse()
+            first_byte = time.perf_counter()
+            response.read()
+            finished = time.perf_counter()
+
+            result["connect"] = (connected - start) * 1000
+            result["ttfb"] = (first_byte - connected) * 1000
+            result["fetch"] = (finished - start) * 1000
+            # 重定向也说明节点在正常工作
+            result["ok"] = response.status < 400
+            if not result["ok"]:
+                result["error"] = f"HTTP {response.status}"
+        except Exception as e:
+            result["error"] = str(e) or e.__class__.__name__
+        finally:
+            if conn:
+                conn.close()
+        return result
+
+    def _update_stats(self, server, result):
+        """用一次探测结果更新服务器统计"""
+        stat = self.stats.setdefault(server, {
+            "connect": None, "ttfb": None, "fetch": None,
+            "jitter": None, "failures": 0, "healthy": False, "weight": 0.0, "error": ""
+        })
+        if result["ok"]:
+            # 抖动：获取时间偏离平均值的幅度的加权平均
+            if stat["fetch"] is not None:
+                deviation = abs(result["fetch"] - stat["fetch"])
+                if stat["jitter"] is None:
+                    stat["jitter"] = deviation
+                else:
+                    stat["jitter"] += self.EWMA_ALPHA * (deviation - stat["jitter"])
+            for key in ("connect", "ttfb", "fetch"):
+                if stat[key] is None:
+                    stat[key] = result[key]
+                else:
+                    stat[key] += self.EWMA_ALPHA * (result[key] - stat[key])
+            stat["failures"] = 0
+            stat["healthy"] = True
+            stat["error"] = ""
+        else:
+            stat["failures"] += 1
+            stat["error"] = result["error"]
+            if stat["failures"] >= self.FAIL_THRESHOLD or stat["fetch"] is None:
+                stat["healthy"] = False
+
+    def _rebuild_ranking(self):
+        """按播放列表获取时间重新排序，并按延迟倒数分配权重"""
+        healthy = [s for s, st in self.stats.items() if st["healthy"]]
+        healthy.sort(key=lambda s: self.stats[s]["fetch"])
+        unhealthy = [s for s in self.stats if s not in healthy]
+        total = sum(1.0 / max(self.stats[s]["fetch"], 1.0) for s in healthy)
+        for server, stat in self.stats.items():
+            if stat["healthy"] and total:
+                stat["weight"] = (1.0 / max(stat["fetch"], 1.0)) / total
+            else:
+                stat["weight"] = 0.0
+        self.ranking = healthy + unhealthy
+        self.best = healthy[0] if healthy else None
+
+    def pick(self, exclude=()):
+        """选择最快的可用服务器，没有探测结果时返回None"""
+        best = self.best
+        if best is not None and best not in exclude:
+            return best
+        for server in self.ranking:
+            if server not in exclude and self.stats.get(server, {}).get("healthy"):
+                return server
+        return None
+
+    def stat(self, server):
+        """单个服务器的统计副本，没有探测结果时返回None"""
+        with self._lock:
+            stat = self.stats.get(server)
+            return dict(stat) if stat else None
+
+    def snapshot(self):
+        """返回排名表快照：[(服务器, 统计副本), ...]"""
+        with self._lock:
+            return [(server, dict(self.stats[server])) for server in self.ranking]
+
+class NetworkCachingTuner:
+    """按 服务器×频道 自适应VLC网络缓存（network-caching）
+
+    - 基础值由服务器探测得到的播放列表获取时间和抖动估算：缓存要盖住一次请求往返再加上几倍抖动
+    - 每个 服务器×频道 另有一个缩放系数，按播放会话的卡顿情况在会话之间调整：
+      出现卡顿就放大，足够长且没有卡顿的会话慢慢缩小，收敛到不卡顿的最低延迟
+    - 没有该频道的记录时使用该服务器的系数；组播延迟稳定，使用单独的较小基础值
+    - 系数保存在文件中，重启后继续使用
+    """
+
+    MIN_MS = 80
+    MAX_MS = 5000
+    DEFAULT_MS = 300  # 没有探测结果时的基础值
+    HTTP_MIN_MS = 200  # HTTP拉流的基础值下限
+    MULTICAST_MS = 100
+    MIN_SCALE = 0.5
+    MAX_SCALE = 8.0
+    GROW = 1.5  # 每次卡顿的放大倍数
+    SHRINK = 0.9  # 无卡顿会话的缩小倍数
+    CLEAN_SESSION = 60  # 至少播放多少秒没有卡顿才缩小
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.entries = {}  # "服务器|频道标识"（频道为*表示整台服务器） -> 记录
+        self._lock = threading.Lock()
+        self.load_state()
+
+    @staticmethod
+    def _entry_key(server, key):
+        return f"{server}|{key}"
+
+    def base(self, server, stat=None):
+        """由探测统计估算基础缓存（毫秒）"""
+        if server == "multicast":
+            return self.MULTICAST_MS
+        if not stat or stat.get("fetch") is None:
+            return self.DEFAULT_MS
+        return max(stat["fetch"] * 2 + (stat.get("jitter") or 0.0) * 4, self.HTTP_MIN_MS)
+
+    def scale(self, server, key):
+        """当前缩放系数：频道记录优先，其次服务器记录"""
+        with self._lock:
+            entry = self.entries.get(self._entry_key(server, key)) or self.entries.get(self._entry_key(server, "*"))
+            return entry["scale"] if entry else 1.0
+
+    def value(self, server, key, stat=None):
+        """给该 服务器×频道 使用的network-caching值（毫秒，整数）"""
+        caching = self.base(server, stat) * self.scale(server, key)
+        return int(min(max(caching, self.MIN_MS), self.MAX_MS))
+
+    def record(self, server, key, duration, rebuffers):
+        """记录一次播放会话的结果，调整系数并保存"""
+        if not server or not key:
+            return
+        if rebuffers:
+            factor = self.GROW ** min(rebuffers, 3)
+        elif duration >= self.CLEAN_SESSION:
+            factor = self.SHRINK
+        else:
+            # 很短的会话（换台扫过）不说明问题
+            return
+        with self._lock:
+            for entry_key in (self._entry_key(server, key), self._entry_key(server, "*")):
+                entry = self.entries.setdefault(entry_key, {"scale": 1.0, "sessions": 0, "rebuffers": 0})
+                entry["scale"] = min(max(entry["scale"] * factor, self.MIN_SCALE), self.MAX_SCALE)
+                entry["sessions"] += 1
+                entry["rebuffers"] += rebuffers
+                entry["updated"] = time.time()
+        self.save_state()
+
+    def load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except Exception as e:
+            print(f"读取网络缓存配置失败: {e}")
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            state = json.dumps(self.entries, ensure_ascii=False)
+        try:
+            with open(self.state_file + ".tmp", "w", encoding="utf-8") as f:
+                f.write(state)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        except OSError:
+            pass
+
+class TimeKeeper:
+    """时间同步：并发查询全部NTP服务器，按NTP时钟选择算法选出可信样本，跟踪本地时钟漂移
+
+    - 每个样本的误差上界（根距离）= 往返延迟/2 + 服务器根延迟/2 + 根离散度
+    - 用Marzullo交集算法剔除与多数服务器不一致的样本，其余按误差上界倒数加权平均
+    - 相邻两次同步间隔足够长时估计本地时钟漂移率，两次同步之间按漂移外推偏移
+    - 定时在后台重新同步，最近一次可信偏移保存在文件中，启动时直接使用无需等待NTP
+    - 所有NTP服务器都失败且没有近期NTP结果时，用IPTV服务器HTTP响应的Date头粗略估计偏移（精度约0.5秒）
+    """
+
+    # 同步间隔（秒）；失败后较快重试
+    RESYNC_INTERVAL = 3600
+    RETRY_INTERVAL = 60
+    # 估计漂移所需的最短同步间隔（秒），以及漂移率上限（500ppm，超出视为系统时间被调整）
+    MIN_DRIFT_INTERVAL = 600
+    MAX_DRIFT = 500e-6
+    DRIFT_ALPHA = 0.5
+    # 保存的偏移多久内仍可使用（秒）
+    STATE_MAX_AGE = 7 * 86400
+    # NTP偏移多久以后才改用精度较低的HTTP Date头结果（秒）
+    HTTP_FALLBACK_AGE = 86400
+
+    def __init__(self, get_servers, state_file=None, get_http_urls=None, timeout=2, on_sync=None):
+        self.get_servers = get_servers  # 返回NTP服务器列表的函数
+        self.state_file = state_file
+        self.get_http_urls = get_http_urls  # 返回用于Date头兜底的HTTP地址列表的函数
+        self.timeout = timeout
+        self.on_sync = on_sync  # 每次同步结束后的回调（在同步线程中调用）
+        self.base_offset = 0.0  # 上次同步时测得的偏移（秒）
+        self.base_time = time.monotonic()
+        self.drift = 0.0  # 本地时钟漂移率（秒/秒）
+        self.source = None  # "ntp"、"http" 或 "saved"
+        self.last_sync = None  # 上次成功同步的墙上时间
+        self.samples = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.load_state()
+
+    def offset(self):
+        """当前时钟偏移（秒），按漂移率外推"""
+        with self._lock:
+            return self.base_offset + self.drift * (time.monotonic() - self.base_time)
+
+    def sync_now(self):
+        """立即在后台同步（首次调用时启动定时同步线程）"""
+        if self._thread and self._thread.is_alive():
+            self._wake.set()
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _sync_loop(self):
+        while not self._stop.is_set():
+            try:
+                result = self.sync()
+            except Exception as e:
+                result = {"ok": False, "error": str(e)}
+            self._wake.wait(self.RESYNC_INTERVAL if result["ok"] else self.RETRY_INTERVAL)
+            self._wake.clear()
+
+    def sync(self):
+        """同步一次（阻塞），返回结果字典"""
+        servers = list(dict.fromkeys(self.get_servers()))
+        samples = self.query_ntp(servers) if servers else []
+        survivors = self.select(samples)
+        result = {"ok": False, "source": None, "servers": len(servers), "samples": len(samples),
+                  "survivors": len(survivors), "offset": None, "error": ""}
+        if survivors:
+            weights = [1 / max(sample["distance"], 1e-4) for sample in survivors]
+            offset = sum(w * sample["offset"] for w, sample in zip(weights, survivors)) / sum(weights)
+            best = min(survivors, key=lambda sample: sample["distance"])
+            result.update(ok=True, source="ntp", offset=offset, best=best["server"],
+                          error_bound=best["distance"])
+        else:
+            offset = self.query_http_date() if self._http_fallback_allowed() else None
+            if offset is not None:
+                result.update(ok=True, source="http", offset=offset)
+            else:
+                result["error"] = "所有NTP服务器均不可用" if servers else "没有配置NTP服务器"
+        self.samples = samples
+        if result["ok"]:
+            self._apply(result["offset"], result["source"])
+            result["drift_ppm"] = self.drift * 1e6
+            self.save_state()
+        if self.on_sync:
+            self.on_sync(result)
+        return result
+
+    def query_ntp(self, servers):
+        """并发查询NTP服务器，返回有效样本列表"""
+        def query(server):
+            try:
+                response = ntplib.NTPClient().request(server, version=3, timeout=self.timeout)
+            except Exception:
+                return None
+            # 未同步（闰秒标志3）或层级无效的服务器不可用
+            if response.leap == 3 or not 0 < response.stratum < 16:
+                return None
+            return {
+                "server": server,
+                "offset": response.offset,
+                "delay": response.delay,
+                "stratum": response.stratum,
+                "distance": response.delay / 2 + response.root_delay / 2 + response.root_dispersion,
+            }
+
+        with ThreadPoolExecutor(max_workers=min(len(servers), 8)) as pool:
+            return [sample for sample in pool.map(query, servers) if sample]
+
+    @staticmethod
+    def select(samples):
+        """Marzullo交集算法：返回误差区间能互相重叠的最大一组样本"""
+        if len(samples) <= 2:
+            # 样本太少无法判断多数，取误差最小的一个
+            return sorted(samples, key=lambda sample: sample["distance"])[:1]
+        edges = []
+        for index, sample in enumerate(samples):
+            edges.append((sample["offset"] - sample["distance"], -1, index))
+            edges.append((sample["offset"] + sample["distance"], 1, index))
+        # 同一位置先处理区间起点，保证端点相接的区间算作重叠
+        edges.sort()
+        best = 0
+        best_point = None
+        count = 0
+        for point, kind, _ in edges:
+            count -= kind
+            if count > best:
+                best = count
+                best_point = point
+        if best * 2 <= len(samples):
+            # 没有多数派，退回误差最小的样本
+            return sorted(samples, key=lambda sample: sample["distance"])[:1]
+        return [
+            sample for sample in samples
+            if sample["offset"] - sample["distance"] <= best_point <= sample["offset"] + sample["distance"]
+        ]
+
+    def _http_fallback_allowed(self):
+        """近期有过NTP结果时，外推值比HTTP Date头更准确"""
+        if not self.get_http_urls:
+            return False
+        if self.source in ("ntp", "saved") and time.time() - self.last_sync < self.HTTP_FALLBACK_AGE:
+            return False
+        return True
+
+    def query_http_date(self):
+        """用HTTP响应的Date头估计偏移，返回各服务器结果的中位数（秒），全部失败时返回None"""
+        offsets = []
+        for url in self.get_http_urls()[:4]:
+            parsed = urllib.parse.urlsplit(url)
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=self.timeout)
+            try:
+                sent = time.time()
+                conn.request("HEAD", parsed.path or "/")
+                response = conn.getresponse()
+                received = time.time()
+                date = response.getheader("Date")
+                if not date:
+                    continue
+                # Date只精确到秒，取该秒的中点
+                server_time = email.utils.parsedate_to_datetime(date).timestamp() + 0.5
+                offsets.append(server_time - (sent + received) / 2)
+            except Exception:
+                continue
+            finally:
+                conn.close()
+        if not offsets:
+            return None
+        offsets.sort()
+        return offsets[len(offsets) // 2]
+
+    def _apply(self, offset, source):
+        """采用新的偏移，并用与上次同步的差值更新漂移估计"""
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self.base_time
+            if self.source == "ntp" and source == "ntp" and elapsed >= self.MIN_DRIFT_INTERVAL:
+                measured = (offset - self.base_offset) / elapsed
+                if abs(measured) > self.MAX_DRIFT:
+                    # 期间系统时间被调整过，重新开始估计
+                    self.drift = 0.0
+                else:
+                    self.drift += self.DRIFT_ALPHA * (measured - self.drift)
+            self.base_offset = offset
+            self.base_time = now
+            self.source = source
+            self.last_sync = time.time()
+
+    def load_state(self):
+        """读取保存的偏移和漂移，按经过的时间外推"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            age = time.time() - state["synced_at"]
+            if not 0 <= age <= self.STATE_MAX_AGE:
+                return
+            drift = state.get("drift", 0.0)
+            self.drift = drift if abs(drift) <= self.MAX_DRIFT else 0.0
+            self.base_offset = state["offset"] + self.drift * age
+            self.base_time = time.monotonic()
+            self.source = "saved"
+            self.last_sync = state["synced_at"]
+        except Exception as e:
+            print(f"读取时间同步状态失败: {e}")
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            state = {"offset": self.base_offset, "drift": self.drift, "synced_at": self.last_sync}
+        try:
+            with open(self.state_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        except OSError:
+            pass
+
+    def snapshot(self):
+        """当前同步状态"""
+        return {
+            "offset": self.offset(),
+            "drift_ppm": self.drift * 1e6,
+            "source": self.source,
+            "last_sync": self.last_sync,
+            "samples": list(self.samples),
+        }
+
+class ChannelScanner:
+    """频道体检：把每个频道模板按每台服务器生成播放地址，拉取播放列表和第一个分片
+
+    有界线程池并发执行，每台主机同时最多 per_host 个请求。
+    结果为 频道×服务器 的矩阵，每项包含状态、首字节时间、分片码率和错误信息，
+    可导出为JSON或CSV。组播等非HTTP地址无法通过HTTP检测，标记为skipped。
+    """
+
+    FIELDS = [
+        "channel", "name", "server", "status", "http_status", "ttfb_ms",
+        "playlist_ms", "segment_ms", "segment_bytes", "bitrate_kbps", "url", "error",
+    ]
+
+    def __init__(self, get_session, make_url, max_workers=16, per_host=4, timeout=5):
+        self.get_session = get_session
+        self.make_url = make_url  # (模板, 服务器) -> 播放地址
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.results = []
+        self.elapsed = 0.0
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _slot(self, host):
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return slot
+
+    def _get(self, url):
+        """按主机限流的GET，返回 (响应对象, 首字节耗时毫秒, 总耗时毫秒, 内容)"""
+        with self._slot(urllib.parse.urlsplit(url).netloc):
+            start = time.perf_counter()
+            with self.get_session().get(url, timeout=self.timeout, stream=True) as response:
+                first_byte = time.perf_counter()
+                content = response.content
+            finished = time.perf_counter()
+        return response, (first_byte - start) * 1000, (finished - start) * 1000, content
+
+    def scan(self, channels, servers, progress=None):
+        """检测全部频道（[(标识, 频道)]）和服务器，返回结果列表
+
+        progress(已完成数, 总数) 在每项完成后调用。
+        """
+        self._cancel.clear()
+        jobs = []
+        for key, channel in channels:
+            if "{server}" in channel["url"]:
+                jobs.extend((key, channel, server) for server in (servers or [""]))
+            else:
+                jobs.append((key, channel, ""))
+        started = time.perf_counter()
+        results = []
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(jobs))) as pool:
+                for result in pool.map(lambda job: self.scan_one(*job), jobs):
+                    results.append(result)
+                    if progress:
+                        progress(len(results), len(jobs))
+        self.elapsed = time.perf_counter() - started
+        self.results = results
+        return results
+
+    def scan_one(self, key, channel, server):
+        """检测一个频道在一台服务器上的情况"""
+        result = dict.fromkeys(self.FIELDS, None)
+        result.update(channel=key, name=channel["name"], server=server, status="error", error="")
+        if self._cancel.is_set():
+            result["status"] = "cancelled"
+            return result
+        if "{server}" in channel["url"] and not server:
+            result["error"] = "没有可用的服务器"
+            return result
+        try:
+            url = self.make_url(channel["url"], server)
+            result["url"] = url
+            if urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+                result["status"] = "skipped"
+                return result
+            if ".m3u8" not in url:
+                # 非HLS的HTTP流（如udpxy转发）只检查能否打开
+                response, ttfb = self._open(url)
+                result.update(http_status=response.status_code, ttfb_ms=round(ttfb, 1))
+                result["status"] = "ok" if response.status_code < 400 else "error"
+                if response.status_code >= 400:
+                    result["error"] = f"HTTP {response.status_code}"
+                return result
+
+            response, ttfb, total, content = self._get(url)
+            result.update(http_status=response.status_code, ttfb_ms=round(ttfb, 1), playlist_ms=round(total, 1))
+            if response.status_code >= 400:
+                result["error"] = f"HTTP {response.status_code}"
+                return result
+            playlist = parse_m3u8(content.decode("utf-8", errors="replace"), response.url)
+            if playlist["variants"] and not playlist["segments"]:
+                response, _, _, content = self._get(playlist["variants"][0])
+                playlist = parse_m3u8(content.decode("utf-8", errors="replace"), response.url)
+            if not playlist["segments"]:
+                result["error"] = "播放列表中没有分片"
+                return result
+
+            segment = playlist["segments"][0]
+            response, _, total, content = self._get(segment["uri"])
+            if response.status_code >= 400:
+                result["error"] = f"分片 HTTP {response.status_code}"
+                return result
+            result["segment_ms"] = round(total, 1)
+            result["segment_bytes"] = len(content)
+            if segment["duration"]:
+                result["bitrate_kbps"] = round(len(content) * 8 / segment["duration"] / 1000)
+            result["status"] = "ok"
+        except Exception as e:
+            result["error"] = str(e) or e.__class__.__name__
+        return result
+
+    def _open(self, url):
+        """只读取响应头（用于非HLS的HTTP流），返回 (响应对象, 首字节耗时毫秒)"""
+        with self._slot(urllib.parse.urlsplit(url).netloc):
+            start = time.perf_counter()
+            with self.get_session().get(url, timeout=self.timeout, stream=True) as response:
+                first_byte = time.perf_counter()
+        return response, (first_byte - start) * 1000
+
+    def matrix(self):
+        """按频道汇总：{频道标识: {"name", "servers": {服务器: 状态}}}"""
+        matrix = {}
+        for result in self.results:
+            row = matrix.setdefault(result["channel"], {"name": result["name"], "servers": {}})
+            row["servers"][result["server"]] = result["status"]
+        return matrix
+
+    def summary(self):
+        """统计各状态的数量"""
+        counts = {}
+        for result in self.results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        return counts
+
+    def export(self, path):
+        """按扩展名导出为CSV或JSON"""
+        if path.lower().endswith(".csv"):
+            with open(path, "w", encoding="utf-8-sig", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.results)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "elapsed": round(self.elapsed, 2),
+                    "summary": self.summary(),
+                    "matrix": self.matrix(),
+                    "results": self.results,
+                }, f, ensure_ascii=False, indent=2)
+
+def normalize_channel_url(url):
+    """频道地址模板的规范形式（用于去重）：协议和主机小写，查询参数排序，去掉片段"""
+    parts = urllib.parse.urlsplit(url.strip())
+    query = "&".join(sorted(parts.query.split("&"))) if parts.query else ""
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query, ""))
+
+class ChannelStore:
+    """频道库：用SQLite保存频道，规范化后的地址唯一，频道ID在增删后保持不变
+
+    每次添加都是一个小事务（WAL日志），不再整文件重写；导入重复的地址会被跳过。
+    新建频道库时自动导入旧版的 channel_config.json。
+    """
+
+    def __init__(self, path, legacy_json=None):
+        self.path = path
+        self.lock = threading.Lock()
+        created = not os.path.exists(path)
+        try:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error as e:
+            # 目录不可写等情况下退回内存库，本次运行仍可使用
+            print(f"打开频道库失败，使用内存频道库: {e}")
+            self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS channels ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "name TEXT NOT NULL, "
+                "url TEXT NOT NULL, "
+                "url_key TEXT NOT NULL, "
+                "position INTEGER NOT NULL, "
+                "tvg_id TEXT NOT NULL DEFAULT '', "
+                "group_title TEXT NOT NULL DEFAULT '')"
+            )
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS channels_url_key ON channels (url_key)")
+            # 旧版频道库补充M3U属性列
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(channels)")}
+            for column in ("tvg_id", "group_title"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE channels ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        if created and legacy_json and os.path.exists(legacy_json):
+            self._migrate(legacy_json)
+
+    def _migrate(self, legacy_json):
+        try:
+            with open(legacy_json, "r", encoding="utf-8") as f:
+                channels = json.load(f)
+        except Exception as e:
+            print(f"读取旧频道配置失败: {e}")
+            return
+        added = self.add_many(channels)
+        print(f"已从 {legacy_json} 导入 {len(added)} 个频道")
+
+    def load(self):
+        """按列表顺序返回全部频道"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, name, url, tvg_id, group_title FROM channels ORDER BY position, id"
+            ).fetchall()
+        return [
+            {"id": channel_id, "name": name, "url": url, "tvg_id": tvg_id, "group": group}
+            for channel_id, name, url, tvg_id, group in rows
+        ]
+
+    def add_many(self, channels):
+        """在一个事务中添加频道（可迭代的 {"name", "url"[, "tvg_id", "group"]}），返回实际新增的频道（含ID）
+
+        地址规范化后已存在（或同一批次内重复）的频道被跳过。
+        """
+        added = []
+        with self.lock, self.conn:
+            position = self.conn.execute("SELECT COALESCE(MAX(position), -1) FROM channels").fetchone()[0]
+            for channel in channels:
+                name = channel["name"]
+                url = channel["url"]
+                tvg_id = channel.get("tvg_id", "")
+                group = channel.get("group", "")
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO channels (name, url, url_key, position, tvg_id, group_title) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, url, normalize_channel_url(url), position + 1, tvg_id, group)
+                )
+                if cursor.rowcount:
+                    position += 1
+                    added.append({"id": cursor.lastrowid, "name": name, "url": url, "tvg_id": tvg_id, "group": group})
+        return added
+
+    def add(self, name, url):
+        """添加一个频道，地址重复时返回None"""
+        added = self.add_many([{"name": name, "url": url}])
+        return added[0] if added else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# 导入时把具体服务器地址和时间戳替换为占位符
+SERVER_HOST_RE = re.compile(r"http://[^/]+")
+STARTTIME_RE = re.compile(r"starttime=\d{8}T\d{6}\.\d{2}Z")
+
+def convert_channel_url(original_url):
+    """将URL中的服务器地址和时间戳替换为占位符"""
+    converted_url = SERVER_HOST_RE.sub("http://{server}", original_url, count=1)
+    if "starttime=" in converted_url:
+        converted_url = STARTTIME_RE.sub("starttime={timestamp}", converted_url)
+    return converted_url
+
+# starttime参数的时间格式（UTC），如 20250705T142312.00Z
+STARTTIME_FORMAT = "%Y%m%dT%H%M%S.00Z"
+PLACEHOLDER_RE = re.compile(r"(\{server\}|\{timestamp\})")
+
+class PlayURLTemplate:
+    """预编译的播放地址模板：{server}/{timestamp} 占位符只解析一次，生成地址只需一次 str.format"""
+
+    __slots__ = ("template", "has_server", "has_timestamp", "_parts", "_format")
+
+    def __init__(self, template):
+        self.template = template
+        self.has_server = "{server}" in template
+        self.has_timestamp = "{timestamp}" in template
+        self._parts = PLACEHOLDER_RE.split(template)
+        # 占位符换成位置参数，其余花括号转义
+        fields = {"{server}": "{0}", "{timestamp}": "{1}"}
+        self._format = "".join(
+            fields.get(part) or part.replace("{", "{{").replace("}", "}}")
+            for part in self._parts
+        )
+
+    def render(self, server, timestamp):
+        return self._format.format(server, timestamp)
+
+    def pieces(self, server):
+        """代入服务器后按 {timestamp} 切开的固定文本（时间戳数 + 1 段）"""
+        pieces = [""]
+        for part in self._parts:
+            if part == "{timestamp}":
+                pieces.append("")
+            else:
+                pieces[-1] += (server or "") if part == "{server}" else part
+        return pieces
+
+_COMPILED_TEMPLATES = {}
+
+def compile_play_template(template):
+    """取得模板的预编译对象（按模板字符串缓存）"""
+    compiled = _COMPILED_TEMPLATES.get(template)
+    if compiled is None:
+        if len(_COMPILED_TEMPLATES) > 65536:
+            _COMPILED_TEMPLATES.clear()
+        compiled = _COMPILED_TEMPLATES[template] = PlayURLTemplate(template)
+    return compiled
+
+# M3U的 #EXTINF 属性，如 tvg-id="hunanws" group-title="卫视"
+M3U_ATTR_RE = re.compile(r'([\w-]+)="([^"]*)"')
+
+class PlaylistImporter:
+    """流式解析频道列表文件，逐个产生 {"name", "url", "tvg_id", "group"}
+
+    支持的格式：
+      m3u  扩展M3U（#EXTINF 的 tvg-id、group-title 属性和 #EXTGRP 分组）
+      txt  “频道名<Tab>播放地址”（湖南电信导出格式）或“频道名,播放地址”，“分组,#genre#”行设置分组
+      csv  带表头（name/url/tvg-id/group-title 或 频道名称/播放地址/分组）或前两列为名称和地址
+    按行读取，不把整个文件载入内存；bytes_read/total_bytes 可用于显示进度。
+    convert 用于把IPTV地址转换为占位符模板：制表符分隔的TXT（IPTV导出）全部转换，
+    其他格式多为公开列表，只转换带starttime时间戳的地址。
+    """
+
+    CSV_COLUMNS = {
+        "name": ("name", "频道名称", "频道名", "频道", "tvg-name", "title"),
+        "url": ("url", "播放地址", "地址", "link", "stream"),
+        "tvg_id": ("tvg-id", "tvg_id", "id", "频道id"),
+        "group": ("group-title", "group", "分组", "category"),
+    }
+
+    def __init__(self, path, fmt=None, convert=None):
+        self.path = path
+        self.convert = convert
+        self.total_bytes = os.path.getsize(path)
+        self.bytes_read = 0
+        self.format = fmt or self.detect_format(path)
+
+    @staticmethod
+    def detect_format(path):
+        """按扩展名和文件开头判断格式"""
+        extension = os.path.splitext(path)[1].lower()
+        if extension in (".m3u", ".m3u8"):
+            return "m3u"
+        with open(path, "rb") as f:
+            head = f.read(4096).decode("utf-8", errors="replace").lstrip("\ufeff").lstrip()
+        if head.startswith("#EXTM3U") or head.startswith("#EXTINF"):
+            return "m3u"
+        if extension == ".csv":
+            return "csv"
+        return "txt"
+
+    def lines(self):
+        """逐行读取文件（去掉换行符和BOM），同时累计已读字节数"""
+        with open(self.path, "rb") as f:
+            first = True
+            for raw in f:
+                self.bytes_read += len(raw)
+                line = raw.decode("utf-8", errors="replace")
+                if first:
+                    line = line.lstrip("\ufeff")
+                    first = False
+                yield line.rstrip("\r\n")
+
+    def _template(self, url, exported=False):
+        if self.convert and (exported or ("starttime=" in url and STARTTIME_RE.search(url))):
+            return self.convert(url)
+        return url
+
+    def __iter__(self):
+        if self.format == "m3u":
+            return self._parse_m3u()
+        if self.format == "csv":
+            return self._parse_csv()
+        return self._parse_txt()
+
+    def _parse_m3u(self):
+        info = None
+        group = ""
+        for line in self.lines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#EXTINF"):
+                attrs = dict(M3U_ATTR_RE.findall(line))
+                # 标题是属性之后第一个逗号后的内容
+                rest = M3U_ATTR_RE.sub("", line)
+                title = rest.split(",", 1)[1].strip() if "," in rest else ""
+                info = {
+                    "name": title or attrs.get("tvg-name", ""),
+                    "tvg_id": attrs.get("tvg-id", ""),
+                    "group": attrs.get("group-title", ""),
+                }
+            elif line.startswith("#EXTGRP:"):
+                group = line[len("#EXTGRP:"):].strip()
+            elif not line.startswith("#"):
+                info = info or {"name": "", "tvg_id": "", "group": ""}
+                yield {
+                    "name": info["name"] or line,
+                    "url": self._template(line),
+                    "tvg_id": info["tvg_id"],
+                    "group": info["group"] or group,
+                }
+                info = None
+
+    def _parse_txt(self):
+        group = ""
+        for line in self.lines():
+            line = line.strip()
+            if not line:
+                continue
+            exported = "\t" in line
+            if exported:
+                name, url = line.split("\t", 1)
+            elif "," in line:
+                name, url = line.split(",", 1)
+                if url.strip() == "#genre#":
+                    group = name.strip()
+                    continue
+            else:
+                continue
+            url = url.strip()
+            # 没有协议的行（如标题行“频道名称\t播放地址”）跳过
+            if "://" not in url:
+                continue
+            yield {"name": name.strip(), "url": self._template(url, exported), "tvg_id": "", "group": group}
+
+    def _parse_csv(self):
+        reader = csv.reader(self.lines())
+        columns = {"name": 0, "url": 1}
+        for row in reader:
+            if not row:
+                continue
+            if reader.line_num == 1:
+                header = [cell.strip().lower() for cell in row]
+                mapped = {}
+                for field, names in self.CSV_COLUMNS.items():
+                    for position, cell in enumerate(header):
+                        if cell in names:
+                            mapped[field] = position
+                            break
+                if "url" in mapped:
+                    columns = mapped
+                    continue
+            cells = {}
+            for field, position in columns.items():
+                cells[field] = row[position].strip() if position < len(row) else ""
+            url = cells["url"]
+            if "://" not in url:
+                continue
+            yield {
+                "name": cells.get("name") or url,
+                "url": self._template(url),
+                "tvg_id": cells.get("tvg_id", ""),
+                "group": cells.get("group", ""),
+            }
+
+    def batches(self, size=2000):
+        """按批产生频道列表"""
+        batch = []
+        for channel in self:
+            batch.append(channel)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+# 频道ID：播放地址中的12位数字路径段，如 /000000002000/201500000067/1000.m3u8 中的 201500000067
+CHANNEL_ID_RE = re.compile(r"/(\d{12})/(?=[^/]*$)")
+
+# GB2312一级汉字按拼音排序，以下为各声母首字的编码，用于在没有pypinyin时求拼音首字母
+_PINYIN_INITIAL_BOUNDARIES = [
+    (0xB0A1, "a"), (0xB0C5, "b"), (0xB2C1, "c"), (0xB4EE, "d"), (0xB6EA, "e"),
+    (0xB7A2, "f"), (0xB8C1, "g"), (0xB9FE, "h"), (0xBBF7, "j"), (0xBFA6, "k"),
+    (0xC0AC, "l"), (0xC2E8, "m"), (0xC4C3, "n"), (0xC5B6, "o"), (0xC5BE, "p"),
+    (0xC6DA, "q"), (0xC8BB, "r"), (0xC8F6, "s"), (0xCBFA, "t"), (0xCDDA, "w"),
+    (0xCEF4, "x"), (0xD1B9, "y"), (0xD4D1, "z"),
+]
+_pinyin_initial_cache = {}
+
+def pinyin_initial(char):
+    """求单个汉字的拼音首字母，非汉字原样返回小写，无法识别的汉字返回空串"""
+    cached = _pinyin_initial_cache.get(char)
+    if cached is not None:
+        return cached
+    initial = char.lower()
+    if "\u4e00" <= char <= "\u9fff":
+        initial = ""
+        try:
+            encoded = char.encode("gb2312")
+            code = (encoded[0] << 8) | encoded[1]
+            if 0xB0A1 <= code <= 0xD7F9:
+                for boundary, letter in reversed(_PINYIN_INITIAL_BOUNDARIES):
+                    if code >= boundary:
+                        initial = letter
+                        break
+        except UnicodeEncodeError:
+            pass
+    _pinyin_initial_cache[char] = initial
+    return initial
+
+class ChannelSearchIndex:
+    """频道搜索索引：匹配频道名称、拼音（首字母/全拼）和频道ID
+
+    名称或任一字段以查询开头的结果排在前面，其余子串匹配的结果在后。
+    新查询是上一次查询的延伸时只在上一次的结果中过滤（逐字输入时越输越快）。
+    安装了pypinyin时额外索引全拼，否则只用GB2312编码表求首字母。
+    """
+
+    SEPARATOR = "\x00"
+
+    def __init__(self):
+        self.keys = []  # 频道索引 -> 小写的检索文本（各字段以SEPARATOR分隔）
+        self._pinyin = None  # pypinyin.lazy_pinyin，未安装时为False
+        self._last_query = None
+        self._last_matches = None
+
+    def _full_pinyin(self, name):
+        if self._pinyin is None:
+            try:
+                from pypinyin import lazy_pinyin
+                self._pinyin = lazy_pinyin
+            except ImportError:
+                self._pinyin = False
+        if not self._pinyin:
+            return "", ""
+        syllables = self._pinyin(name)
+        return "".join(syllables).lower(), "".join(s[:1] for s in syllables).lower()
+
+    def _make_key(self, channel):
+        name = channel["name"].lower()
+        full, initials = self._full_pinyin(channel["name"])
+        if not initials:
+            initials = "".join(pinyin_initial(char) for char in channel["name"] if not char.isspace())
+        match = CHANNEL_ID_RE.search(channel["url"])
+        channel_id = match.group(1) if match else ""
+        fields = [name.replace(" ", ""), initials, full, channel_id]
+        return self.SEPARATOR.join(field for field in fields if field)
+
+    def rebuild(self, channels):
+        """按频道列表重建索引"""
+        self.keys = [self._make_key(channel) for channel in channels]
+        self._last_query = None
+        self._last_matches = None
+
+    def add(self, channel):
+        """追加一个频道"""
+        self.keys.append(self._make_key(channel))
+        self._last_query = None
+        self._last_matches = None
+
+    def search(self, query):
+        """返回匹配的频道索引列表，空查询返回全部"""
+        query = query.strip().lower().replace(" ", "")
+        if not query:
+            self._last_query = None
+            self._last_matches = None
+            return list(range(len(self.keys)))
+        keys = self.keys
+        if self._last_query and query.startswith(self._last_query):
+            candidates = self._last_matches
+        else:
+            candidates = range(len(keys))
+        matches = [i for i in candidates if query in keys[i]]
+        self._last_query = query
+        self._last_matches = matches
+
+        prefix = self.SEPARATOR + query
+        head = []
+        tail = []
+        for i in matches:
+            key = keys[i]
+            if key.startswith(query) or prefix in key:
+                head.append(i)
+            else:
+                tail.append(i)
+        return head + tail
+
+_XMLTV_DAY_CACHE = {}  # "日期+时区" -> 当天0点的Unix时间戳
+
+def parse_xmltv_time(text):
+    """解析XMLTV时间（如 20250705143000 +0800），返回Unix时间戳；没有时区时按UTC，格式错误返回None"""
+    text = text.strip()
+    day_key = text[:8] + text[14:]
+    try:
+        base = _XMLTV_DAY_CACHE.get(day_key)
+        if base is None:
+            base = calendar.timegm((int(text[0:4]), int(text[4:6]), int(text[6:8]), 0, 0, 0, 0, 0, 0))
+            zone = text[14:].strip()
+            if len(zone) == 5 and zone[0] in "+-":
+                shift = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+                base += -shift if zone[0] == "+" else shift
+            if len(_XMLTV_DAY_CACHE) > 4096:
+                _XMLTV_DAY_CACHE.clear()
+            _XMLTV_DAY_CACHE[day_key] = base
+        return base + int(text[8:10] or 0) * 3600 + int(text[10:12] or 0) * 60 + int(text[12:14] or 0)
+    except ValueError:
+        return None
+
+class EPGGuide:
+    """节目单：流式解析XMLTV文件，按频道建立时间区间索引
+
+    - 用iterparse逐个处理 <channel>/<programme> 元素，处理完立即清空，内存占用与文件大小无关
+    - 每个频道的节目按开始时间排序保存为三个并列数组（开始、结束、标题），
+      查询某时刻的节目只需一次二分查找
+    - 已结束超过 KEEP_PAST 秒的节目不保存
+    """
+
+    KEEP_PAST = 6 * 3600
+    PROGRESS_EVERY = 10000
+
+    def __init__(self):
+        self.programs = {}  # EPG频道ID -> (开始时间列表, 结束时间列表, 标题列表)
+        self.names = {}  # 显示名称（小写去空格） -> EPG频道ID
+        self.count = 0
+        self.source = None
+        self.loaded_at = None
+
+    @staticmethod
+    def normalize_name(name):
+        return "".join(name.split()).lower()
+
+    def load(self, path, progress=None):
+        """解析XMLTV文件（支持.gz），完成后替换当前索引，返回节目数
+
+        progress(已解析节目数) 每解析 PROGRESS_EVERY 个节目调用一次。
+        """
+        cutoff = time.time() - self.KEEP_PAST
+        pending = {}  # EPG频道ID -> [(开始, 结束, 标题), ...]
+        names = {}
+        count = 0
+        opener = gzip.open if path.lower().endswith(".gz") else open
+        with opener(path, "rb") as f:
+            context = ElementTree.iterparse(f, events=("start", "end"))
+            _, root = next(context)
+            for event, element in context:
+                if event != "end":
+                    continue
+                if element.tag == "programme":
+                    start = parse_xmltv_time(element.get("start", ""))
+                    stop = parse_xmltv_time(element.get("stop", ""))
+                    if start is not None and (stop is None or stop >= cutoff):
+                        title = (element.findtext("title") or "").strip()
+                        pending.setdefault(element.get("channel", ""), []).append((start, stop, title))
+                        count += 1
+                        if progress and count % self.PROGRESS_EVERY == 0:
+                            progress(count)
+                    root.clear()
+                elif element.tag == "channel":
+                    channel_id = element.get("id", "")
+                    for name in element.iter("display-name"):
+                        if name.text:
+                            names.setdefault(self.normalize_name(name.text), channel_id)
+                    root.clear()
+
+        programs = {}
+        for channel_id, items in pending.items():
+            items.sort(key=lambda item: item[0])
+            starts = [item[0] for item in items]
+            # 没有结束时间的节目到下一个节目开始时结束
+            stops = [
+                item[1] if item[1] is not None else (starts[i + 1] if i + 1 < len(starts) else item[0] + 3600)
+                for i, item in enumerate(items)
+            ]
+            programs[channel_id] = (starts, stops, [item[2] for item in items])
+        self.programs = programs
+        self.names = names
+        self.count = count
+        self.source = path
+        self.loaded_at = time.time()
+        return count
+
+    def resolve(self, channel):
+        """频道在节目单中的ID：依次尝试 tvg-id、播放地址中的12位频道ID、频道名称"""
+        tvg_id = channel.get("tvg_id")
+        if tvg_id and tvg_id in self.programs:
+            return tvg_id
+        match = CHANNEL_ID_RE.search(channel["url"])
+        if match and match.group(1) in self.programs:
+            return match.group(1)
+        return self.names.get(self.normalize_name(channel["name"]))
+
+    def now_next(self, epg_id, at=None):
+        """返回 (当前节目, 下一个节目)，每项为 {"start", "stop", "title"} 或None"""
+        entry = self.programs.get(epg_id)
+        if not entry:
+            return None, None
+        if at is None:
+            at = time.time()
+        starts, stops, titles = entry
+        i = bisect.bisect_right(starts, at) - 1
+        current = None
+        if i >= 0 and stops[i] > at:
+            current = {"start": starts[i], "stop": stops[i], "title": titles[i]}
+        following = None
+        if i + 1 < len(starts):
+            following = {"start": starts[i + 1], "stop": stops[i + 1], "title": titles[i + 1]}
+        return current, following
+
+class VirtualChannelList:
+    """虚拟化频道列表：Treeview中只保留可见行数的条目，滚动时改写条目内容
+
+    rows 为当前显示的频道索引（经过搜索过滤），get_values(频道索引) 返回各列的值，
+    on_select(频道索引或None) 在选中项变化时调用。
+    """
+
+    ROW_HEIGHT = 20
+    HEADING_HEIGHT = 24
+
+    def __init__(self, parent, columns, get_values, on_select):
+        self.get_values = get_values
+        self.on_select = on_select
+        self.rows = []
+        self.offset = 0
+        self.selected = None  # 选中的频道索引
+        self._items = []  # 复用的Treeview条目
+
+        self.tree = ttk.Treeview(
+            parent,
+            columns=[column for column, _, _, _ in columns],
+            show="headings",
+            selectmode="none",
+            height=15
+        )
+        for column, heading, width, anchor in columns:
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, anchor=anchor)
+        self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(fill=tk.BOTH, expand=True)
+
+        style_height = ttk.Style().lookup("Treeview", "rowheight")
+        if style_height:
+            self.ROW_HEIGHT = int(style_height)
+
+        self.tree.bind("<Configure>", self._on_resize)
+        self.tree.bind("<Button-1>", self._on_click)
+        self.tree.bind("<MouseWheel>", lambda event: self.scroll(-1 if event.delta > 0 else 1, "units"))
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-1, "units"))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(1, "units"))
+        self.tree.bind("<Up>", lambda event: self.move_selection(-1))
+        self.tree.bind("<Down>", lambda event: self.move_selection(1))
+        self.tree.bind("<Prior>", lambda event: self.move_selection(-self.visible_count))
+        self.tree.bind("<Next>", lambda event: self.move_selection(self.visible_count))
+        self.tree.bind("<Home>", lambda event: self.move_selection(-len(self.rows)))
+        self.tree.bind("<End>", lambda event: self.move_selection(len(self.rows)))
+
+    @property
+    def visible_count(self):
+        return max(len(self._items), 1)
+
+    def set_rows(self, rows):
+        """更换显示的频道索引列表，尽量保持选中项可见"""
+        self.rows = rows
+        self.offset = 0
+        if self.selected is not None:
+            self.see(self.selected)
+        self.render()
+
+    def _on_resize(self, event):
+        count = max((event.height - self.HEADING_HEIGHT) // self.ROW_HEIGHT, 1)
+        while len(self._items) < count:
+            self._items.append(self.tree.insert("", "end", values=()))
+        while len(self._items) > count:
+            self.tree.delete(self._items.pop())
+        self.render()
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.offset = int(float(amount) * len(self.rows))
+            self.render()
+        else:
+            self.scroll(int(amount), unit)
+
+    def scroll(self, amount, unit="units"):
+        """按行或按页滚动"""
+        step = self.visible_count if unit == "pages" else 3
+        self.offset += amount * step
+        self.render()
+        return "break"
+
+    def see(self, index):
+        """滚动使指定频道可见"""
+        try:
+            position = self.rows.index(index)
+        except ValueError:
+            return
+        if position < self.offset:
+            self.offset = position
+        elif position >= self.offset + self.visible_count:
+            self.offset = position - self.visible_count + 1
+
+    def select(self, index, notify=True):
+        """选中指定频道（None表示取消选中）"""
+        self.selected = index
+        if index is not None:
+            self.see(index)
+        self.render()
+        if notify:
+            self.on_select(index)
+
+    def move_selection(self, step):
+        """在当前显示的列表中上下移动选中项"""
+        if not self.rows:
+            return "break"
+        try:
+            position = self.rows.index(self.selected) + step
+        except ValueError:
+            position = 0 if step > 0 else len(self.rows) - 1
+        position = min(max(position, 0), len(self.rows) - 1)
+        self.select(self.rows[position])
+        return "break"
+
+    def _on_click(self, event):
+        item = self.tree.identify_row(event.y)
+        if item in self._items:
+            position = self.offset + self._items.index(item)
+            if position < len(self.rows):
+                self.select(self.rows[position])
+        self.tree.focus_set()
+        return "break"
+
+    def render(self):
+        """把当前窗口内的频道写入复用的条目"""
+        total = len(self.rows)
+        visible = self.visible_count
+        self.offset = max(0, min(self.offset, total - visible))
+        selected_item = None
+        for i, item in enumerate(self._items):
+            position = self.offset + i
+            if position < total:
+                index = self.rows[position]
+                self.tree.item(item, values=self.get_values(index))
+                if index == self.selected:
+                    selected_item = item
+            else:
+                self.tree.item(item, values=())
+        if selected_item:
+            self.tree.selection_set(selected_item)
+        else:
+            self.tree.selection_set(())
+        if total:
+            self.scrollbar.set(self.offset / total, min((self.offset + visible) / total, 1.0))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+class UIDispatcher:
+    """界面更新调度器：后台线程把界面操作投递到队列，主循环按固定节拍统一执行
+
+    - call(func, *args)：必须执行的操作（如导入完成提示）
+    - update(key, func, *args)：可合并的刷新（如状态栏、测速排名），同一key尚未执行时
+      只保留最新一次，被覆盖的计入merged
+    全部操作按投递顺序执行（合并后的刷新不会越过其后投递的call）。队列超过上限时
+    丢弃最旧的刷新（不丢弃call），计入dropped；latency为投递到执行的延迟。
+    """
+
+    TICK_MS = 50
+    MAX_PENDING = 1000
+    # 每个节拍最多执行的操作数，其余留到下一个节拍，避免长时间占用主循环
+    MAX_PER_TICK = 200
 
-class IPTVPlayer:
     def __init__(self, root):
         self.root = root
-        self.root.title("Windows IPTV播放器 - 专业全屏版")
-        self.root.geometry("1000x700")
-        self.root.configure(bg="#f0f0f0")
+        self._lock = threading.Lock()
+        self._queue = OrderedDict()  # key -> (投递时刻, 函数, 参数)；call使用 ("call", 序号) 作为key
+        self._updates = 0  # 队列中的刷新数
+        self._sequence = 0
+        self._last_call = 0  # 最近一次call的序号
+        self._positions = {}  # 刷新key -> 入队时的序号
+        self.stats = {"posted": 0, "executed": 0, "merged": 0, "dropped": 0, "errors": 0,
+                      "latency_ms": 0.0, "max_latency_ms": 0.0}
+        self._job = None
+
+    def start(self):
+        if self._job is None:
+            self._job = self.root.after(self.TICK_MS, self._drain)
+
+    def stop(self):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+    def call(self, func, *args):
+        """投递一个必须执行的操作（任意线程）"""
+        with self._lock:
+            self.stats["posted"] += 1
+            self._sequence += 1
+            self._last_call = self._sequence
+            self._queue[("call", self._sequence)] = (time.perf_counter(), func, args)
+
+    def update(self, key, func, *args):
+        """投递一个可合并的刷新（任意线程），同一key只保留最新一次"""
+        with self._lock:
+            self.stats["posted"] += 1
+            self._sequence += 1
+            pending = self._queue.get(key)
+            if pending is not None:
+                self.stats["merged"] += 1
+                if self._positions[key] > self._last_call:
+                    # 之后没有call，原位替换，保留最早的投递时刻
+                    self._queue[key] = (pending[0], func, args)
+                    return
+                # 之后有call：移到队尾，保证在那些call之后执行
+                del self._queue[key]
+                self._updates -= 1
+            if self._updates >= self.MAX_PENDING:
+                for old_key in self._queue:
+                    if old_key in self._positions:
+                        del self._queue[old_key]
+                        del self._positions[old_key]
+                        self._updates -= 1
+                        self.stats["dropped"] += 1
+                        break
+            self._queue[key] = (pending[0] if pending else time.perf_counter(), func, args)
+            self._positions[key] = self._sequence
+            self._updates += 1
+
+    def _drain(self):
+        """主循环节拍：按顺序执行队列中的操作"""
+        batch = []
+        with self._lock:
+            while self._queue and len(batch) < self.MAX_PER_TICK:
+                key, item = self._queue.popitem(last=False)
+                if key in self._positions:
+                    del self._positions[key]
+                    self._updates -= 1
+                batch.append(item)
+        now = time.perf_counter()
+        for posted, func, args in batch:
+            latency = (now - posted) * 1000
+            self.stats["latency_ms"] += 0.1 * (latency - self.stats["latency_ms"])
+            self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency)
+            try:
+                func(*args)
+                self.stats["executed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"界面更新出错: {e}")
+        self._job = self.root.after(self.TICK_MS, self._drain)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._queue)
+        return stats
+
+class ChannelZapper:
+    """快速换台引擎：在隐藏的静音VLC播放器中预先播放当前频道上下相邻的频道
+
+    每个预热播放器有自己的画布，与主画布叠放在同一位置；换台时只需把对应画布提到最上层
+    并取消静音，解码器和缓冲都不用重建。预热路数受带宽预算限制，
+    预算不足以预热的相邻频道只预先解析播放地址（直播边缘等）。
+    """
+
+    # 没有实测码率时假定的单路码率（kbps，按高清频道估计）
+    DEFAULT_BITRATE_KBPS = 8000
+    # 起播后多久再开始预热（毫秒），避免与主画面抢带宽
+    WARM_DELAY_MS = 1500
+
+    def __init__(self, app, budget_kbps=16000):
+        self.app = app
+        self.budget_kbps = budget_kbps
+        self.enabled = False
+        self.warm = {}  # 频道标识 -> 预热槽位
+        self.pending = set()  # 正在后台解析地址、尚未起播的频道标识
+        self.bitrates = {}  # 频道标识 -> 实测码率（kbps）
+        self._pool = []  # 空闲槽位（复用播放器和画布）
+        self._refresh_job = None
+
+    def _new_slot(self):
+        """创建一个空闲槽位：独立的VLC播放器和叠放在主画布下面的画布"""
+        canvas = self.app.create_video_canvas()
+        tk.Misc.lower(canvas, self.app.canvas)
+        player = self.app.ensure_vlc().media_player_new()
+        self.app.attach_video_output(player, canvas)
+        return {"key": None, "player": player, "canvas": canvas, "media": None}
+
+    def bitrate(self, key):
+        return self.bitrates.get(key, self.DEFAULT_BITRATE_KBPS)
+
+    def sample_bitrate(self, key, media):
+        """从VLC统计中采样码率"""
+        if media is None:
+            return
+        try:
+            stats = vlc.MediaStats()
+            if media.get_stats(stats) and stats.demux_bitrate > 0:
+                # VLC的码率单位为 字节/微秒 的千分之一，换算为kbps
+                self.bitrates[key] = stats.demux_bitrate * 8000
+        except Exception:
+            pass
+
+    def take(self, key):
+        """取出已预热好的频道槽位，没有时返回None"""
+        if not self.enabled:
+            return None
+        return self.warm.pop(key, None)
+
+    def activate(self, slot):
+        """把预热槽位切换为主画面：提到最上层并取消静音，原主画面降为预热"""
+        app = self.app
+        old = {"key": app.current_channel_key, "player": app.media_player, "canvas": app.canvas, "media": app.current_media}
+        # Canvas的lift/lower作用于画布内元素，窗口叠放需调用Misc上的方法
+        tk.Misc.tkraise(slot["canvas"])
+        slot["player"].audio_set_mute(False)
+        app.media_player = slot["player"]
+        app.canvas = slot["canvas"]
+        app.current_media = slot["media"]
+        if app.is_playing and old["key"]:
+            old["player"].audio_set_mute(True)
+            self.warm[old["key"]] = old
+        else:
+            self._release(old)
+
+    def schedule_refresh(self):
+        """起播后延迟刷新预热频道"""
+        if self._refresh_job:
+            self.app.root.after_cancel(self._refresh_job)
+        self._refresh_job = self.app.root.after(self.WARM_DELAY_MS, self.refresh)
+
+    def refresh(self):
+        """按当前频道的相邻频道和带宽预算调整预热播放器"""
+        self._refresh_job = None
+        app = self.app
+        if not self.enabled or not app.is_playing or app.mosaic is not None:
+            # 多画面打开时解码器留给多画面
+            self.clear()
+            return
+        current = app.current_channel_key
+        self.sample_bitrate(current, app.current_media)
+
+        # 在预算内选择要预热的相邻频道（主画面本身也占用预算）
+        remaining = self.budget_kbps - self.bitrate(current)
+        desired = []
+        resolve_only = []
+        for key in app.neighbor_channel_keys(current):
+            if key == current or key in desired:
+                continue
+            if self.bitrate(key) <= remaining:
+                desired.append(key)
+                remaining -= self.bitrate(key)
+            else:
+                resolve_only.append(key)
+
+        for key in list(self.warm):
+            if key not in desired:
+                self._release(self.warm.pop(key))
+        self.pending &= set(desired)
+
+        for key in desired:
+            if key in self.warm or key in self.pending:
+                continue
+            channel = app.channel_by_key(key)
+            if channel is None:
+                continue
+            if app.needs_live_edge_measure(channel["url"], key):
+                self.pending.add(key)
+                threading.Thread(target=self._resolve_thread, args=(key, channel["url"], True), daemon=True).start()
+            else:
+                self._start(key, app.build_play_url(channel["url"], key))
+
+        for key in resolve_only:
+            channel = app.channel_by_key(key)
+            if channel is not None and app.needs_live_edge_measure(channel["url"], key):
+                threading.Thread(target=self._resolve_thread, args=(key, channel["url"], False), daemon=True).start()
+
+    def _resolve_thread(self, key, template_url, start):
+        """后台解析播放地址（测量直播边缘），需要时回到UI线程起播"""
+        play_url = self.app.resolve_play_url(template_url, key)
+        if start:
+            self.app.ui.call(self._start_pending, key, play_url)
+
+    def _start_pending(self, key, play_url):
+        if key in self.pending:
+            self.pending.discard(key)
+            self._start(key, play_url)
+
+    def _start(self, key, play_url):
+        """在空闲槽位中静音起播"""
+        slot = self._pool.pop() if self._pool else self._new_slot()
+        slot["key"] = key
+        slot["media"] = self.app.create_media(play_url, key)
+        tk.Misc.lower(slot["canvas"], self.app.canvas)
+        slot["player"].set_media(slot["media"])
+        slot["player"].audio_set_mute(True)
+        if slot["player"].play() == -1:
+            self._release(slot)
+            return
+        self.warm[key] = slot
+        
+        def mute_again():
+            # 音频输出建立后再静音一次，部分平台起播前设置的静音不生效
+            if self.warm.get(key) is slot:
+                slot["player"].audio_set_mute(True)
+        
+        self.app.root.after(500, mute_again)
+
+    def _release(self, slot):
+        """停止槽位中的播放并放回空闲池"""
+        slot["player"].stop()
+        slot["key"] = None
+        slot["media"] = None
+        tk.Misc.lower(slot["canvas"], self.app.canvas)
+        self._pool.append(slot)
+
+    def clear(self):
+        """停止全部预热播放"""
+        self.pending.clear()
+        for key in list(self.warm):
+            self._release(self.warm.pop(key))
+
+class MosaicScheduler:
+    """多画面解码调度：在解码路数和总带宽预算内决定每个画面的解码级别
+
+    级别：full（焦点画面，完整解码并出声音）、reduced（跳过B帧，降低帧率）、
+    keyframe（只解关键帧）、off（不解码，只显示频道名）。
+    焦点画面总是完整解码；其余画面按来源排序（组播直连 > 本地中继 > 直接拉上游）依次分配，
+    超出解码路数或带宽预算的画面不解码。解码路数超过 REDUCED_MAX_DECODERS 时，
+    非焦点画面只解关键帧，CPU占用随画面数近似不变。
+    码率估计每次调度都会变化，为避免画面反复重启：已在解码的画面可超出预算 HYSTERESIS 比例仍保留，
+    同等来源下优先保留已在解码的画面；只解关键帧的状态要等解码路数降到门限以下一路才恢复。
+    """
+
+    SOURCE_RANK = {"multicast": 0, "relay": 1, "direct": 2}
+    REDUCED_MAX_DECODERS = 4
+    HYSTERESIS = 0.15
+    # 各级别追加的VLC媒体选项（avcodec-skip-frame：1跳过B帧，3只解关键帧）
+    LEVEL_OPTIONS = {
+        "full": (),
+        "reduced": (":no-audio", ":avcodec-skip-frame=1", ":avcodec-skip-loop-filter=4", ":avcodec-threads=1"),
+        "keyframe": (":no-audio", ":avcodec-skip-frame=3", ":avcodec-skip-loop-filter=4", ":avcodec-threads=1"),
+    }
+
+    def __init__(self, max_decoders=6, budget_kbps=32000):
+        self.max_decoders = max_decoders
+        self.budget_kbps = budget_kbps
+
+    def plan(self, tiles, focus, reserved_decoders=0, reserved_kbps=0, current=None):
+        """计算各画面的解码级别
+
+        tiles 为 [{"key", "source", "bitrate", "shared"}, ...]，shared=True 表示该路数据已在拉取（不占带宽），
+        reserved_* 为主画面等占用的解码路数和带宽，current 为上次的 {频道标识: 级别}（用于防抖）。
+        返回 {频道标识: 级别}。
+        """
+        current = current or {}
+
+        def decoding(key):
+            return current.get(key) not in (None, "off")
+
+        order = sorted(
+            range(len(tiles)),
+            key=lambda i: (
+                tiles[i]["key"] != focus,
+                self.SOURCE_RANK.get(tiles[i]["source"], 2),
+                not decoding(tiles[i]["key"]),
+                i,
+            )
+        )
+        decoders = reserved_decoders
+        bandwidth = reserved_kbps
+        levels = {}
+        for i in order:
+            tile = tiles[i]
+            cost = 0 if tile["shared"] else tile["bitrate"]
+            budget = self.budget_kbps * (1 + self.HYSTERESIS) if decoding(tile["key"]) else self.budget_kbps
+            if tile["key"] != focus and (decoders >= self.max_decoders or bandwidth + cost > budget):
+                levels[tile["key"]] = "off"
+                continue
+            decoders += 1
+            bandwidth += cost
+            levels[tile["key"]] = "full" if tile["key"] == focus else None
+        limit = self.REDUCED_MAX_DECODERS
+        if "keyframe" in current.values():
+            limit -= 1
+        background = "reduced" if decoders <= limit else "keyframe"
+        for key, level in levels.items():
+            if level is None:
+                levels[key] = background
+        return levels
+
+class MosaicView:
+    """多画面窗口：以网格同时显示多个频道，每个画面有自己的小画布和VLC播放器
+
+    单击画面设为焦点（完整解码并出声音），双击在主窗口播放该频道并关闭多画面。
+    画面的解码级别由 MosaicScheduler 决定，焦点变化或码率估计变化时重新调度，
+    级别变化的画面用新的媒体选项重新起播。
+    """
+
+    GRID_SIZES = (4, 9, 16)
+    RESCHEDULE_MS = 5000
+
+    def __init__(self, app, size=4, start=0):
+        self.app = app
+        self.scheduler = MosaicScheduler(app.options.mosaic_decoders, app.options.mosaic_budget)
+        self.size = size
+        self.start = start  # 第一个画面在频道列表显示顺序中的位置
+        self.focus = None
+        self.tiles = []
+        self._job = None
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("多画面")
+        self.window.geometry("960x600")
+        self.window.configure(bg="black")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        toolbar = ttk.Frame(self.window, padding=5)
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        ttk.Button(toolbar, text="上一页", command=lambda: self.page(-1)).pack(side=tk.LEFT)
+        ttk.Button(toolbar, text="下一页", command=lambda: self.page(1)).pack(side=tk.LEFT, padx=5)
+        self.size_var = tk.StringVar(value=str(size))
+        size_box = ttk.Combobox(
+            toolbar, textvariable=self.size_var, values=[str(n) for n in self.GRID_SIZES], width=4, state="readonly"
+        )
+        size_box.pack(side=tk.LEFT, padx=5)
+        size_box.bind("<<ComboboxSelected>>", lambda event: self.resize(int(self.size_var.get())))
+        self.info_label = ttk.Label(toolbar, text="")
+        self.info_label.pack(side=tk.LEFT, padx=10)
+
+        self.grid = tk.Frame(self.window, bg="black")
+        self.grid.pack(fill=tk.BOTH, expand=True)
+        self.build_grid()
+        self.show_page()
+
+    def build_grid(self):
+        """按画面数创建网格（每个画面一个画布、一个标签和一个VLC播放器）"""
+        for tile in self.tiles:
+            self._stop_tile(tile)
+            tile["player"].release()
+            tile["frame"].destroy()
+        self.tiles = []
+        columns = int(self.size ** 0.5)
+        # 清除上一次较大网格的行列设置
+        for i in range(int(max(self.GRID_SIZES) ** 0.5)):
+            self.grid.rowconfigure(i, weight=0, uniform="")
+            self.grid.columnconfigure(i, weight=0, uniform="")
+        for i in range(self.size):
+            row, column = divmod(i, columns)
+            self.grid.rowconfigure(row, weight=1, uniform="row")
+            self.grid.columnconfigure(column, weight=1, uniform="column")
+            frame = tk.Frame(self.grid, bg="black", highlightthickness=2, highlightbackground="black")
+            frame.grid(row=row, column=column, sticky="nsew")
+            canvas = tk.Canvas(frame, bg="black", highlightthickness=0)
+            canvas.place(relx=0, rely=0, relwidth=1, relheight=1)
+            label = tk.Label(frame, text="", fg="white", bg="black", anchor=tk.W)
+            label.place(relx=0, rely=1.0, anchor=tk.SW)
+            player = self.app.ensure_vlc().media_player_new()
+            self.app.attach_video_output(player, canvas)
+            player.video_set_mouse_input(False)
+            player.video_set_key_input(False)
+            tile = {"frame": frame, "canvas": canvas, "label": label, "player": player,
+                    "key": None, "level": "off", "media": None, "source": None}
+            for widget in (canvas, label):
+                widget.bind("<Button-1>", lambda event, tile=tile: self.set_focus(tile["key"]))
+                widget.bind("<Double-Button-1>", lambda event, tile=tile: self.play_in_main(tile["key"]))
+            self.tiles.append(tile)
+
+    def resize(self, size):
+        if size != self.size:
+            self.size = size
+            self.build_grid()
+            self.show_page()
+
+    def page(self, step):
+        rows = self.app.channel_view.rows
+        if rows:
+            self.start = (self.start + step * self.size) % len(rows)
+            self.show_page()
+
+    def show_page(self):
+        """把当前页的频道分配给各画面"""
+        app = self.app
+        rows = app.channel_view.rows
+        keys = [app.channel_key(app.channel_list[index]) for index in rows[self.start:self.start + self.size]]
+        for tile, key in zip(self.tiles, keys + [None] * (self.size - len(keys))):
+            if tile["key"] != key:
+                self._stop_tile(tile)
+                tile["key"] = key
+                tile["source"] = None
+                channel = app.channel_by_key(key) if key else None
+                tile["name"] = channel["name"] if channel else ""
+        if self.focus not in keys:
+            self.focus = keys[0] if keys else None
+        self.schedule()
+
+    def set_focus(self, key):
+        if key and key != self.focus:
+            self.focus = key
+            self.schedule()
+
+    def play_in_main(self, key):
+        """在主窗口播放该频道并关闭多画面"""
+        position = self.app.channel_positions.get(key) if key else None
+        self.close()
+        if position is not None:
+            self.app.channel_view.select(position)
+            self.app.play_channel()
+
+    def schedule(self):
+        """重新调度各画面的解码级别并应用变化"""
+        if self._job:
+            self.window.after_cancel(self._job)
+        app = self.app
+        main_relayed = bool(app.is_playing and app.http_server and app.session
+                            and app.session["url"].startswith(app.http_server.url("/")))
+        tiles = []
+        for tile in self.tiles:
+            if not tile["key"]:
+                continue
+            channel = app.channel_by_key(tile["key"])
+            if tile["source"] is None:
+                tile["source"], tile["url"] = app.stream_source(channel, tile["key"])
+            app.zapper.sample_bitrate(tile["key"], tile["media"])
+            tiles.append({
+                "key": tile["key"],
+                "source": tile["source"],
+                "bitrate": app.zapper.bitrate(tile["key"]),
+                "shared": tile["source"] == "relay" and main_relayed and tile["key"] == app.current_channel_key,
+            })
+        # 主窗口正在播放时占用一路解码和相应带宽
+        reserved = 1 if app.is_playing else 0
+        reserved_kbps = app.zapper.bitrate(app.current_channel_key) if app.is_playing else 0
+        current = {tile["key"]: tile["level"] for tile in self.tiles if tile["key"]}
+        levels = self.scheduler.plan(tiles, self.focus, reserved, reserved_kbps, current)
+        counts = {}
+        for tile in self.tiles:
+            level = levels.get(tile["key"], "off")
+            counts[level] = counts.get(level, 0) + 1
+            if level != tile["level"]:
+                self._stop_tile(tile)
+                if level != "off":
+                    self._start_tile(tile, level)
+            focused = tile["key"] is not None and tile["key"] == self.focus
+            tile["frame"].config(highlightbackground="#3399ff" if focused else "black")
+            suffix = {"off": "（未解码）", "keyframe": "（关键帧）"}.get(level, "")
+            tile["label"].config(text=f"{tile.get('name', '')}{suffix}" if tile["key"] else "")
+        self.info_label.config(
+            text=f"解码 {len(tiles) - counts.get('off', 0)}/{self.scheduler.max_decoders} 路，"
+                 f"只解关键帧 {counts.get('keyframe', 0)} 路，未解码 {counts.get('off', 0)} 路"
+        )
+        self._job = self.window.after(self.RESCHEDULE_MS, self.schedule)
+
+    def _start_tile(self, tile, level):
+        media = self.app.create_media(tile["url"], tile["key"])
+        for option in self.scheduler.LEVEL_OPTIONS[level]:
+            media.add_option(option)
+        tile["player"].set_media(media)
+        tile["player"].audio_set_mute(level != "full")
+        if tile["player"].play() == -1:
+            tile["media"] = None
+            tile["level"] = "off"
+            return
+        tile["media"] = media
+        tile["level"] = level
+
+    def _stop_tile(self, tile):
+        if tile["level"] != "off":
+            tile["player"].stop()
+        tile["media"] = None
+        tile["level"] = "off"
+
+    def close(self):
+        """停止全部画面并关闭窗口"""
+        if self._job:
+            self.window.after_cancel(self._job)
+            self._job = None
+        for tile in self.tiles:
+            self._stop_tile(tile)
+            tile["player"].release()
+        self.tiles = []
+        self.window.destroy()
+        if self.app.mosaic is self:
+            self.app.mosaic = None
+            if self.app.zapper.enabled:
+                self.app.zapper.schedule_refresh()
+
+class IPTVEngine:
+    """IPTV核心（不依赖界面）：频道与服务器管理、播放地址生成、时间同步、中继控制
+
+    界面版本（IPTVPlayer）和无界面守护进程（--daemon）共用。状态变化通过
+    notify_status、on_channels_changed 等钩子通知上层，默认实现只打印日志。
+    """
+
+    def __init__(self, options=None):
+        self.options = options or parse_args([])
         
         # 初始化变量
         self.channel_list = []
         self.server_list = []
         self.current_server = ""
-        self.ntp_offset = 0
-        self.player = None
-        self.is_playing = False
-        self.current_channel = None
-        self.fullscreen_window = None
-        self.fullscreen_canvas = None
-        self.current_media = None  # 保存当前媒体对象
-        self.current_channel_template = ""  # 保存当前频道的模板URL
-        self.current_channel_name = ""  # 保存当前频道名称
+        
+        # 本地HTTP服务与中继（按需启动）
+        self.background = None
+        self.http_server = None
+        self.hls_relay = None
+        self.multicast_relay = None
+        self.relay_enabled = False  # 播放时是否走本地中继
+        self.timeshift = None
+        self.timeshift_enabled = False  # 播放M3U8频道时是否经过本地时移缓冲
+        self.streams = {}  # 频道标识 -> 通过控制接口启动的中继流
         
         # NTP服务器配置
         self.ntp_config_file = "ntp_config.json"
@@ -46,22 +4077,161 @@ class IPTVPlayer:
         ]
         self.current_ntp_server = self.load_ntp_config()
         
+        # 时间同步：并发查询全部NTP服务器，定时重新同步，上次的偏移保存在文件中供启动时直接使用
+        self.time_sync_file = "time_sync.json"
+        self.time_keeper = TimeKeeper(
+            self._ntp_query_servers,
+            state_file=self.time_sync_file,
+            get_http_urls=lambda: [f"http://{server}/" for server in self.server_list],
+            on_sync=self._on_time_sync
+        )
+        
         # 配置文件路径
         self.server_config_file = "server_config.json"
-        self.channel_config_file = "channel_config.json"
+        self.channel_config_file = "channel_config.json"  # 旧版频道配置，仅用于迁移
+        self.channel_db_file = "channels.db"
+        self.channel_store = None
+        self.channels_by_key = {}  # 频道标识（频道ID字符串） -> 频道
+        self.channel_positions = {}  # 频道标识 -> 在频道列表中的位置
+        self._playlist_entries = None  # /playlist.m3u 的预编译条目，频道变化后重建
+        self._playlist_layouts = None  # (条目, {服务器: 预先拼好的播放列表})
         
-        # 创建界面
-        self.create_widgets()
+        # 共享HTTP会话（首次使用时创建）与服务器可用性缓存
+        self._http_session = None
+        self._http_session_lock = threading.Lock()
+        self.availability_cache = AvailabilityCache()
+        
+        # 直播边缘起播
+        self.live_edge = LiveEdgeResolver(lambda: self.http_session)
+        self.live_edge_enabled = True  # 界面开关的镜像，供后台线程读取
+        self.channel_delays = {}  # 频道标识 -> 测得的起播延迟（秒）
+        
+        # 服务器探测器（后台并发测速，生成播放地址时直接取最快服务器）
+        self.server_prober = ServerProber(
+            lambda: self.server_list,
+            self._make_probe_url,
+            on_update=self._on_probe_update
+        )
+        
+        # 自适应网络缓存：按 服务器×频道 的探测结果和卡顿记录计算VLC的network-caching
+        self.caching_file = "network_caching.json"
+        self.caching_tuner = NetworkCachingTuner(self.caching_file)
+        
+        # 节目单（XMLTV）；频道对应的节目单ID在首次查询时确定并缓存
+        self.epg = EPGGuide()
+        self.epg_config_file = "epg_config.json"
+        self._epg_ids = {}  # 频道标识 -> 节目单ID（None表示节目单中没有该频道）
+        
+        # 录制（首次录制或有未完成的预约时创建）
+        self.recorder = None
+        self.recordings_file = "recordings.json"
         
-        # 加载配置
+        # 指标（/metrics）与滚动日志
+        self.metrics = Metrics()
+        self.metrics_log = RollingLog(self.options.metrics_log) if self.options.metrics_log else None
+        self.last_server = None  # 最近一次生成播放地址时使用的服务器
+        self._describe_metrics()
+
+    @property
+    def ntp_offset(self):
+        """当前时钟偏移（秒），含漂移外推"""
+        return self.time_keeper.offset()
+
+    @property
+    def http_session(self):
+        """共享HTTP会话，首次使用时才导入requests并创建"""
+        if self._http_session is None:
+            with self._http_session_lock:
+                if self._http_session is None:
+                    self._http_session = create_http_session()
+        return self._http_session
+
+    def start(self):
+        """加载配置，启动服务器探测和时间同步"""
+        self.load_config()
+        self.start_services()
+
+    def load_config(self):
+        """加载服务器和频道配置"""
         self.load_server_config()
         self.load_channel_config()
         # 如果配置为空，加载演示数据
         if not self.channel_list:
             self.load_demo_data()
+        else:
+            self.on_channels_changed()
+
+    def start_services(self):
+        """启动需要联网的后台服务"""
+        # 启动服务器探测
+        self.server_prober.start()
         
         # 自动同步时间
         self.sync_time()
+        
+        # 在后台加载节目单（命令行指定的或上次导入的）
+        epg_path = self.options.epg or self.load_epg_config()
+        if epg_path:
+            threading.Thread(target=self._load_epg_thread, args=(epg_path,), daemon=True).start()
+        
+        if self.options.metrics or self.options.playlist:
+            try:
+                self.ensure_local_server()
+            except OSError as e:
+                self.notify_warning("本地服务错误", f"无法启动本地HTTP服务:\n{str(e)}")
+        
+        # 恢复上次未完成的录制预约
+        if StreamRecorder.has_pending(self.recordings_file):
+            try:
+                self.ensure_recorder()
+            except OSError as e:
+                self.notify_warning("录制错误", f"无法恢复录制预约:\n{str(e)}")
+
+    def shutdown(self):
+        """停止后台任务和本地服务"""
+        self.server_prober.stop()
+        self.time_keeper.stop()
+        if self.recorder:
+            try:
+                self.background.run(self.recorder.close()).result(timeout=10)
+            except Exception as e:
+                print(f"停止录制失败: {e}")
+        if self.timeshift:
+            self.background.call(self.timeshift.close)
+        if self.http_server:
+            self.http_server.stop()
+        if self.channel_store:
+            self.channel_store.close()
+            self.channel_store = None
+
+    # ---- 通知钩子（界面版本覆盖） ----
+
+    def notify_status(self, message):
+        """状态消息（可能在后台线程中调用）"""
+        print(message)
+
+    def notify_warning(self, title, message):
+        """需要用户注意的警告"""
+        print(f"{title}: {message}")
+
+    def on_channels_changed(self):
+        """频道列表整体发生变化"""
+
+    def on_channels_imported(self, added):
+        """导入线程写入频道库的一批频道，加入内存中的频道列表"""
+        self._append_channels(added)
+
+    def on_epg_loaded(self):
+        """节目单加载完成"""
+
+    def on_server_ranking(self, ranking):
+        """服务器排名更新（在探测线程中调用）"""
+
+    def on_time_synced(self):
+        """一次时间同步结束（无论成功与否）"""
+
+    def on_local_server_created(self, server):
+        """本地HTTP服务创建后、启动前调用，可在此注册更多路由"""
 
     def load_ntp_config(self):
         """加载NTP服务器配置，如果没有则创建默认配置文件"""
@@ -124,24 +4294,11 @@ class IPTVPlayer:
             self.current_server = ""
 
     def load_channel_config(self):
-        """加载频道列表配置，如果没有则创建默认配置文件"""
-        default_channels = []
-        if os.path.exists(self.channel_config_file):
-            try:
-                with open(self.channel_config_file, "r", encoding="utf-8") as f:
-                    self.channel_list = json.load(f)
-                    # 更新树形视图
-                    self.channel_tree.delete(*self.channel_tree.get_children())
-                    for channel in self.channel_list:
-                        self.channel_tree.insert("", "end", values=(channel["name"], channel["url"]))
-            except Exception as e:
-                # 读取出错，使用默认，不写入文件
-                self.channel_list = default_channels
-        else:
-            # 文件不存在则写入默认
-            with open(self.channel_config_file, "w", encoding="utf-8") as f:
-                json.dump(default_channels, f, ensure_ascii=False)
-            self.channel_list = default_channels
+        """打开频道库并加载频道列表（首次运行时迁移旧版JSON配置）"""
+        if self.channel_store is None:
+            self.channel_store = ChannelStore(self.channel_db_file, legacy_json=self.channel_config_file)
+        self.channel_list = self.channel_store.load()
+        self._index_channels()
 
     def save_server_config(self):
         """保存服务器列表配置"""
@@ -151,33 +4308,1026 @@ class IPTVPlayer:
         except:
             pass
 
-    def save_channel_config(self):
-        """保存频道列表配置"""
-        try:
-            with open(self.channel_config_file, "w", encoding="utf-8") as f:
-                json.dump(self.channel_list, f, ensure_ascii=False)
-        except:
-            pass
+    def add_channels(self, channels):
+        """把频道写入频道库并追加到频道列表，返回实际新增的频道（重复地址被跳过）"""
+        added = self.channel_store.add_many(channels)
+        self._append_channels(added)
+        return added
+
+    def _append_channels(self, added):
+        """把已写入频道库的频道追加到内存中的频道列表和索引"""
+        for channel in added:
+            key = self.channel_key(channel)
+            self.channels_by_key[key] = channel
+            self.channel_positions[key] = len(self.channel_list)
+            self.channel_list.append(channel)
+        if added:
+            self._playlist_entries = None
+
+    def _index_channels(self):
+        """重建频道标识到频道、位置的映射"""
+        self.channels_by_key = {}
+        self.channel_positions = {}
+        self._playlist_entries = None
+        for position, channel in enumerate(self.channel_list):
+            key = self.channel_key(channel)
+            self.channels_by_key[key] = channel
+            self.channel_positions[key] = position
+
+    # ---- 指标 ----
+
+    def _describe_metrics(self):
+        describe = self.metrics.describe
+        describe("iptv_probe_connect_ms", "gauge", "服务器探测TCP连接时间（EWMA，毫秒）")
+        describe("iptv_probe_ttfb_ms", "gauge", "服务器探测首字节时间（EWMA，毫秒）")
+        describe("iptv_probe_fetch_ms", "gauge", "服务器探测播放列表获取时间（EWMA，毫秒）")
+        describe("iptv_probe_jitter_ms", "gauge", "服务器探测获取时间抖动（EWMA，毫秒）")
+        describe("iptv_server_healthy", "gauge", "服务器是否可用")
+        describe("iptv_ntp_offset_seconds", "gauge", "当前时钟偏移")
+        describe("iptv_ntp_drift_ppm", "gauge", "本地时钟漂移率")
+        describe("iptv_ntp_last_sync_timestamp", "gauge", "上次成功同步时间（Unix时间）")
+        describe("iptv_channels", "gauge", "频道数")
+        describe("iptv_relay_streams", "gauge", "通过控制接口启动的中继流数")
+        describe("iptv_hls_relay_requests_total", "counter", "HLS中继分片请求数")
+        describe("iptv_hls_relay_hit_ratio", "gauge", "HLS中继缓存命中率")
+        describe("iptv_hls_relay_upstream_bytes_total", "counter", "HLS中继上游流量")
+        describe("iptv_hls_relay_served_bytes_total", "counter", "HLS中继下行流量")
+        describe("iptv_playlist_requests_total", "counter", "/playlist.m3u 请求数")
+        describe("iptv_timeshift_window_seconds", "gauge", "时移可回看时长")
+        describe("iptv_playback_ttff_seconds", "gauge", "当前播放会话的首帧时间")
+        describe("iptv_playback_network_caching_ms", "gauge", "当前播放会话使用的VLC网络缓存")
+        describe("iptv_failovers_total", "counter", "播放中卡顿自动切换服务器的次数")
+        describe("iptv_failover_seconds", "gauge", "最近一次故障切换从发现卡顿到新服务器出画面的耗时")
+        describe("iptv_playback_demux_bitrate_kbps", "gauge", "当前播放会话的解复用码率")
+        describe("iptv_playback_input_bitrate_kbps", "gauge", "当前播放会话的输入码率")
+        describe("iptv_playback_displayed_pictures_total", "counter", "当前播放会话已显示的帧数")
+        describe("iptv_playback_lost_pictures_total", "counter", "当前播放会话丢弃的帧数")
+        describe("iptv_playback_lost_abuffers_total", "counter", "当前播放会话丢弃的音频缓冲数")
+        describe("iptv_playback_demux_corrupted_total", "counter", "当前播放会话损坏的数据包数")
+        describe("iptv_playback_demux_discontinuity_total", "counter", "当前播放会话的TS不连续次数")
+        describe("iptv_playback_buffering_events_total", "counter", "当前播放会话起播后的重新缓冲次数")
+        describe("iptv_sessions_total", "counter", "播放会话数")
+        describe("iptv_ui_updates_merged_total", "counter", "界面调度器合并的刷新数")
+        describe("iptv_ui_updates_dropped_total", "counter", "界面调度器丢弃的刷新数")
+        describe("iptv_ui_latency_ms", "gauge", "界面更新从投递到执行的平均延迟")
+        describe("iptv_ui_max_latency_ms", "gauge", "界面更新从投递到执行的最大延迟")
+
+    def collect_metrics(self):
+        """抓取时从各模块的统计中更新指标（需在事件循环线程中调用）"""
+        metrics = self.metrics
+        for server, stat in self.server_prober.snapshot():
+            metrics.set("iptv_probe_connect_ms", stat["connect"], server=server)
+            metrics.set("iptv_probe_ttfb_ms", stat["ttfb"], server=server)
+            metrics.set("iptv_probe_fetch_ms", stat["fetch"], server=server)
+            metrics.set("iptv_probe_jitter_ms", stat["jitter"], server=server)
+            metrics.set("iptv_server_healthy", int(stat["healthy"]), server=server)
+        metrics.set("iptv_ntp_offset_seconds", self.ntp_offset)
+        metrics.set("iptv_ntp_drift_ppm", self.time_keeper.drift * 1e6)
+        metrics.set("iptv_ntp_last_sync_timestamp", self.time_keeper.last_sync)
+        metrics.set("iptv_channels", len(self.channel_list))
+        metrics.set("iptv_relay_streams", len(self.streams))
+        if self.hls_relay:
+            stats = self.hls_relay.snapshot()
+            metrics.set("iptv_hls_relay_requests_total", stats["requests"])
+            metrics.set("iptv_hls_relay_hit_ratio", stats["hit_ratio"])
+            metrics.set("iptv_hls_relay_upstream_bytes_total", stats["bytes_upstream"])
+            metrics.set("iptv_hls_relay_served_bytes_total", stats["bytes_served"])
+        window = self.timeshift.window_seconds() if self.timeshift else None
+        if window is not None:
+            metrics.set("iptv_timeshift_window_seconds", window)
+
+    async def handle_metrics(self, request, writer):
+        """/metrics：Prometheus文本格式的指标"""
+        self.collect_metrics()
+        return 200, "text/plain; version=0.0.4; charset=utf-8", self.metrics.render().encode("utf-8")
+
+    def log_event(self, event, **fields):
+        """写入滚动日志（未启用时忽略）"""
+        if self.metrics_log:
+            self.metrics_log.write(event, **fields)
+
+    def _on_probe_update(self, ranking):
+        """一轮服务器探测结束（探测线程中调用）"""
+        self.log_event("probe", servers={
+            server: {key: stat[key] for key in ("connect", "ttfb", "fetch", "jitter", "healthy", "error")}
+            for server, stat in ranking
+        })
+        self.on_server_ranking(ranking)
 
     def check_server_available(self, url):
-        """检查服务器是否可用 - 优化版本"""
+        """检查服务器是否可用 - 按主机缓存结果，复用共享连接池（会阻塞，勿在UI线程调用）"""
+        # 解析URL获取主机部分
+        parsed_url = urllib.parse.urlparse(url)
+        if parsed_url.scheme not in ("http", "https"):
+            # 组播等非HTTP地址无法检查
+            return True
+        host = parsed_url.netloc
+        base_url = f"{parsed_url.scheme}://{host}"
+        
+        cached = self.availability_cache.get(host)
+        if cached is not None:
+            return cached
+        
+        available = False
         try:
-            # 解析URL获取主机部分
-            parsed_url = urllib.parse.urlparse(url)
-            base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-            
             # 尝试连接服务器
-            response = requests.head(base_url, timeout=3)
-            return response.status_code == 200
+            with self.http_session.head(base_url, timeout=3) as response:
+                available = response.status_code == 200
         except requests.exceptions.RequestException:
             # 如果HEAD方法失败，尝试GET方法（更可靠）
             try:
-                response = requests.get(base_url, timeout=3, stream=True)
-                return response.status_code == 200
-            except:
-                return False
-        except:
+                with self.http_session.get(base_url, timeout=3, stream=True) as response:
+                    available = response.status_code == 200
+            except requests.exceptions.RequestException:
+                available = False
+        
+        self.availability_cache.put(host, available)
+        return available
+    
+    def _make_probe_url(self, server):
+        """生成用于探测服务器的URL（使用第一个带{server}占位符的频道）"""
+        template = "http://{server}/"
+        for channel in self.channel_list:
+            if "{server}" in channel["url"]:
+                template = channel["url"]
+                break
+        return template.replace("{server}", server).replace("{timestamp}", self.get_utc_timestamp())
+    
+    def ensure_local_server(self):
+        """按需启动本地HTTP服务和中继（HLS中继、组播中继）"""
+        if self.http_server is None:
+            self.background = BackgroundLoop()
+            self.http_server = LocalHTTPServer(
+                self.background,
+                host=self.options.http_host,
+                port=self.options.http_port,
+                advertise_host=self.options.advertise_host
+            )
+            self.hls_relay = HLSRelay(self.http_session, self._resolve_relay_channel)
+            self.hls_relay.register(self.http_server)
+            self.multicast_relay = MulticastRelay(interface=self.options.mcast_iface)
+            self.multicast_relay.register(self.http_server)
+            self.timeshift = TimeshiftService(
+                self.http_session,
+                self._resolve_relay_channel,
+                os.path.join(tempfile.gettempdir(), f"iptv_timeshift_{self.options.http_port}.ring"),
+                self.options.timeshift_mb * 1024 * 1024
+            )
+            self.timeshift.register(self.http_server)
+            self.http_server.add_route("/metrics", self.handle_metrics)
+            self.http_server.add_route("/playlist.m3u", self.handle_playlist)
+            self.on_local_server_created(self.http_server)
+        self.http_server.start()
+        return self.http_server
+    
+    def _resolve_relay_channel(self, key):
+        """中继回调：把频道标识解析为上游播放地址"""
+        channel = self.channel_by_key(key)
+        if channel is None:
+            raise KeyError(f"未知频道: {key}")
+        if "{server}" in channel["url"] and not self.server_list:
+            raise ValueError("没有可用的服务器")
+        return self.resolve_play_url(channel["url"], key)
+    
+    def relay_path(self, template_url, key):
+        """频道在本地中继上的路径，不能走中继时返回None"""
+        if ".m3u8" in template_url:
+            return f"/hls/{key}.m3u8"
+        return MulticastRelay.local_path(template_url)
+    
+    def stream_source(self, channel, key):
+        """为附加画面（多画面等）选择来源，返回 (来源, 播放地址)
+
+        组播频道直接加入组播（不经过上游服务器），其次走本地中继（与其他播放共享上游拉取），
+        最后直接拉上游（只使用已缓存的直播边缘结果，不阻塞）。
+        """
+        template = channel["url"]
+        if urllib.parse.urlsplit(template).scheme in ("rtp", "udp"):
+            return "multicast", template
+        if self.relay_enabled and self.http_server:
+            path = self.relay_path(template, key)
+            if path:
+                return "relay", self.http_server.url(path)
+        return "direct", self.resolve_play_url(template, key, measure=False)
+    
+    def timeshift_url(self, key, behind=0):
+        """频道的本地时移播放列表地址，behind为距直播边缘的秒数"""
+        # switch=1：本程序的播放器换台时切换时移录制的频道
+        path = f"/timeshift/{key}.m3u8?switch=1"
+        if behind > 0:
+            path += f"&behind={int(behind)}"
+        return self.http_server.url(path)
+    
+    def uses_timeshift(self, template_url):
+        """该频道播放时是否经过本地时移缓冲（仅M3U8频道）"""
+        return self.timeshift_enabled and self.http_server is not None and ".m3u8" in template_url
+    
+    def build_play_url(self, template_url, key):
+        """生成实际交给VLC的地址：开启中继时M3U8和组播频道走本地中继"""
+        if self.relay_enabled and self.http_server:
+            path = self.relay_path(template_url, key)
+            if path:
+                return self.http_server.url(path)
+        return self.resolve_play_url(template_url, key, measure=False)
+    
+    def start_stream(self, key, request=None):
+        """通过本地中继开始一路流（供局域网播放器拉取），返回流信息
+
+        流地址按发起请求的客户端访问本机所用的地址生成（见 LocalHTTPServer.public_url）。
+        """
+        channel = self.channel_by_key(key)
+        if channel is None:
+            raise KeyError(f"未知频道: {key}")
+        if not self.http_server or not self.http_server.running:
+            raise RuntimeError("本地HTTP服务未启动")
+        path = self.relay_path(channel["url"], key)
+        if path is None:
+            raise ValueError(f"频道不支持中继: {channel['name']}")
+        stream = {
+            "channel": key,
+            "name": channel["name"],
+            "url": self.http_server.public_url(path, request),
+            "started": time.time(),
+        }
+        self.streams[key] = stream
+        if path.startswith("/hls/"):
+            # 预先拉取播放列表，客户端连上时即可命中缓存
+            self.background.run(self.hls_relay.prefetch(key))
+        return stream
+    
+    def stop_stream(self, key):
+        """停止一路中继流，返回是否存在"""
+        stream = self.streams.pop(key, None)
+        if stream is None:
+            return False
+        if self.hls_relay:
+            self.background.call(self.hls_relay.release, key)
+        return True
+    
+    def ensure_recorder(self):
+        """按需创建录制器（依赖本地服务的事件循环和组播中继）"""
+        if self.recorder is None:
+            self.ensure_local_server()
+            self.recorder = StreamRecorder(
+                self.background.loop,
+                self.http_session,
+                self._resolve_relay_channel,
+                self.multicast_relay,
+                self.options.record_dir,
+                state_file=self.recordings_file
+            )
+        return self.recorder
+    
+    def start_recording(self, key, start_at=None, stop_at=None, duration=None, program=""):
+        """录制频道，返回录制信息
+
+        start_at/stop_at 为本机时间戳，不指定开始时间则立即开始，不指定结束时间（或时长）则录到手动停止。
+        """
+        channel = self.channel_by_key(key)
+        if channel is None:
+            raise KeyError(f"未知频道: {key}")
+        if "{server}" in channel["url"] and not self.server_list:
+            raise ValueError("没有可用的服务器")
+        if duration:
+            stop_at = (start_at or time.time()) + duration
+        return self.ensure_recorder().add(key, channel["name"], channel["url"], start_at, stop_at, program)
+    
+    def record_program(self, key, which="next", padding=StreamRecorder.PADDING):
+        """按节目单预约录制当前或下一个节目，前后各多录 padding 秒"""
+        channel = self.channel_by_key(key)
+        if channel is None:
+            raise KeyError(f"未知频道: {key}")
+        current, following = self.epg_now_next(channel)
+        program = current if which == "now" else following
+        if program is None:
+            raise ValueError(f"节目单中没有{channel['name']}的{'当前' if which == 'now' else '下一个'}节目")
+        # 节目单时间是校正后的时间，换算为本机时间
+        offset = self.ntp_offset
+        start_at = None if which == "now" else program["start"] - offset - padding
+        stop_at = program["stop"] - offset + padding
+        return self.start_recording(key, start_at, stop_at, program=program["title"])
+    
+    def stop_recording(self, rec_id):
+        """停止或取消一路录制，返回是否存在"""
+        return self.recorder is not None and self.recorder.cancel(rec_id)
+    
+    def recordings(self):
+        """全部录制的状态"""
+        return self.recorder.snapshot() if self.recorder else []
+    
+    @staticmethod
+    def channel_key(channel):
+        """频道标识：频道库中的频道ID（字符串），不随列表顺序变化"""
+        return str(channel["id"])
+    
+    def channel_by_key(self, key):
+        """按频道标识查找频道"""
+        return self.channels_by_key.get(key)
+    
+    def neighbor_channel_keys(self, key):
+        """返回频道列表中与指定频道上下相邻的频道标识（下一个在前）"""
+        count = len(self.channel_list)
+        position = self.channel_positions.get(key)
+        if count < 2 or position is None:
+            return []
+        return [
+            self.channel_key(self.channel_list[(position + 1) % count]),
+            self.channel_key(self.channel_list[(position - 1) % count]),
+        ]
+    
+    def pick_server(self, exclude=()):
+        """选择服务器：优先测速排名第一的服务器，尚无探测结果时随机选择；exclude中的服务器都不选，没有可选的返回None"""
+        server = self.server_prober.pick(exclude)
+        if server is None:
+            candidates = [server for server in self.server_list if server not in exclude]
+            server = random.choice(candidates) if candidates else None
+        return server
+    
+    def _live_edge_target(self, template_url):
+        """判断模板是否适用直播边缘起播，适用时返回要使用的服务器，否则返回None"""
+        if not self.live_edge_enabled or "{timestamp}" not in template_url or ".m3u8" not in template_url:
+            return None
+        if "{server}" in template_url:
+            return self.pick_server() if self.server_list else None
+        return ""
+    
+    def needs_live_edge_measure(self, template_url, key):
+        """是否需要先测量直播边缘才能起播"""
+        if self.relay_enabled and self.http_server:
+            # 走中继时由中继线程测量
+            return False
+        server = self._live_edge_target(template_url)
+        return server is not None and self.live_edge.cached(server, key) is None
+    
+    def resolve_play_url(self, template_url, key, server=None, measure=True):
+        """生成上游播放地址，开启直播边缘起播时按测得的偏移调整starttime
+
+        measure=True且没有缓存结果时会联网测量（阻塞），不要在UI线程中使用。
+        """
+        target = self._live_edge_target(template_url)
+        if target is None:
+            return self.generate_play_url(template_url, server)
+        server = server or target
+        info = self.live_edge.cached(server, key)
+        if info is None and measure:
+            try:
+                info = self.live_edge.measure(
+                    server,
+                    key,
+                    lambda offset: self.generate_play_url(template_url, server, offset),
+                    self.get_corrected_utc
+                )
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"直播边缘测量失败: {e}")
+        offset = 0.0
+        if info is not None:
+            offset = info["shift"]
+            if info["delay"] is not None:
+                self.channel_delays[key] = info["delay"]
+        return self.generate_play_url(template_url, server, offset)
+    
+    def starttime_offset(self, play_url):
+        """播放地址中starttime相对当前（校正后）时间的秒数，没有starttime时返回None"""
+        values = urllib.parse.parse_qs(urllib.parse.urlsplit(play_url).query).get("starttime")
+        if not values:
+            return None
+        try:
+            starttime = datetime.datetime.strptime(values[0], "%Y%m%dT%H%M%S.%fZ").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+        return (starttime - self.get_corrected_utc()).total_seconds()
+    
+    def play_server(self, play_url):
+        """播放地址实际对应的上游服务器（本地中继取最近使用的服务器，组播返回"multicast"）"""
+        parts = urllib.parse.urlsplit(play_url)
+        if parts.scheme in ("udp", "rtp"):
+            return "multicast"
+        if self.http_server and play_url.startswith(self.http_server.url("/")):
+            if parts.path.startswith(("/udp/", "/rtp/")):
+                return "multicast"
+            return self.last_server
+        return parts.netloc
+    
+    def network_caching(self, play_url, key):
+        """该播放地址和频道使用的network-caching（毫秒）"""
+        server = self.play_server(play_url)
+        return self.caching_tuner.value(server, key, self.server_prober.stat(server) if server else None)
+    
+    def load_demo_data(self):
+        """加载演示数据"""
+        # 添加演示服务器
+        self.server_list = [
+            "124.232.231.172:8089",
+            "218.76.205.6:6410",
+            "218.76.205.7:6410",
+            "218.76.205.9:6410"
+        ]
+        
+        # 添加演示频道（已使用占位符）
+        demo_channels = [
+            ("CCTV1 高清", "http://{server}/000000002000/201500000063/1000.m3u8?starttime={timestamp}"),
+            ("湖南卫视", "http://{server}/000000002000/201500000067/1000.m3u8?starttime={timestamp}"),
+            ("浙江卫视", "http://{server}/000000002000/201500000064/1000.m3u8?starttime={timestamp}"),
+            ("测试 RTP 流", "rtp://239.76.253.151:9000"),
+            ("测试 RTP 转", "http://192.168.1.1:7088/udp/239.76.253.151:9000")
+        ]
+        
+        self.add_channels({"name": name, "url": url} for name, url in demo_channels)
+        
+        self.on_channels_changed()
+        self.notify_status(f"已加载 {len(demo_channels)} 个演示频道")
+    
+    def sync_time(self):
+        """立即同步时间（后台线程，之后定时重新同步）"""
+        self.time_keeper.sync_now()
+    
+    def _ntp_query_servers(self):
+        """参与同步的NTP服务器：当前选择的服务器在前，其余配置的服务器一起查询"""
+        return [self.current_ntp_server] + self.ntp_servers
+    
+    def _on_time_sync(self, result):
+        """一次时间同步结束（同步线程中调用）"""
+        self.log_event("ntp_sync", **{key: value for key, value in result.items() if key != "samples"})
+        if result["ok"] and result["source"] == "ntp":
+            self.notify_status(
+                f"时间同步成功! 可信NTP服务器 {result['survivors']}/{result['servers']} 个，"
+                f"最佳: {result['best']}, 偏移: {result['offset']:.3f}秒, 漂移: {result['drift_ppm']:.1f}ppm"
+            )
+        elif result["ok"]:
+            self.notify_status(f"NTP不可用，已按IPTV服务器时间校正, 偏移: {result['offset']:.3f}秒")
+        else:
+            self.notify_status(f"时间同步失败: {result['error']}，继续使用偏移 {self.ntp_offset:.3f}秒")
+        self.on_time_synced()
+    
+    def get_corrected_utc(self):
+        """获取经NTP校正的当前UTC时间"""
+        # 获取当前UTC时间（使用带时区的时间对象）
+        utc_now = datetime.datetime.now(timezone.utc)
+        
+        # 应用NTP偏移
+        return utc_now + datetime.timedelta(seconds=self.ntp_offset)
+    
+    def get_utc_timestamp(self, offset=0.0):
+        """获取UTC时间戳（格式：20250705T142312.00Z），offset为相对当前时间的秒数"""
+        corrected_utc = self.get_corrected_utc() + datetime.timedelta(seconds=offset)
+        
+        # 格式化为所需格式
+        return corrected_utc.strftime(STARTTIME_FORMAT)
+    
+    def convert_url(self, original_url):
+        """将URL中的服务器地址和时间戳替换为占位符"""
+        return convert_channel_url(original_url)
+    
+    def import_channels(self, file_path, progress=None, batch_size=2000):
+        """流式导入频道列表文件，按批写入频道库，返回 (新增数, 跳过的重复数)
+
+        progress(已读字节, 总字节, 新增数, 跳过数) 在每批写入后调用。
+        可在后台线程中调用：这里只解析文件和写频道库，每批新增的频道交给 on_channels_imported。
+        """
+        importer = PlaylistImporter(file_path, convert=convert_channel_url)
+        added = 0
+        skipped = 0
+        for batch in importer.batches(batch_size):
+            new_channels = self.channel_store.add_many(batch)
+            self.on_channels_imported(new_channels)
+            count = len(new_channels)
+            added += count
+            skipped += len(batch) - count
+            if progress:
+                progress(importer.bytes_read, importer.total_bytes, added, skipped)
+        return added, skipped
+    
+    def load_epg(self, path, progress=None):
+        """解析XMLTV节目单文件并替换当前节目单，记住文件路径供下次启动加载，返回节目数"""
+        guide = EPGGuide()
+        count = guide.load(path, progress)
+        self.epg, self._epg_ids = guide, {}
+        try:
+            with open(self.epg_config_file, "w", encoding="utf-8") as f:
+                json.dump({"path": os.path.abspath(path)}, f, ensure_ascii=False)
+        except OSError:
+            pass
+        self.on_epg_loaded()
+        return count
+    
+    def load_epg_config(self):
+        """上次导入的节目单路径（文件已不存在时返回None）"""
+        try:
+            with open(self.epg_config_file, "r", encoding="utf-8") as f:
+                path = json.load(f).get("path")
+        except (OSError, ValueError, AttributeError):
+            return None
+        return path if path and os.path.exists(path) else None
+    
+    def _load_epg_thread(self, path):
+        try:
+            count = self.load_epg(path)
+            self.notify_status(f"节目单已加载: {count} 个节目")
+        except Exception as e:
+            self.notify_status(f"加载节目单失败: {e}")
+    
+    def epg_now_next(self, channel, at=None):
+        """频道的 (当前节目, 下一个节目)，时间默认为校正后的当前时间"""
+        key = self.channel_key(channel)
+        epg = self.epg
+        epg_id = self._epg_ids.get(key, False)
+        if epg_id is False:
+            epg_id = self._epg_ids[key] = epg.resolve(channel)
+        if epg_id is None:
+            return None, None
+        return epg.now_next(epg_id, time.time() + self.ntp_offset if at is None else at)
+    
+    def scan_channels(self, progress=None):
+        """体检全部频道×全部服务器，返回ChannelScanner（结果在其results中）"""
+        scanner = ChannelScanner(lambda: self.http_session, self.generate_play_url)
+        channels = [(self.channel_key(channel), channel) for channel in self.channel_list]
+        scanner.scan(channels, list(self.server_list), progress)
+        return scanner
+    
+    def run_scan(self, output_path):
+        """命令行体检：同步时间后检测全部频道，结果写入JSON或CSV文件"""
+        self.load_config()
+        # 直接在当前线程同步时间，保证生成的starttime准确
+        self.time_keeper.sync()
+        
+        def progress(done, total):
+            if done == total or done % max(total // 10, 1) == 0:
+                print(f"已检测 {done}/{total}")
+        
+        scanner = self.scan_channels(progress)
+        scanner.export(output_path)
+        summary = "，".join(f"{status} {count}" for status, count in sorted(scanner.summary().items()))
+        print(f"体检完成，用时 {scanner.elapsed:.1f} 秒：{summary}；结果已写入 {output_path}")
+        self.shutdown()
+    
+    def run_analysis(self, source, seconds=30, report_path=None):
+        """命令行流分析：source 为组播地址、频道ID、TS文件或pcap文件，报告打印到终端，可另存为JSON"""
+        if not os.path.exists(source) and not MULTICAST_URL_RE.match(source):
+            # 频道ID：分析该频道的组播地址
+            self.load_channel_config()
+            channel = self.channel_by_key(source)
+            self.shutdown()
+            if channel is None:
+                raise SystemExit(f"无法识别的分析对象: {source}")
+            if not MULTICAST_URL_RE.match(channel["url"]):
+                raise SystemExit(f"{channel['name']} 不是组播频道")
+            source = channel["url"]
+        analyzer = StreamAnalyzer(source)
+        try:
+            match = MULTICAST_URL_RE.match(source)
+            if match:
+                group, port = match.group(1), int(match.group(2))
+                print(f"正在抓取 {group}:{port}，{seconds} 秒……")
+                analyzer.capture(
+                    group, port, seconds, self.options.mcast_iface,
+                    lambda elapsed, count: print(f"已抓取 {elapsed:.0f} 秒，{count} 个报文")
+                )
+            elif source.lower().endswith((".pcap", ".cap")):
+                group, port = analyzer.load_pcap(source)
+                analyzer.source = f"{source}（{group}:{port}）"
+            else:
+                analyzer.load_ts(source)
+            report = analyzer.analyze()
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"分析失败: {e}")
+        print(format_analysis_report(report))
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"报告已写入 {report_path}")
+        return report
+    
+    def generate_play_url(self, template_url, server=None, offset=0.0):
+        """生成播放URL，可指定服务器和starttime相对当前时间的偏移（秒）"""
+        compiled = compile_play_template(template_url)
+        
+        # 如果URL中包含{server}占位符，则替换为当前服务器
+        if compiled.has_server:
+            if not server:
+                if not self.server_list:
+                    self.notify_warning("服务器错误", "没有可用的服务器，请先导入服务器列表")
+                    return template_url
+                server = self.pick_server()
+            self.last_server = server
+        
+        timestamp = self.get_utc_timestamp(offset) if compiled.has_timestamp else ""
+        return compiled.render(server, timestamp)
+    
+    # ---- 解析后的M3U播放列表（/playlist.m3u） ----
+    
+    def _playlist_entry_list(self):
+        """频道的 (频道标识, #EXTINF行, 预编译模板) 列表，频道列表变化后重建"""
+        entries = self._playlist_entries
+        if entries is None:
+            entries = []
+            for channel in self.channel_list:
+                name = channel["name"].replace(",", " ")
+                header = (
+                    f'#EXTINF:-1 tvg-id="{channel.get("tvg_id", "")}" tvg-name="{name}" '
+                    f'group-title="{channel.get("group", "")}",{name}\n'
+                )
+                entries.append((self.channel_key(channel), header, compile_play_template(channel["url"])))
+            self._playlist_entries = entries
+        return entries
+    
+    def _playlist_layout(self, entries, server):
+        """把整个播放列表按某台服务器预先拼好：固定文本段和各段之间的时间戳位置
+
+        返回 (文本段, 各时间戳位置对应的直播边缘缓存键)，文本段比时间戳位置多一个。
+        """
+        layouts = self._playlist_layouts
+        if layouts is None or layouts[0] is not entries:
+            layouts = self._playlist_layouts = (entries, {})
+        layout = layouts[1].get(server)
+        if layout is None:
+            segments = ["#EXTM3U\n"]
+            slots = []
+            for key, header, compiled in entries:
+                if compiled.has_server and not server:
+                    continue
+                pieces = compiled.pieces(server)
+                segments[-1] += header + pieces[0]
+                for piece in pieces[1:]:
+                    slots.append((server if compiled.has_server else "", key))
+                    segments.append(piece)
+                segments[-1] += "\n"
+            layout = layouts[1][server] = (segments, slots, frozenset(slots))
+        return layout
+    
+    def render_playlist(self):
+        """生成全部频道都已解析的M3U：使用当前最快的服务器和校正后的当前时间
+
+        开启直播边缘起播时使用已测得的各频道偏移（不联网测量）。
+        """
+        entries = self._playlist_entry_list()
+        server = self.pick_server() if self.server_list else None
+        segments, slots, slot_set = self._playlist_layout(entries, server)
+        now = self.get_corrected_utc()
+        timestamp = now.strftime(STARTTIME_FORMAT)
+        shifts = self.live_edge.shifts() if self.live_edge_enabled else {}
+        if not shifts or slot_set.isdisjoint(shifts):
+            # 所有频道使用同一时间戳：一次拼接
+            return timestamp.join(segments).encode("utf-8")
+        
+        timestamps = {0.0: timestamp}  # 偏移 -> 时间戳
+        parts = [segments[0]]
+        for slot, segment in zip(slots, segments[1:]):
+            offset = shifts.get(slot, 0.0)
+            stamp = timestamps.get(offset)
+            if stamp is None:
+                stamp = timestamps[offset] = (now + timedelta(seconds=offset)).strftime(STARTTIME_FORMAT)
+            parts.append(stamp)
+            parts.append(segment)
+        return "".join(parts).encode("utf-8")
+    
+    async def handle_playlist(self, request, writer):
+        """/playlist.m3u：供Kodi、电视盒子等其他播放器使用的解析后播放列表"""
+        self.metrics.inc("iptv_playlist_requests_total")
+        return 200, "audio/x-mpegurl; charset=utf-8", self.render_playlist()
+
+class ControlAPI:
+    """守护进程的HTTP/JSON控制接口
+
+      GET    /api/status             运行状态
+      GET    /api/channels           频道列表
+      GET    /api/servers            服务器测速排名
+      GET    /api/resolve?channel=ID 解析播放地址（relay=1时返回本地中继地址）
+      GET    /api/streams            正在中继的流
+      POST   /api/streams            开始中继，正文 {"channel": ID}
+      DELETE /api/streams/ID         停止中继
+      POST   /api/sync-time          立即同步时间
+      GET    /api/epg[?channel=ID]   当前和下一个节目（不指定频道时返回全部频道）
+      GET    /api/recordings         录制列表
+      POST   /api/recordings         开始或预约录制，正文 {"channel": ID, "start": 时间戳, "stop": 时间戳,
+                                     "duration": 秒} 或 {"channel": ID, "program": "now"|"next"}
+      DELETE /api/recordings/ID      停止或取消录制
+
+    默认只接受本机请求；设置了令牌（--api-token）时也接受带
+    Authorization: Bearer <令牌> 头或 token=<令牌> 参数的其它地址的请求。中继、/playlist.m3u 等其它路径不受影响。
+    """
+
+    def __init__(self, engine, token=None):
+        self.engine = engine
+        self.token = token
+        self.requests = 0
+        self.routes = {
+            ("GET", "/api/status"): self.get_status,
+            ("GET", "/api/channels"): self.get_channels,
+            ("GET", "/api/servers"): self.get_servers,
+            ("GET", "/api/resolve"): self.get_resolve,
+            ("GET", "/api/streams"): self.get_streams,
+            ("POST", "/api/streams"): self.post_stream,
+            ("POST", "/api/sync-time"): self.post_sync_time,
+            ("GET", "/api/epg"): self.get_epg,
+            ("GET", "/api/recordings"): self.get_recordings,
+            ("POST", "/api/recordings"): self.post_recording,
+        }
+
+    def register(self, server):
+        """注册到本地HTTP服务"""
+        server.add_route("/api/", self.handle)
+
+    def authorized(self, request):
+        """本机请求直接允许；其它地址需要令牌"""
+        host = request.peer[0] if request.peer else ""
+        if host in ("127.0.0.1", "::1", "::ffff:127.0.0.1"):
+            return True
+        if not self.token:
             return False
+        supplied = request.query.get("token", "")
+        authorization = request.headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            supplied = authorization[7:].strip()
+        return hmac.compare_digest(supplied.encode("utf-8"), self.token.encode("utf-8"))
+
+    async def handle(self, request, writer):
+        if not self.authorized(request):
+            return json_response({"error": "forbidden"}, 403)
+        self.requests += 1
+        path = request.path.rstrip("/")
+        handler = self.routes.get((request.method, path))
+        try:
+            if handler is not None:
+                return handler(request)
+            if request.method == "DELETE" and path.startswith("/api/streams/"):
+                return self.delete_stream(path[len("/api/streams/"):])
+            if request.method == "DELETE" and path.startswith("/api/recordings/"):
+                return self.delete_recording(path[len("/api/recordings/"):])
+        except KeyError as e:
+            return json_response({"error": e.args[0] if e.args else "not found"}, 404)
+        except (ValueError, RuntimeError) as e:
+            return json_response({"error": str(e)}, 400)
+        return json_response({"error": "not found"}, 404)
+
+    def get_status(self, request):
+        engine = self.engine
+        return json_response({
+            "channels": len(engine.channel_list),
+            "servers": len(engine.server_list),
+            "best_server": engine.server_prober.best,
+            "ntp_server": engine.current_ntp_server,
+            "ntp_offset": engine.ntp_offset,
+            "time_sync": engine.time_keeper.snapshot(),
+            "streams": len(engine.streams),
+            "api_requests": self.requests,
+            "hls_relay": engine.hls_relay.snapshot() if engine.hls_relay else None,
+        })
+
+    def get_channels(self, request):
+        return json_response([
+            {"channel": self.engine.channel_key(channel), "name": channel["name"], "url": channel["url"]}
+            for channel in self.engine.channel_list
+        ])
+
+    def get_servers(self, request):
+        return json_response([
+            dict(stat, server=server) for server, stat in self.engine.server_prober.snapshot()
+        ])
+
+    def _channel_param(self, request):
+        key = request.query.get("channel", "")
+        if self.engine.channel_by_key(key) is None:
+            raise KeyError(f"未知频道: {key}")
+        return key
+
+    def get_resolve(self, request):
+        engine = self.engine
+        key = self._channel_param(request)
+        channel = engine.channel_by_key(key)
+        if "{server}" in channel["url"] and not engine.server_list:
+            raise ValueError("没有可用的服务器")
+        if request.query.get("relay") == "1":
+            path = engine.relay_path(channel["url"], key)
+            if path is None:
+                raise ValueError("频道不支持中继")
+            url = engine.http_server.public_url(path, request)
+        else:
+            # 只使用已缓存的直播边缘结果，不在事件循环中联网
+            url = engine.resolve_play_url(channel["url"], key, measure=False)
+        return json_response({"channel": key, "name": channel["name"], "url": url})
+
+    def get_streams(self, request):
+        return json_response(list(self.engine.streams.values()))
+
+    def post_stream(self, request):
+        key = request.query.get("channel")
+        if key is None and request.body:
+            try:
+                key = str(json.loads(request.body).get("channel", ""))
+            except (ValueError, AttributeError):
+                raise ValueError("请求正文不是有效的JSON对象")
+        return json_response(self.engine.start_stream(key or "", request), 201)
+
+    def delete_stream(self, key):
+        if not self.engine.stop_stream(key):
+            raise KeyError(f"没有正在中继的频道: {key}")
+        return json_response({"channel": key, "stopped": True})
+
+    def post_sync_time(self, request):
+        self.engine.sync_time()
+        return json_response({"syncing": True}, 202)
+
+    def get_epg(self, request):
+        engine = self.engine
+        if "channel" in request.query:
+            channels = [engine.channel_by_key(self._channel_param(request))]
+        else:
+            channels = engine.channel_list
+        result = []
+        for channel in channels:
+            current, following = engine.epg_now_next(channel)
+            result.append({"channel": engine.channel_key(channel), "name": channel["name"],
+                           "now": current, "next": following})
+        return json_response(result)
+
+    def get_recordings(self, request):
+        return json_response(self.engine.recordings())
+
+    def post_recording(self, request):
+        try:
+            body = json.loads(request.body) if request.body else {}
+            params = dict(request.query, **body)
+        except (ValueError, TypeError):
+            raise ValueError("请求正文不是有效的JSON对象")
+        key = str(params.get("channel", ""))
+        if self.engine.channel_by_key(key) is None:
+            raise KeyError(f"未知频道: {key}")
+        if params.get("program"):
+            if params["program"] not in ("now", "next"):
+                raise ValueError("program 只能是 now 或 next")
+            rec = self.engine.record_program(key, params["program"])
+        else:
+            def number(name):
+                value = params.get(name)
+                return None if value in (None, "") else float(value)
+            rec = self.engine.start_recording(key, number("start"), number("stop"), number("duration"))
+        return json_response({name: value for name, value in rec.items() if name != "template"}, 201)
+
+    def delete_recording(self, rec_id):
+        if not self.engine.stop_recording(rec_id):
+            raise KeyError(f"没有进行中的录制: {rec_id}")
+        return json_response({"id": rec_id, "stopped": True})
+
+class IPTVDaemon(IPTVEngine):
+    """无界面守护进程：启动本地HTTP服务并提供JSON控制接口"""
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.relay_enabled = True
+        self.api = ControlAPI(self, self.options.api_token)
+
+    def on_local_server_created(self, server):
+        self.api.register(server)
+
+    def run(self):
+        """运行直到收到中断"""
+        self.start()
+        server = self.ensure_local_server()
+        print(f"IPTV守护进程已启动: {server.url('/api/status')}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+class IPTVPlayer(IPTVEngine):
+    """Tk界面播放器"""
+
+    # 播放统计采样间隔（毫秒），每隔 SAMPLE_LOG_EVERY 次采样写一次日志
+    SAMPLE_INTERVAL_MS = 2000
+    SAMPLE_LOG_EVERY = 5
+    # 卡顿看门狗：出画面后持续缓冲或收不到数据超过 STALL_SECONDS 秒，
+    # 或起播超过 STARTUP_TIMEOUT 秒仍没有画面，就切换到下一台服务器
+    STALL_SECONDS = 8
+    STARTUP_TIMEOUT = 15
+
+    def __init__(self, root, options=None):
+        super().__init__(options)
+        self.root = root
+        self.root.title("Windows IPTV播放器 - 专业全屏版")
+        self.root.geometry("1000x700")
+        self.root.configure(bg="#f0f0f0")
+        
+        # 初始化变量
+        self.player = None
+        self.is_playing = False
+        self.current_channel = None
+        self.is_fullscreen = False
+        self._fullscreen_started = None  # 全屏切换计时起点
+        self.fullscreen_latencies = []  # 最近的全屏切换耗时（毫秒）
+        self.current_media = None  # 保存当前媒体对象
+        self.current_channel_template = ""  # 保存当前频道的模板URL
+        self.current_channel_name = ""  # 保存当前频道名称
+        self.current_channel_key = ""  # 保存当前频道标识（用于本地中继）
+        self.timeshift_behind = 0  # 时移播放落后直播的秒数
+        self.timeshift_paused_at = None  # 时移暂停开始的时刻
+        
+        # VLC实例和播放器在首次播放时才创建
+        self.instance = None
+        self.media_player = None
+        
+        # 后台线程的界面更新统一经过调度器
+        self.ui = UIDispatcher(root)
+        self.ui.start()
+        
+        # 播放会话指标（VLC事件回调只计数，统计每2秒在主循环中采样一次）
+        self.session = None
+        self._watched_players = set()
+        self.root.after(self.SAMPLE_INTERVAL_MS, self.sample_playback)
+        
+        # 创建界面
+        self.create_widgets()
+        STARTUP_PROFILE.mark("创建控件")
+        
+        # 先从本地配置画出频道列表，联网的服务推迟到窗口显示之后
+        self.load_config()
+        STARTUP_PROFILE.mark("加载配置")
+        self.root.after(50, self._start_deferred_services)
+    
+    def _start_deferred_services(self):
+        """窗口显示后启动服务器探测和时间同步"""
+        STARTUP_PROFILE.mark("首次绘制")
+        self.start_services()
+        STARTUP_PROFILE.mark("启动后台服务")
+        if self.options.startup_profile:
+            STARTUP_PROFILE.report()
+
+    def notify_status(self, message):
+        """后台线程的状态消息转到界面线程显示"""
+        self.ui.update("status", self.update_status, message)
+
+    def notify_warning(self, title, message):
+        # 可能在后台线程中调用；相同的警告在一个节拍内只弹出一次
+        self.ui.update(("warning", title, message), messagebox.showwarning, title, message)
+
+    def on_channels_changed(self):
+        self.refresh_channel_tree()
+
+    def on_channels_imported(self, added):
+        # 频道列表和索引只在界面线程中修改，导入线程只负责解析和写频道库
+        if added:
+            self.ui.call(self._append_channels, added)
+
+    def on_server_ranking(self, ranking):
+        self.ui.update("server_ranking", self.update_server_ranking, ranking)
+
+    def on_time_synced(self):
+        self.ui.call(self.sync_btn.config, {"state": tk.NORMAL, "text": "同步时间"})
+
+    def refresh_channel_tree(self):
+        """频道列表变化后刷新列表显示（搜索索引下次搜索时重建）"""
+        self.search_index_dirty = True
+        self.apply_channel_filter()
+    
+    def channel_row_values(self, index):
+        """频道列表中一行的显示内容"""
+        channel = self.channel_list[index]
+        delay = self.channel_delays.get(self.channel_key(channel))
+        current, following = self.epg_now_next(channel)
+        return (
+            channel["name"],
+            f"{delay:.1f}s" if delay is not None else "",
+            current["title"] if current else "",
+            f"{time.strftime('%H:%M', time.localtime(following['start']))} {following['title']}" if following else "",
+            channel["url"]
+        )
+    
+    def apply_channel_filter(self):
+        """按搜索框内容过滤频道列表"""
+        query = self.search_var.get()
+        if not query.strip():
+            self.channel_view.set_rows(list(range(len(self.channel_list))))
+            return
+        if self.search_index_dirty:
+            self.search_index.rebuild(self.channel_list)
+            self.search_index_dirty = False
+        self.channel_view.set_rows(self.search_index.search(query))
+
+    def sync_time(self):
+        """同步时间"""
+        self.sync_btn.config(state=tk.DISABLED, text="同步中...")
+        self.update_status("正在同步时间...")
+        
+        # 在新线程中执行同步
+        super().sync_time()
+    
+    def _verify_server_thread(self, play_url, channel_name):
+        """后台检查服务器可用性，播放已先行开始"""
+        available = self.check_server_available(play_url)
+        
+        def report():
+            # 用户已切换频道时不再覆盖状态栏
+            if channel_name != self.current_channel_name:
+                return
+            if available:
+                self.update_status(f"服务器可用，正在播放: {channel_name} - 双击画面或按ESC键切换全屏")
+            else:
+                # 检查失败时继续播放（因为有时检查方法可能误报）
+                self.update_status(f"服务器检查失败，但仍尝试播放: {channel_name}")
+        
+        self.ui.call(report)
 
     def create_widgets(self):
         # 创建主框架
@@ -255,6 +5405,13 @@ class IPTVPlayer:
         )
         self.import_channel_btn.pack(fill=tk.X, pady=5)
         
+        self.import_epg_btn = ttk.Button(
+            control_frame, 
+            text="导入节目单", 
+            command=self.import_epg_file
+        )
+        self.import_epg_btn.pack(fill=tk.X, pady=5)
+        
         # 播放控制区域
         ttk.Separator(control_frame).pack(fill=tk.X, pady=10)
         
@@ -264,24 +5421,144 @@ class IPTVPlayer:
             command=self.play_channel,
             state=tk.DISABLED
         )
-        self.play_btn.pack(fill=tk.X, pady=5)
+        self.play_btn.pack(fill=tk.X, pady=5)
+        
+        self.stop_btn = ttk.Button(
+            control_frame, 
+            text="停止", 
+            command=self.stop_playback,
+            state=tk.DISABLED
+        )
+        self.stop_btn.pack(fill=tk.X, pady=5)
+        
+        # 全屏控制按钮
+        self.fullscreen_btn = ttk.Button(
+            control_frame, 
+            text="进入全屏", 
+            command=self.enter_fullscreen,
+            state=tk.DISABLED
+        )
+        self.fullscreen_btn.pack(fill=tk.X, pady=5)
+        
+        # 本地中继：多个播放器共享同一路上游流
+        self.relay_var = tk.BooleanVar(value=False)
+        self.relay_check = ttk.Checkbutton(
+            control_frame,
+            text="通过本地中继播放（M3U8/组播）",
+            variable=self.relay_var,
+            command=self.on_relay_toggle
+        )
+        self.relay_check.pack(anchor=tk.W, pady=5)
+        self.relay_stats_label = ttk.Label(control_frame, text="")
+        self.relay_stats_label.pack(anchor=tk.W)
+        
+        # 直播边缘起播：消除M3U8比组播慢约1分钟的问题
+        self.live_edge_var = tk.BooleanVar(value=self.live_edge_enabled)
+        self.live_edge_check = ttk.Checkbutton(
+            control_frame,
+            text="M3U8从直播边缘起播",
+            variable=self.live_edge_var,
+            command=lambda: setattr(self, "live_edge_enabled", self.live_edge_var.get())
+        )
+        self.live_edge_check.pack(anchor=tk.W, pady=5)
+        self.delay_label = ttk.Label(control_frame, text="")
+        self.delay_label.pack(anchor=tk.W)
+        
+        # 快速换台：预热相邻频道，上下键换台
+        self.zap_var = tk.BooleanVar(value=False)
+        self.zap_check = ttk.Checkbutton(
+            control_frame,
+            text="快速换台（预热相邻频道）",
+            variable=self.zap_var,
+            command=self.on_zap_toggle
+        )
+        self.zap_check.pack(anchor=tk.W, pady=5)
+        
+        self.mosaic_btn = ttk.Button(
+            control_frame,
+            text="多画面",
+            command=self.open_mosaic
+        )
+        self.mosaic_btn.pack(fill=tk.X, pady=5)
+        
+        # 录制：原样保存TS数据，可同时录制多个频道
+        self.record_btn = ttk.Button(
+            control_frame,
+            text="录制选中频道",
+            command=self.toggle_recording
+        )
+        self.record_btn.pack(fill=tk.X, pady=5)
+        
+        self.record_next_btn = ttk.Button(
+            control_frame,
+            text="预约录制下一节目",
+            command=self.record_next_program
+        )
+        self.record_next_btn.pack(fill=tk.X, pady=5)
+        
+        self.record_label = ttk.Label(control_frame, text="")
+        self.record_label.pack(fill=tk.X)
+        
+        # 本地时移：M3U8频道的分片写入本地环形文件，可暂停、后退和回到直播
+        self.timeshift_var = tk.BooleanVar(value=False)
+        self.timeshift_check = ttk.Checkbutton(
+            control_frame,
+            text="本地时移（M3U8）",
+            variable=self.timeshift_var,
+            command=self.on_timeshift_toggle
+        )
+        self.timeshift_check.pack(anchor=tk.W, pady=5)
+        timeshift_frame = ttk.Frame(control_frame)
+        timeshift_frame.pack(fill=tk.X)
+        self.timeshift_back_btn = ttk.Button(
+            timeshift_frame, text="后退30秒", state=tk.DISABLED, command=lambda: self.timeshift_seek(30)
+        )
+        self.timeshift_back_btn.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.timeshift_pause_btn = ttk.Button(
+            timeshift_frame, text="暂停", state=tk.DISABLED, command=self.timeshift_pause
+        )
+        self.timeshift_pause_btn.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.timeshift_live_btn = ttk.Button(
+            timeshift_frame, text="回到直播", state=tk.DISABLED, command=lambda: self.timeshift_seek(None)
+        )
+        self.timeshift_live_btn.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.timeshift_label = ttk.Label(control_frame, text="")
+        self.timeshift_label.pack(anchor=tk.W)
+        
+        # 服务器排名区域
+        ranking_frame = ttk.LabelFrame(self.left_panel, text="服务器排名", padding=10)
+        ranking_frame.pack(fill=tk.X, pady=5)
+        
+        self.server_tree = ttk.Treeview(
+            ranking_frame,
+            columns=("server", "connect", "ttfb", "fetch", "weight"),
+            show="headings",
+            height=4,
+            selectmode="none"
+        )
+        self.server_tree.heading("server", text="服务器")
+        self.server_tree.heading("connect", text="连接")
+        self.server_tree.heading("ttfb", text="首字节")
+        self.server_tree.heading("fetch", text="列表")
+        self.server_tree.heading("weight", text="权重")
+        self.server_tree.column("server", width=130, anchor=tk.W)
+        for column in ("connect", "ttfb", "fetch", "weight"):
+            self.server_tree.column(column, width=50, anchor=tk.E)
+        self.server_tree.pack(fill=tk.X)
         
-        self.stop_btn = ttk.Button(
-            control_frame, 
-            text="停止", 
-            command=self.stop_playback,
-            state=tk.DISABLED
+        self.probe_btn = ttk.Button(
+            ranking_frame,
+            text="立即测速",
+            command=self.server_prober.probe_now
         )
-        self.stop_btn.pack(fill=tk.X, pady=5)
+        self.probe_btn.pack(fill=tk.X, pady=(5, 0))
         
-        # 全屏控制按钮
-        self.fullscreen_btn = ttk.Button(
-            control_frame, 
-            text="进入全屏", 
-            command=self.enter_fullscreen,
-            state=tk.DISABLED
+        self.scan_btn = ttk.Button(
+            ranking_frame,
+            text="频道体检",
+            command=self.start_channel_scan
         )
-        self.fullscreen_btn.pack(fill=tk.X, pady=5)
+        self.scan_btn.pack(fill=tk.X, pady=(5, 0))
         
         # 添加自定义频道区域
         custom_frame = ttk.LabelFrame(self.left_panel, text="添加自定义频道", padding=10)
@@ -303,33 +5580,34 @@ class IPTVPlayer:
         self.add_channel_btn.pack(fill=tk.X, pady=5)
         
         # 右侧面板内容 - 频道列表
-        channel_frame = ttk.LabelFrame(self.right_panel, text="频道列表", padding=10)
-        channel_frame.pack(fill=tk.BOTH, expand=True)
-        
-        # 创建树形视图显示频道 - 修改为显示频道名称和播放地址两列
-        self.channel_tree = ttk.Treeview(
-            channel_frame, 
-            columns=("name", "url"),
-            show="headings",
-            selectmode="browse"
-        )
-        
-        # 设置列 - 显示频道名称和播放地址
-        self.channel_tree.heading("name", text="频道名称")
-        self.channel_tree.heading("url", text="播放地址")
+        self.channel_frame = ttk.LabelFrame(self.right_panel, text="频道列表", padding=10)
+        self.channel_frame.pack(fill=tk.BOTH, expand=True)
+        channel_frame = self.channel_frame
         
-        # 设置列宽
-        self.channel_tree.column("name", width=200, anchor=tk.W)
-        self.channel_tree.column("url", width=700, anchor=tk.W)
+        # 搜索框：按名称、拼音首字母或频道ID即时过滤
+        search_frame = ttk.Frame(channel_frame)
+        search_frame.pack(fill=tk.X, pady=(0, 5))
+        ttk.Label(search_frame, text="搜索:").pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        self.search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.search_var.trace_add("write", lambda *args: self.apply_channel_filter())
+        self.search_index = ChannelSearchIndex()
+        self.search_index_dirty = True  # 索引在首次搜索时才建立
         
-        # 添加滚动条
-        scrollbar = ttk.Scrollbar(channel_frame, orient=tk.VERTICAL, command=self.channel_tree.yview)
-        self.channel_tree.configure(yscroll=scrollbar.set)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.channel_tree.pack(fill=tk.BOTH, expand=True)
-        
-        # 绑定选择事件
-        self.channel_tree.bind("<<TreeviewSelect>>", self.on_channel_select)
+        # 虚拟化频道列表 - 显示频道名称、直播延迟和播放地址，只创建可见行
+        self.channel_view = VirtualChannelList(
+            channel_frame,
+            [
+                ("name", "频道名称", 200, tk.W),
+                ("delay", "延迟", 60, tk.E),
+                ("now", "正在播出", 180, tk.W),
+                ("next", "即将播出", 180, tk.W),
+                ("url", "播放地址", 640, tk.W),
+            ],
+            self.channel_row_values,
+            self.on_channel_select
+        )
         
         # 底部状态栏
         self.status_bar = ttk.Label(
@@ -341,35 +5619,74 @@ class IPTVPlayer:
         )
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
         
-        # 视频播放区域
-        self.video_frame = ttk.Frame(self.right_panel)
+        # 视频播放区域（多个画布叠放在同一位置，快速换台时只调整叠放顺序）
+        self.video_frame = ttk.Frame(self.right_panel, height=360)
         self.video_frame.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
         
-        # 创建VLC实例
-        self.instance = vlc.Instance("--no-xlib")
-        self.media_player = self.instance.media_player_new()
-        
-        # 创建画布用于显示视频
-        self.canvas = tk.Canvas(self.video_frame, bg="black")
-        self.canvas.pack(fill=tk.BOTH, expand=True)
-        
-        # 设置媒体播放器窗口
-        if sys.platform == "win32":
-            self.media_player.set_hwnd(self.canvas.winfo_id())
-        else:
-            self.media_player.set_xwindow(self.canvas.winfo_id())
+        # 创建画布用于显示视频（VLC播放器在首次播放时绑定）
+        self.canvas = self.create_video_canvas()
         
-        # 绑定双击事件用于切换全屏
-        self.canvas.bind("<Double-Button-1>", self.toggle_fullscreen)
         # 绑定ESC键退出全屏
         self.root.bind("<Escape>", self.exit_fullscreen)
         
+        # 快速换台引擎（预热相邻频道）
+        self.zapper = ChannelZapper(self, budget_kbps=self.options.zap_budget)
+        self.mosaic = None  # 多画面窗口
+        self.channel_view.tree.bind("<Up>", lambda event: self.zap(-1) or self.channel_view.move_selection(-1))
+        self.channel_view.tree.bind("<Down>", lambda event: self.zap(1) or self.channel_view.move_selection(1))
+        
+        # 启动直播延迟刷新
+        self.root.after(1000, self.update_live_delay)
+        
+        # 启动时间显示刷新
+        self.update_clock()
+        
+        # 启动节目单刷新
+        self.root.after(30000, self.refresh_epg_view)
+        
+        # 启动录制状态刷新
+        self.root.after(2000, self.refresh_recordings)
+    
+    def create_video_canvas(self):
+        """在视频区域创建一个铺满的画布"""
+        canvas = tk.Canvas(self.video_frame, bg="black", highlightthickness=0)
+        canvas.place(relx=0, rely=0, relwidth=1, relheight=1)
+        # 绑定双击事件用于切换全屏
+        canvas.bind("<Double-Button-1>", self.toggle_fullscreen)
         # 绑定画布大小改变事件
-        self.canvas.bind("<Configure>", self.on_canvas_resize)
+        canvas.bind("<Configure>", self.on_canvas_resize)
+        return canvas
+    
+    def attach_video_output(self, player, canvas):
+        """把VLC播放器的视频输出绑定到画布"""
+        if sys.platform == "win32":
+            player.set_hwnd(canvas.winfo_id())
+        else:
+            player.set_xwindow(canvas.winfo_id())
+    
+    def ensure_vlc(self):
+        """首次播放时创建VLC实例和主播放器"""
+        if self.instance is None:
+            started = time.perf_counter()
+            self.instance = vlc.Instance("--no-xlib")
+            self.media_player = self.instance.media_player_new()
+            self.attach_video_output(self.media_player, self.canvas)
+            STARTUP_PROFILE.record("创建VLC实例", started)
+        return self.instance
+    
+    def create_media(self, play_url, key=None):
+        """创建带统一播放选项的VLC媒体对象（网络缓存按服务器和频道自适应）"""
+        self.ensure_vlc()
+        media = self.instance.media_new(play_url)
         
-        # 启动时间更新线程
-        self.update_time_thread = threading.Thread(target=self.update_time_loop, daemon=True)
-        self.update_time_thread.start()
+        # 设置媒体选项
+        media.add_option(f":network-caching={self.network_caching(play_url, key or self.current_channel_key)}")
+        media.add_option(":clock-jitter=0")
+        media.add_option(":clock-synchro=0")
+        # Windows平台添加硬件加速选项
+        if sys.platform == "win32":
+            media.add_option(":avcodec-hw=dxva2")
+        return media
     
     def on_ntp_server_change(self, event):
         """NTP服务器选择改变事件"""
@@ -403,260 +5720,308 @@ class IPTVPlayer:
             
             self.update_status(f"已添加自定义NTP服务器: {custom_server}")
     
-    def create_fullscreen_window(self):
-        """创建全屏专用窗口 - 修复版本"""
-        if self.fullscreen_window:
+    def update_server_ranking(self, ranking):
+        """刷新服务器排名表"""
+        self.server_tree.delete(*self.server_tree.get_children())
+        for server, stat in ranking:
+            if stat["healthy"]:
+                values = (
+                    server,
+                    f"{stat['connect']:.0f}",
+                    f"{stat['ttfb']:.0f}",
+                    f"{stat['fetch']:.0f}",
+                    f"{stat['weight']:.0%}"
+                )
+            else:
+                values = (server, "-", "-", "-", "不可用")
+            self.server_tree.insert("", "end", values=values)
+    
+    def on_relay_toggle(self):
+        """切换本地中继"""
+        self.relay_enabled = self.relay_var.get()
+        if not self.relay_enabled:
+            self.relay_stats_label.config(text="")
             return
-            
-        # 创建新窗口
-        self.fullscreen_window = tk.Toplevel(self.root)
-        self.fullscreen_window.title("全屏播放")
-        self.fullscreen_window.attributes("-fullscreen", True)
-        self.fullscreen_window.configure(bg="black")
-        
-        # 创建全屏画布
-        self.fullscreen_canvas = tk.Canvas(
-            self.fullscreen_window, 
-            bg="black", 
-            highlightthickness=0
+        try:
+            server = self.ensure_local_server()
+        except OSError as e:
+            self.relay_var.set(False)
+            self.relay_enabled = False
+            messagebox.showerror("中继错误", f"无法启动本地中继:\n{str(e)}")
+            return
+        self.update_status(
+            f"本地中继已启动: {server.url('/hls/<频道ID>.m3u8')}，组播: {server.url('/udp/<组播地址>:<端口>')}"
         )
-        self.fullscreen_canvas.pack(fill=tk.BOTH, expand=True)
-        
-        # 绑定退出全屏事件
-        self.fullscreen_canvas.bind("<Double-Button-1>", self.exit_fullscreen)
-        self.fullscreen_window.bind("<Escape>", self.exit_fullscreen)
+        self.update_relay_stats()
+    
+    def update_relay_stats(self):
+        """定时刷新中继统计"""
+        if not self.relay_var.get() or not self.hls_relay:
+            return
+        stats = self.hls_relay.snapshot()
+        self.relay_stats_label.config(
+            text=f"中继命中率 {stats['hit_ratio']:.0%}，节省上游 {stats['bytes_saved'] / 1048576:.1f} MB"
+        )
+        self.root.after(2000, self.update_relay_stats)
+    
+    def on_timeshift_toggle(self):
+        """切换本地时移"""
+        enabled = self.timeshift_var.get()
+        if enabled:
+            try:
+                self.ensure_local_server()
+            except OSError as e:
+                self.timeshift_var.set(False)
+                messagebox.showerror("时移错误", f"无法启动本地HTTP服务:\n{str(e)}")
+                return
+            # 时移与快速换台的预热播放不能同时使用
+            if self.zap_var.get():
+                self.zap_var.set(False)
+                self.on_zap_toggle()
+        self.timeshift_enabled = enabled
+        state = tk.NORMAL if enabled else tk.DISABLED
+        for button in (self.timeshift_back_btn, self.timeshift_pause_btn, self.timeshift_live_btn):
+            button.config(state=state)
+        self.zap_check.config(state=tk.DISABLED if enabled else tk.NORMAL)
+        if not enabled:
+            self.timeshift_label.config(text="")
+            self.background.call(self.timeshift.stop)
+        # 正在播放时按新的方式重新起播
+        if self.is_playing and self.current_channel is not None:
+            self.play_channel()
+    
+    def timeshift_seek(self, seconds):
+        """时移后退seconds秒，None表示回到直播"""
+        if not self.is_playing or not self.uses_timeshift(self.current_channel_template):
+            return
+        if seconds is None:
+            self.timeshift_behind = 0
+        else:
+            window = self.timeshift.window_seconds() or 0.0
+            self.timeshift_behind = min(self.timeshift_behind + seconds, max(window - 10, 0))
+        self._replay_timeshift()
+    
+    def timeshift_pause(self):
+        """暂停/继续：继续时从暂停的位置接着播放（落后直播的时间加上暂停时长）"""
+        if not self.is_playing or not self.uses_timeshift(self.current_channel_template):
+            return
+        if self.timeshift_paused_at is None:
+            self.media_player.set_pause(1)
+            self.timeshift_paused_at = time.monotonic()
+            self.timeshift_pause_btn.config(text="继续")
+        else:
+            self.timeshift_behind += time.monotonic() - self.timeshift_paused_at
+            self._replay_timeshift()
+    
+    def _replay_timeshift(self):
+        """用新的时移位置重新打开本地播放列表（数据都在本地，无需重新缓冲上游）"""
+        self.timeshift_paused_at = None
+        self.timeshift_pause_btn.config(text="暂停")
+        play_url = self.timeshift_url(self.current_channel_key, self.timeshift_behind)
+        self._start_playback(play_url, self.current_channel_template, self.current_channel_name)
+    
+    def update_timeshift_label(self):
+        """显示时移位置和可回看的时长"""
+        if not self.timeshift_enabled or not self.timeshift:
+            return
+        window = self.timeshift.window_seconds()
+        if window is None:
+            return
+        behind = self.timeshift_behind
+        if self.timeshift_paused_at is not None:
+            behind += time.monotonic() - self.timeshift_paused_at
+        self.timeshift_label.config(
+            text=f"落后直播 {behind:.0f} 秒，可回看 {window:.0f} 秒"
+        )
+    
+    def on_zap_toggle(self):
+        """切换快速换台"""
+        self.zapper.enabled = self.zap_var.get()
+        if self.zapper.enabled:
+            self.zapper.schedule_refresh()
+            self.update_status(f"快速换台已开启，带宽预算 {self.zapper.budget_kbps} kbps - 在频道列表中按上下键换台")
+        else:
+            self.zapper.clear()
+    
+    def open_mosaic(self):
+        """打开多画面窗口，从选中的频道开始显示"""
+        if self.mosaic is not None:
+            self.mosaic.window.lift()
+            return
+        if not self.channel_view.rows:
+            messagebox.showwarning("多画面", "频道列表为空")
+            return
+        rows = self.channel_view.rows
+        start = rows.index(self.channel_view.selected) if self.channel_view.selected in rows else 0
+        # 预热播放器让出解码器
+        self.zapper.clear()
+        self.mosaic = MosaicView(self, start=start)
+    
+    def neighbor_channel_keys(self, key):
+        """按当前显示顺序（搜索过滤后）返回上下相邻的频道标识（下一个在前）"""
+        rows = self.channel_view.rows
+        if len(rows) < 2 or key not in self.channel_positions:
+            return []
+        try:
+            position = rows.index(self.channel_positions[key])
+        except ValueError:
+            return super().neighbor_channel_keys(key)
+        return [
+            self.channel_key(self.channel_list[rows[(position + 1) % len(rows)]]),
+            self.channel_key(self.channel_list[rows[(position - 1) % len(rows)]]),
+        ]
+    
+    def zap(self, step):
+        """上下换台（开启快速换台且正在播放时生效，否则保持列表默认的按键行为）"""
+        if not self.zapper.enabled or not self.is_playing:
+            return None
+        neighbors = self.neighbor_channel_keys(self.current_channel_key)
+        if not neighbors:
+            return "break"
+        self.channel_view.select(self.channel_positions[neighbors[0] if step > 0 else neighbors[1]])
+        self.play_channel()
+        return "break"
+    
+    def update_live_delay(self):
+        """定时刷新当前频道的直播延迟，并更新频道列表中的延迟列"""
+        key = self.current_channel_key
+        delay = self.channel_delays.get(key)
+        if self.is_playing and delay is not None:
+            self.delay_label.config(text=f"直播延迟: {delay:.1f} 秒（{self.current_channel_name}）")
+        else:
+            self.delay_label.config(text="")
+        self.update_timeshift_label()
+        # 只重绘可见行
+        self.channel_view.render()
+        self.root.after(1000, self.update_live_delay)
+    
+    def enter_fullscreen(self):
+        """进入全屏模式：只隐藏其它控件并放大主窗口，视频画布、解码器和网络连接保持不变"""
+        if not self.is_playing or not self.media_player or self.is_fullscreen:
+            return
         
-        # 绑定画布大小改变事件
-        self.fullscreen_canvas.bind("<Configure>", self.on_canvas_resize)
+        self._fullscreen_started = time.perf_counter()
+        self.is_fullscreen = True
         
-        # 窗口关闭事件处理
-        self.fullscreen_window.protocol("WM_DELETE_WINDOW", self.exit_fullscreen)
+        # 隐藏控制面板、频道列表和状态栏，视频区域铺满窗口
+        self.left_panel.pack_forget()
+        self.channel_frame.pack_forget()
+        self.status_bar.pack_forget()
+        self.main_frame.configure(padding=0)
+        self.right_panel.configure(padding=0)
+        self.video_frame.pack_configure(pady=0)
+        self.root.attributes("-fullscreen", True)
+        self.canvas.focus_set()
         
-        # 隐藏窗口初始状态
-        self.fullscreen_window.withdraw()
+        # 画布尺寸变化时（on_canvas_resize）记录切换耗时；尺寸未变时由定时器兜底
+        self.root.after(500, self._finish_fullscreen_switch, "进入全屏", self._fullscreen_started)
     
-    def enter_fullscreen(self):
-        """进入全屏模式 - 修复版本"""
-        if not self.is_playing or not self.media_player:
+    def exit_fullscreen(self, event=None):
+        """退出全屏模式：恢复窗口布局，播放不中断"""
+        if not self.is_fullscreen:
             return
-            
-        # 确保全屏窗口已创建
-        if not self.fullscreen_window:
-            self.create_fullscreen_window()
-            
-        # 显示全屏窗口
-        self.fullscreen_window.deiconify()
         
-        # 添加延迟确保窗口完全创建
-        self.fullscreen_window.update_idletasks()
-        self.fullscreen_window.update()
-        time.sleep(0.1)
+        self._fullscreen_started = time.perf_counter()
+        self.is_fullscreen = False
         
-        try:
-            # 停止当前播放
-            self.media_player.stop()
-            
-            # 将视频播放器切换到全屏窗口
-            if sys.platform == "win32":
-                self.media_player.set_hwnd(self.fullscreen_canvas.winfo_id())
-            else:
-                self.media_player.set_xwindow(self.fullscreen_canvas.winfo_id())
-            
-            # 重新生成播放URL（使用新的时间戳）
-            play_url = self.generate_play_url(self.current_channel_template)
-            
-            # 创建新的媒体对象（使用新的时间戳）
-            media = self.instance.media_new(play_url)
-            
-            # 设置媒体选项
-            media.add_option(":network-caching=300")
-            media.add_option(":clock-jitter=0")
-            media.add_option(":clock-synchro=0")
-            # Windows平台添加硬件加速选项
-            if sys.platform == "win32":
-                media.add_option(":avcodec-hw=dxva2")
-            
-            # 设置媒体播放器
-            self.media_player.set_media(media)
-            
-            # 开始播放
-            if self.media_player.play() == -1:
-                raise Exception("VLC播放失败")
-            
-            # 更新当前媒体对象
-            self.current_media = media
-            
-            # 隐藏主窗口
-            self.root.withdraw()
-            
-            self.update_status("已进入全屏模式 - 双击画面或按ESC键退出")
-            
-        except Exception as e:
-            print(f"设置全屏失败: {e}")
-            self.update_status(f"全屏设置错误: {e}")
-            # 出错时恢复主窗口
-            self.root.deiconify()
-            self.fullscreen_window.withdraw()
+        self.root.attributes("-fullscreen", False)
+        self.main_frame.configure(padding=10)
+        self.right_panel.configure(padding=10)
+        self.left_panel.pack(side=tk.LEFT, fill=tk.BOTH, expand=False, before=self.right_panel)
+        self.channel_frame.pack(fill=tk.BOTH, expand=True, before=self.video_frame)
+        self.video_frame.pack_configure(pady=(10, 0))
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        
+        self.root.after(500, self._finish_fullscreen_switch, "退出全屏", self._fullscreen_started)
     
-    def exit_fullscreen(self, event=None):
-        """退出全屏模式 - 修复版本"""
-        if not self.fullscreen_window:
+    def _finish_fullscreen_switch(self, action, started=None):
+        """记录全屏切换耗时（从发起切换到视频画布完成重新布局）"""
+        if self._fullscreen_started is None:
             return
-            
-        try:
-            # 停止当前播放
-            self.media_player.stop()
-            
-            # 显示主窗口
-            self.root.deiconify()
-            self.root.update_idletasks()
-            self.root.update()
-            time.sleep(0.1)
-            
-            # 将视频播放器切回主窗口
-            if sys.platform == "win32":
-                self.media_player.set_hwnd(self.canvas.winfo_id())
-            else:
-                self.media_player.set_xwindow(self.canvas.winfo_id())
-            
-            # 重新生成播放URL（使用新的时间戳）
-            play_url = self.generate_play_url(self.current_channel_template)
-            
-            # 创建新的媒体对象（使用新的时间戳）
-            media = self.instance.media_new(play_url)
-            
-            # 设置媒体选项
-            media.add_option(":network-caching=300")
-            media.add_option(":clock-jitter=0")
-            media.add_option(":clock-synchro=0")
-            # Windows平台添加硬件加速选项
-            if sys.platform == "win32":
-                media.add_option(":avcodec-hw=dxva2")
-            
-            # 设置媒体播放器
-            self.media_player.set_media(media)
-            
-            # 开始播放
-            if self.media_player.play() == -1:
-                raise Exception("VLC播放失败")
-            
-            # 更新当前媒体对象
-            self.current_media = media
-            
-            # 隐藏全屏窗口
-            self.fullscreen_window.withdraw()
-            
-            self.update_status("已退出全屏模式")
-            
-        except Exception as e:
-            print(f"退出全屏失败: {e}")
-            self.update_status(f"退出全屏错误: {e}")
-            # 出错时确保主窗口可见
-            self.root.deiconify()
+        if started is not None and started != self._fullscreen_started:
+            # 兜底定时器属于更早的一次切换
+            return
+        elapsed = (time.perf_counter() - self._fullscreen_started) * 1000
+        self._fullscreen_started = None
+        self.fullscreen_latencies.append(elapsed)
+        del self.fullscreen_latencies[:-20]
+        if self.is_fullscreen:
+            self.update_status(f"已{action}（{elapsed:.0f} ms）- 双击画面或按ESC键退出")
+        else:
+            self.update_status(f"已{action}（{elapsed:.0f} ms）")
     
     def toggle_fullscreen(self, event=None):
-        """切换全屏模式 - 修复版本"""
-        if not self.is_playing or not self.media_player:
-            return
-            
-        # 检查当前是否已在全屏模式
-        if self.fullscreen_window and self.fullscreen_window.winfo_viewable():
+        """切换全屏模式"""
+        if self.is_fullscreen:
             self.exit_fullscreen()
         else:
             self.enter_fullscreen()
     
     def on_canvas_resize(self, event):
-        """当画布大小改变时重绘视频"""
+        """当画布大小改变时重绘视频，并结束全屏切换计时"""
+        if self._fullscreen_started is not None and event.widget is self.canvas:
+            self._finish_fullscreen_switch("进入全屏" if self.is_fullscreen else "退出全屏")
         if self.is_playing and self.media_player:
             try:
                 self.media_player.video_update_viewport()
             except:
                 pass
     
-    def update_time_loop(self):
-        """更新时间显示循环"""
-        while True:
-            # 获取当前本地时间
-            local_now = datetime.datetime.now()
-            self.root.after(0, lambda: self.local_time.config(
-                text=local_now.strftime("%Y-%m-%d %H:%M:%S")
-            ))
-            
-            # 获取当前UTC时间（使用带时区的时间对象）
-            utc_now = datetime.datetime.now(timezone.utc)
-            self.root.after(0, lambda: self.utc_time.config(
-                text=utc_now.strftime("%Y-%m-%d %H:%M:%S") + " UTC"
-            ))
-            
-            time.sleep(1)
-    
-    def load_demo_data(self):
-        """加载演示数据"""
-        # 添加演示服务器
-        self.server_list = [
-            "124.232.231.172:8089",
-            "218.76.205.6:6410",
-            "218.76.205.7:6410",
-            "218.76.205.9:6410"
-        ]
-        
-        # 添加演示频道（已使用占位符）
-        demo_channels = [
-            ("CCTV1 高清", "http://{server}/000000002000/201500000063/1000.m3u8?starttime={timestamp}"),
-            ("湖南卫视", "http://{server}/000000002000/201500000067/1000.m3u8?starttime={timestamp}"),
-            ("浙江卫视", "http://{server}/000000002000/201500000064/1000.m3u8?starttime={timestamp}"),
-            ("测试 RTP 流", "rtp://239.76.253.151:9000"),
-            ("测试 RTP 转", "http://192.168.1.1:7088/udp/239.76.253.151:9000")
-        ]
+    def update_clock(self):
+        """刷新时间显示（在主循环中每秒对齐到整秒执行一次）"""
+        local_now = datetime.datetime.now()
+        self.local_time.config(text=local_now.strftime("%Y-%m-%d %H:%M:%S"))
         
-        for name, url in demo_channels:
-            self.channel_list.append({"name": name, "url": url})
-            # 插入频道名称和播放地址到树形视图
-            self.channel_tree.insert("", "end", values=(name, url))
+        # 获取当前UTC时间（使用带时区的时间对象）
+        utc_now = datetime.datetime.now(timezone.utc)
+        self.utc_time.config(text=utc_now.strftime("%Y-%m-%d %H:%M:%S") + " UTC")
         
-        self.update_status(f"已加载 {len(demo_channels)} 个演示频道")
+        self.root.after(1000 - local_now.microsecond // 1000, self.update_clock)
     
-    def sync_time(self):
-        """同步时间"""
-        self.sync_btn.config(state=tk.DISABLED, text="同步中...")
-        self.update_status("正在同步时间...")
-        
-        # 在新线程中执行同步
-        threading.Thread(target=self._sync_time_thread, daemon=True).start()
+    def start_channel_scan(self):
+        """检测全部频道在各服务器上能否播放，结果导出为CSV或JSON"""
+        output_path = filedialog.asksaveasfilename(
+            title="保存体检结果",
+            defaultextension=".csv",
+            filetypes=[("CSV文件", "*.csv"), ("JSON文件", "*.json")]
+        )
+        if not output_path:
+            return
+        self.scan_btn.config(state=tk.DISABLED)
+        self.update_status("正在体检频道...")
+        threading.Thread(target=self._channel_scan_thread, args=(output_path,), daemon=True).start()
     
-    def _sync_time_thread(self):
-        """时间同步线程"""
+    def _channel_scan_thread(self, output_path):
+        """频道体检线程"""
+        def progress(done, total):
+            self.notify_status(f"正在体检频道: {done}/{total}")
+        
         try:
-            client = ntplib.NTPClient()
-            # 使用当前选择的NTP服务器
-            response = client.request(self.current_ntp_server, version=3)
-            self.ntp_offset = response.offset
-            
-            # 更新UI
-            self.root.after(0, lambda: self.update_status(
-                f"时间同步成功! NTP服务器: {self.current_ntp_server}, 偏移: {self.ntp_offset:.3f}秒"
-            ))
+            scanner = self.scan_channels(progress)
+            scanner.export(output_path)
+            summary = scanner.summary()
+            message = (
+                f"用时 {scanner.elapsed:.1f} 秒，正常 {summary.get('ok', 0)} 项，"
+                f"失败 {summary.get('error', 0)} 项，跳过 {summary.get('skipped', 0)} 项\n结果已保存到 {output_path}"
+            )
+            self.ui.call(self._finish_channel_scan, "频道体检完成", message)
         except Exception as e:
-            self.root.after(0, lambda: self.update_status(f"时间同步失败: {str(e)}"))
-        finally:
-            self.root.after(0, lambda: self.sync_btn.config(state=tk.NORMAL, text="同步时间"))
+            self.ui.call(self._finish_channel_scan, "频道体检失败", f"体检出错: {e}")
     
-    def get_utc_timestamp(self):
-        """获取UTC时间戳（格式：20250705T142312.00Z）"""
-        # 获取当前UTC时间（使用带时区的时间对象）
-        utc_now = datetime.datetime.now(timezone.utc)
-        
-        # 应用NTP偏移
-        corrected_utc = utc_now + datetime.timedelta(seconds=self.ntp_offset)
-        
-        # 格式化为所需格式
-        return corrected_utc.strftime("%Y%m%dT%H%M%S.00Z")
+    def _finish_channel_scan(self, title, message):
+        self.scan_btn.config(state=tk.NORMAL)
+        self.update_status(title)
+        messagebox.showinfo(title, message)
     
     def import_file(self, file_type):
         """导入文件"""
+        if file_type == "channel":
+            filetypes = [("频道列表", "*.txt *.m3u *.m3u8 *.csv"), ("所有文件", "*.*")]
+        else:
+            filetypes = [("文本文件", "*.txt"), ("所有文件", "*.*")]
         file_path = filedialog.askopenfilename(
             title=f"选择{file_type}文件",
-            filetypes=[("文本文件", "*.txt"), ("所有文件", "*.*")]
+            filetypes=filetypes
         )
         
         if not file_path:
@@ -670,16 +6035,6 @@ class IPTVPlayer:
         except Exception as e:
             messagebox.showerror("导入错误", f"导入文件时出错:\n{str(e)}")
     
-    def convert_url(self, original_url):
-        """将URL中的服务器地址和时间戳替换为占位符"""
-        # 替换服务器地址
-        converted_url = re.sub(r'http://[^/]+', 'http://{server}', original_url)
-        
-        # 替换时间戳
-        converted_url = re.sub(r'starttime=\d{8}T\d{6}\.\d{2}Z', 'starttime={timestamp}', converted_url)
-        
-        return converted_url
-    
     def import_server_file(self, file_path):
         """导入服务器列表文件"""
         with open(file_path, "r", encoding="utf-8") as f:
@@ -691,41 +6046,138 @@ class IPTVPlayer:
             self.current_server = self.server_list[0]
             messagebox.showinfo("导入成功", f"成功导入 {len(self.server_list)} 个服务器")
             self.update_status(f"已导入 {len(self.server_list)} 个服务器")
+            self.server_prober.probe_now()
         else:
             messagebox.showwarning("导入失败", "文件中没有有效的服务器地址")
         self.save_server_config()  # 导入后保存
     
     def import_channel_file(self, file_path):
-        """导入频道列表文件"""
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            
-        imported_count = 0
+        """导入频道列表文件（TXT/M3U/CSV），在后台线程中解析和写入，界面显示进度"""
+        self.import_channel_btn.config(state=tk.DISABLED)
+        self.update_status(f"正在导入频道: {os.path.basename(file_path)}")
+        threading.Thread(target=self._import_channel_thread, args=(file_path,), daemon=True).start()
+    
+    def _import_channel_thread(self, file_path):
+        """频道导入线程"""
+        def progress(done, total, added, skipped):
+            percent = done * 100 // total if total else 100
+            self.notify_status(f"正在导入频道: {percent}%，新增 {added} 个，跳过 {skipped} 个重复频道")
         
-        # 跳过第一行标题行
-        for line in lines[1:]:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # 检查格式：频道名\t播放地址
-            if "\t" in line:
-                parts = line.split("\t", 1)
-                if len(parts) == 2:
-                    name, url = parts
-                    # 转换URL格式
-                    converted_url = self.convert_url(url)
-                    self.channel_list.append({"name": name, "url": converted_url})
-                    # 插入频道名称和转换后的播放地址到树形视图
-                    self.channel_tree.insert("", "end", values=(name, converted_url))
-                    imported_count += 1
-        
-        if imported_count > 0:
-            messagebox.showinfo("导入成功", f"成功导入 {imported_count} 个频道")
-            self.update_status(f"已导入 {imported_count} 个频道")
+        try:
+            added, skipped = self.import_channels(file_path, progress)
+            self.ui.call(self._finish_channel_import, added, skipped)
+        except Exception as e:
+            self.ui.call(self._finish_channel_import, 0, 0, str(e))
+    
+    def _finish_channel_import(self, added, skipped, error=None):
+        """导入结束后刷新列表并提示结果（界面线程）"""
+        self.import_channel_btn.config(state=tk.NORMAL)
+        self.refresh_channel_tree()
+        if error:
+            messagebox.showerror("导入错误", f"导入文件时出错:\n{error}")
+            self.update_status("导入失败（出错前已写入的频道保留）")
+        elif added > 0:
+            messagebox.showinfo("导入成功", f"成功导入 {added} 个频道，跳过 {skipped} 个重复频道")
+            self.update_status(f"已导入 {added} 个频道，跳过 {skipped} 个重复频道")
+        elif skipped:
+            messagebox.showinfo("导入完成", f"文件中的 {skipped} 个频道均已存在")
         else:
             messagebox.showwarning("导入失败", "文件中没有有效的频道数据")
-        self.save_channel_config()  # 导入后保存
+    
+    def import_epg_file(self):
+        """导入XMLTV节目单，在后台线程中流式解析"""
+        file_path = filedialog.askopenfilename(
+            title="选择节目单文件",
+            filetypes=[("XMLTV节目单", "*.xml *.xml.gz *.gz"), ("所有文件", "*.*")]
+        )
+        if not file_path:
+            return
+        self.import_epg_btn.config(state=tk.DISABLED)
+        self.update_status(f"正在导入节目单: {os.path.basename(file_path)}")
+        threading.Thread(target=self._import_epg_thread, args=(file_path,), daemon=True).start()
+    
+    def _import_epg_thread(self, file_path):
+        """节目单导入线程"""
+        def progress(count):
+            self.notify_status(f"正在导入节目单: 已解析 {count} 个节目")
+        
+        try:
+            count = self.load_epg(file_path, progress)
+            matched = sum(1 for channel in self.channel_list if self.epg.resolve(channel) is not None)
+            self.ui.call(self._finish_epg_import, f"已导入 {count} 个节目，{matched}/{len(self.channel_list)} 个频道有节目信息")
+        except Exception as e:
+            self.ui.call(self._finish_epg_import, f"导入节目单失败: {e}")
+    
+    def _finish_epg_import(self, message):
+        self.import_epg_btn.config(state=tk.NORMAL)
+        self.update_status(message)
+    
+    def on_epg_loaded(self):
+        self.ui.update("channel_view", self.channel_view.render)
+    
+    def refresh_epg_view(self):
+        """每30秒刷新可见行的正在播出信息"""
+        if self.epg.programs:
+            self.channel_view.render()
+        self.root.after(30000, self.refresh_epg_view)
+    
+    def selected_channel_key(self):
+        """频道列表中选中频道的标识，未选中时返回None"""
+        if self.current_channel is None or self.current_channel >= len(self.channel_list):
+            return None
+        return self.channel_key(self.channel_list[self.current_channel])
+    
+    def toggle_recording(self):
+        """开始录制选中频道，已在录制则停止"""
+        key = self.selected_channel_key()
+        if key is None:
+            messagebox.showwarning("录制", "请先选择频道")
+            return
+        active = self.recorder.active(key) if self.recorder else []
+        if active:
+            for rec in active:
+                self.stop_recording(rec["id"])
+            self.update_status(f"已停止录制: {active[0]['name']}")
+        else:
+            try:
+                rec = self.start_recording(key)
+            except (KeyError, ValueError, OSError) as e:
+                messagebox.showerror("录制", str(e))
+                return
+            self.update_status(f"开始录制: {rec['name']}")
+        self.refresh_recordings(reschedule=False)
+    
+    def record_next_program(self):
+        """按节目单预约录制选中频道的下一个节目"""
+        key = self.selected_channel_key()
+        if key is None:
+            messagebox.showwarning("录制", "请先选择频道")
+            return
+        try:
+            rec = self.record_program(key, "next")
+        except (KeyError, ValueError, OSError) as e:
+            messagebox.showerror("录制", str(e))
+            return
+        start = time.strftime("%H:%M", time.localtime(rec["start_at"]))
+        self.update_status(f"已预约录制: {rec['name']} {rec['program']}（{start} 开始）")
+        self.refresh_recordings(reschedule=False)
+    
+    def refresh_recordings(self, reschedule=True):
+        """每2秒刷新录制状态和按钮文字"""
+        active = self.recorder.active() if self.recorder else []
+        recording = [rec for rec in active if rec["state"] == "recording"]
+        scheduled = len(active) - len(recording)
+        parts = []
+        if recording:
+            parts.append(f"录制中 {len(recording)} 路")
+        if scheduled:
+            parts.append(f"预约 {scheduled} 个")
+        self.record_label.config(text="，".join(parts))
+        key = self.selected_channel_key()
+        recording_selected = key is not None and any(rec["channel"] == key for rec in active)
+        self.record_btn.config(text="停止录制选中频道" if recording_selected else "录制选中频道")
+        if reschedule:
+            self.root.after(2000, self.refresh_recordings)
     
     def add_custom_channel(self):
         """添加自定义频道"""
@@ -743,38 +6195,38 @@ class IPTVPlayer:
         # 转换URL格式
         converted_url = self.convert_url(url)
         
-        # 添加到列表和树形视图
-        self.channel_list.append({"name": name, "url": converted_url})
-        # 插入频道名称和播放地址到树形视图
-        self.channel_tree.insert("", "end", values=(name, converted_url))
+        # 写入频道库并刷新显示
+        added = self.add_channels([{"name": name, "url": converted_url}])
+        if not added:
+            messagebox.showwarning("添加失败", "该播放地址的频道已存在")
+            return
+        if not self.search_index_dirty:
+            self.search_index.add(added[0])
+        self.apply_channel_filter()
         
         # 清空输入框
         self.channel_name_entry.delete(0, tk.END)
         self.channel_url_entry.delete(0, tk.END)
         
         self.update_status(f"已添加频道: {name}")
-        self.save_channel_config()  # 添加后保存
     
-    def on_channel_select(self, event):
-        """频道选择事件"""
-        selected = self.channel_tree.selection()
-        if selected:
+    def on_channel_select(self, index):
+        """频道选择事件（index为频道列表索引，None表示取消选中）"""
+        if index is not None:
             self.play_btn.config(state=tk.NORMAL)
-            # 获取选中的项目
-            self.current_channel = self.channel_tree.item(selected[0])
+            # 保存选中的频道索引
+            self.current_channel = index
         else:
             self.play_btn.config(state=tk.DISABLED)
             self.current_channel = None
     
     def play_channel(self):
         """播放选中的频道"""
-        if not self.current_channel:
+        if self.current_channel is None:
             return
         
-        # 获取选中的行索引
-        selected_item = self.channel_tree.selection()[0]
         # 获取频道信息（使用列表索引）
-        index = self.channel_tree.index(selected_item)
+        index = self.current_channel
         channel_info = self.channel_list[index]
         channel_name = channel_info["name"]
         channel_url = channel_info["url"]
@@ -782,32 +6234,61 @@ class IPTVPlayer:
         # 保存频道模板和名称
         self.current_channel_template = channel_url
         self.current_channel_name = channel_name
+        self.current_channel_key = self.channel_key(channel_info)
         
-        # 生成播放URL
-        play_url = self.generate_play_url(channel_url)
+        key = self.current_channel_key
+        if self.uses_timeshift(channel_url):
+            # 时移：从本地缓冲的直播边缘开始（首次播放该频道时开始录制）
+            self.timeshift_behind = 0
+            self._start_playback(self.timeshift_url(key), channel_url, channel_name)
+            return
         
-        # 检查服务器可用性
-        if not self.check_server_available(play_url):
-            # 如果检查失败，仍然尝试播放（因为有时检查方法可能误报）
-            self.update_status(f"服务器检查失败，但仍尝试播放: {channel_name}")
-        else:
-            self.update_status(f"服务器可用，正在播放: {channel_name}")
+        slot = self.zapper.take(key)
+        if slot is not None:
+            # 已预热的频道：直接切换画面
+            started = time.perf_counter()
+            self._begin_session(channel_name, slot["media"].get_mrl() if slot["media"] else "")
+            self.zapper.activate(slot)
+            self._watch_player(self.media_player)
+            # 预热频道已经在出画面，首帧时间即切换耗时
+            self.session["ttff"] = time.perf_counter() - started
+            self.update_status(
+                f"正在播放: {channel_name}（预热换台 {(time.perf_counter() - started) * 1000:.0f} ms）"
+            )
+            self.zapper.schedule_refresh()
+            return
+        
+        if self.needs_live_edge_measure(channel_url, key):
+            # 首次播放该频道时先在后台定位直播边缘，完成后再起播
+            self.update_status(f"正在定位直播边缘: {channel_name}")
+            
+            def measure_thread():
+                play_url = self.resolve_play_url(channel_url, key)
+                self.ui.call(self._start_pending_playback, play_url, channel_url, channel_name, key)
+            
+            threading.Thread(target=measure_thread, daemon=True).start()
+            return
         
+        # 生成播放URL
+        play_url = self.build_play_url(channel_url, key)
+        self._start_playback(play_url, channel_url, channel_name)
+    
+    def _start_pending_playback(self, play_url, channel_url, channel_name, key):
+        """后台准备完成后起播（期间用户已切换频道则放弃）"""
+        if key != self.current_channel_key:
+            return
+        self._start_playback(play_url, channel_url, channel_name)
+    
+    def _start_playback(self, play_url, channel_url, channel_name):
+        """用生成好的地址开始播放"""
+        self._begin_session(channel_name, play_url)
         try:
             # 停止当前播放
             if self.is_playing:
                 self.media_player.stop()
             
             # 创建媒体对象
-            self.current_media = self.instance.media_new(play_url)
-            
-            # 设置媒体选项
-            self.current_media.add_option(":network-caching=300")
-            self.current_media.add_option(":clock-jitter=0")
-            self.current_media.add_option(":clock-synchro=0")
-            # Windows平台添加硬件加速选项
-            if sys.platform == "win32":
-                self.current_media.add_option(":avcodec-hw=dxva2")
+            self.current_media = self.create_media(play_url)
             
             # 设置媒体播放器
             self.media_player.set_media(self.current_media)
@@ -816,42 +6297,33 @@ class IPTVPlayer:
             if self.media_player.play() == -1:
                 raise Exception("VLC播放失败")
             
+            self._watch_player(self.media_player)
             self.is_playing = True
             self.stop_btn.config(state=tk.NORMAL)
             self.fullscreen_btn.config(state=tk.NORMAL)  # 启用全屏按钮
             self.update_status(f"正在播放: {channel_name} - 双击画面或按ESC键切换全屏")
+            if self.zapper.enabled:
+                self.zapper.schedule_refresh()
+            
+            # 播放开始后在后台检查服务器可用性，不阻塞界面（走中继时检查上游服务器）
+            verify_url = play_url
+            if self.http_server and play_url.startswith(self.http_server.url("/")):
+                verify_url = self.generate_play_url(channel_url)
+            threading.Thread(
+                target=self._verify_server_thread,
+                args=(verify_url, channel_name),
+                daemon=True
+            ).start()
             
         except Exception as e:
             self.is_playing = False
             messagebox.showerror("播放错误", f"无法播放频道:\n{str(e)}\nURL: {play_url}")
             self.update_status("播放失败")
     
-    def generate_play_url(self, template_url):
-        """生成播放URL - 优化版本"""
-        # 获取UTC时间戳
-        timestamp = self.get_utc_timestamp()
-        
-        # 如果URL中包含{server}占位符，则替换为当前服务器
-        if "{server}" in template_url:
-            if not self.server_list:
-                messagebox.showwarning("服务器错误", "没有可用的服务器，请先导入服务器列表")
-                return template_url
-            
-            # 随机选择一个服务器
-            import random
-            server = random.choice(self.server_list)
-            template_url = template_url.replace("{server}", server)
-        
-        # 替换时间戳占位符
-        if "{timestamp}" in template_url:
-            template_url = template_url.replace("{timestamp}", timestamp)
-        
-        # 打印生成的URL用于调试
-        print(f"生成的播放URL: {template_url}")
-        return template_url
-    
     def stop_playback(self):
         """停止播放"""
+        self.zapper.clear()
+        self._end_session()
         if self.is_playing:
             self.media_player.stop()
             self.is_playing = False
@@ -861,29 +6333,286 @@ class IPTVPlayer:
             self.current_media = None
             self.current_channel_template = ""
             self.current_channel_name = ""
+            self.current_channel_key = ""
             
             # 如果全屏中，退出全屏
-            if self.fullscreen_window and self.fullscreen_window.winfo_viewable():
+            if self.is_fullscreen:
                 self.exit_fullscreen()
     
+    # ---- 播放会话指标 ----
+    
+    def _begin_session(self, channel_name, play_url):
+        """开始一个播放会话（结束上一个）"""
+        self._end_session()
+        server = self.play_server(play_url) or urllib.parse.urlsplit(play_url).netloc
+        caching = self.network_caching(play_url, self.current_channel_key)
+        started = time.perf_counter()
+        self.session = {
+            "channel": channel_name,
+            "key": self.current_channel_key,
+            "server": server,
+            "url": play_url,
+            "caching": caching,
+            "started": started,
+            "start_offset": self.starttime_offset(play_url),
+            "ttff": None,
+            "ttff_logged": False,
+            "buffering": False,
+            "buffering_since": None,
+            "buffering_events": 0,
+            "read_bytes": 0,
+            "progress": started,  # 最近一次收到新数据的时刻
+            "tried": set(),  # 本次观看中已失败的服务器
+            "failover": None,  # 由故障切换发起的会话：{"from", "reason", "detected"}
+            "exhausted": False,  # 所有服务器都已尝试过
+            "errors": 0,
+            "samples": 0,
+            "stats": {},
+        }
+        self.metrics.clear("iptv_playback_")
+        self.metrics.inc("iptv_sessions_total")
+        self.metrics.set("iptv_playback_network_caching_ms", caching, channel=channel_name, server=server)
+        self.log_event("session_start", channel=channel_name, server=server, url=play_url, caching=caching)
+    
+    def _end_session(self):
+        """结束当前播放会话并写入汇总"""
+        session = self.session
+        if session is None:
+            return
+        self.session = None
+        duration = time.perf_counter() - session["started"]
+        self.log_event(
+            "session_end",
+            channel=session["channel"],
+            server=session["server"],
+            duration=round(duration, 1),
+            ttff=session["ttff"],
+            caching=session["caching"],
+            buffering_events=session["buffering_events"],
+            errors=session["errors"],
+            **session["stats"]
+        )
+        if session["ttff"] is not None:
+            # 出过画面的会话才用来调整网络缓存
+            self.caching_tuner.record(session["server"], session["key"], duration, session["buffering_events"])
+    
+    def _watch_player(self, player):
+        """订阅播放器的首帧、缓冲和错误事件（每个播放器只订阅一次）"""
+        if player in self._watched_players:
+            return
+        self._watched_players.add(player)
+        events = player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerVout, lambda event: self._on_vlc_vout(player))
+        events.event_attach(
+            vlc.EventType.MediaPlayerBuffering,
+            lambda event: self._on_vlc_buffering(player, event.u.new_cache)
+        )
+        events.event_attach(vlc.EventType.MediaPlayerEncounteredError, lambda event: self._on_vlc_error(player))
+        events.event_attach(vlc.EventType.MediaPlayerEndReached, lambda event: self._on_vlc_end(player))
+    
+    # 以下回调在VLC线程中执行，只更新计数
+    
+    def _on_vlc_vout(self, player):
+        session = self.session
+        if session and player is self.media_player and session["ttff"] is None:
+            session["ttff"] = time.perf_counter() - session["started"]
+    
+    def _on_vlc_buffering(self, player, cache):
+        session = self.session
+        if not session or player is not self.media_player or session["ttff"] is None:
+            return
+        # 出画面之后缓冲降到100%以下算一次卡顿
+        if cache < 100 and not session["buffering"]:
+            session["buffering"] = True
+            session["buffering_since"] = time.perf_counter()
+            session["buffering_events"] += 1
+        elif cache >= 100:
+            session["buffering"] = False
+            session["buffering_since"] = None
+    
+    def _on_vlc_error(self, player):
+        session = self.session
+        if session and player is self.media_player:
+            session["errors"] += 1
+            self.ui.call(self.failover, session, "播放错误")
+    
+    def _on_vlc_end(self, player):
+        # 直播流不会正常结束，播放到结尾说明上游断流
+        session = self.session
+        if session and player is self.media_player:
+            self.ui.call(self.failover, session, "流中断")
+    
+    def sample_playback(self):
+        """采样当前播放会话的VLC统计，更新指标，定期写入日志"""
+        session = self.session
+        if session and self.is_playing and self.current_media is not None:
+            labels = {"channel": session["channel"], "server": session["server"]}
+            metrics = self.metrics
+            try:
+                stats = vlc.MediaStats()
+                if self.current_media.get_stats(stats):
+                    # VLC的码率单位为 字节/微秒 的千分之一，换算为kbps
+                    session["stats"] = {
+                        "demux_bitrate_kbps": round(stats.demux_bitrate * 8000, 1),
+                        "input_bitrate_kbps": round(stats.input_bitrate * 8000, 1),
+                        "displayed_pictures": stats.displayed_pictures,
+                        "lost_pictures": stats.lost_pictures,
+                        "lost_abuffers": stats.lost_abuffers,
+                        "demux_corrupted": stats.demux_corrupted,
+                        "demux_discontinuity": stats.demux_discontinuity,
+                    }
+                    if stats.read_bytes > session["read_bytes"]:
+                        session["read_bytes"] = stats.read_bytes
+                        session["progress"] = time.perf_counter()
+            except Exception:
+                pass
+            values = session["stats"]
+            if values:
+                metrics.set("iptv_playback_demux_bitrate_kbps", values["demux_bitrate_kbps"], **labels)
+                metrics.set("iptv_playback_input_bitrate_kbps", values["input_bitrate_kbps"], **labels)
+                metrics.set("iptv_playback_displayed_pictures_total", values["displayed_pictures"], **labels)
+                metrics.set("iptv_playback_lost_pictures_total", values["lost_pictures"], **labels)
+                metrics.set("iptv_playback_lost_abuffers_total", values["lost_abuffers"], **labels)
+                metrics.set("iptv_playback_demux_corrupted_total", values["demux_corrupted"], **labels)
+                metrics.set("iptv_playback_demux_discontinuity_total", values["demux_discontinuity"], **labels)
+            metrics.set("iptv_playback_buffering_events_total", session["buffering_events"], **labels)
+            if session["ttff"] is not None:
+                metrics.set("iptv_playback_ttff_seconds", session["ttff"], **labels)
+                if not session["ttff_logged"]:
+                    session["ttff_logged"] = True
+                    self.log_event("first_frame", channel=session["channel"], server=session["server"],
+                                   ttff=round(session["ttff"], 3))
+                    failover = session["failover"]
+                    if failover:
+                        # 故障切换耗时：从发现卡顿到新服务器出画面
+                        elapsed = session["started"] - failover["detected"] + session["ttff"]
+                        self.metrics.set("iptv_failover_seconds", elapsed)
+                        self.log_event("failover", channel=session["channel"], reason=failover["reason"],
+                                       old_server=failover["from"], server=session["server"],
+                                       seconds=round(elapsed, 3))
+                        print(f"故障切换完成: {failover['from']} -> {session['server']}，耗时 {elapsed:.2f} 秒")
+            session["samples"] += 1
+            if session["samples"] % self.SAMPLE_LOG_EVERY == 0:
+                self.log_event("sample", channel=session["channel"], server=session["server"],
+                               buffering_events=session["buffering_events"], **values)
+            self.check_stall(session)
+        self.root.after(self.SAMPLE_INTERVAL_MS, self.sample_playback)
+    
+    # ---- 卡顿看门狗与服务器故障切换 ----
+    
+    def check_stall(self, session):
+        """检查当前会话是否卡住，卡住时切换服务器"""
+        now = time.perf_counter()
+        if session["ttff"] is None:
+            if now - session["started"] > self.STARTUP_TIMEOUT:
+                self.failover(session, "起播超时")
+        elif session["buffering_since"] is not None and now - session["buffering_since"] > self.STALL_SECONDS:
+            self.failover(session, "缓冲超时")
+        elif session["read_bytes"] and now - session["progress"] > self.STALL_SECONDS:
+            # 取得过统计才判断数据是否停止到达
+            self.failover(session, "没有新数据")
+    
+    def failover(self, session, reason):
+        """切换到排名中的下一台服务器，保持同一频道和同一节目时间位置"""
+        template = self.current_channel_template
+        if (session is not self.session or not self.is_playing or session["exhausted"]
+                or "{server}" not in template or session["start_offset"] is None):
+            # 非当前会话、固定地址、本地中继/时移等情况不做切换
+            return
+        detected = time.perf_counter()
+        tried = session["tried"] | {session["server"]}
+        server = self.pick_server(tried)
+        if server is None:
+            session["exhausted"] = True
+            self.log_event("failover_exhausted", channel=session["channel"], reason=reason, tried=sorted(tried))
+            self.update_status(f"{session['channel']}: 所有服务器都无法播放（{reason}）")
+            return
+        
+        # 节目时间位置 = 起播时的starttime + 已播放时长；换算为相对当前时间的偏移
+        played = 0.0
+        if session["ttff"] is not None:
+            played = max(self.media_player.get_time(), 0) / 1000
+        offset = session["start_offset"] - (detected - session["started"]) + played
+        play_url = self.generate_play_url(template, server, offset)
+        print(f"{session['channel']}: {session['server']} {reason}，切换到 {server}")
+        self.metrics.inc("iptv_failovers_total")
+        self._start_playback(play_url, template, self.current_channel_name)
+        if self.session is not session and self.session is not None:
+            self.session["tried"] = tried
+            self.session["failover"] = {"from": session["server"], "reason": reason, "detected": detected}
+            self.update_status(f"{session['server']} {reason}，已切换到 {server}: {session['channel']}")
+    
+    def collect_metrics(self):
+        super().collect_metrics()
+        stats = self.ui.snapshot()
+        self.metrics.set("iptv_ui_updates_merged_total", stats["merged"])
+        self.metrics.set("iptv_ui_updates_dropped_total", stats["dropped"])
+        self.metrics.set("iptv_ui_latency_ms", stats["latency_ms"])
+        self.metrics.set("iptv_ui_max_latency_ms", stats["max_latency_ms"])
+    
     def update_status(self, message):
-        """更新状态栏"""
+        """更新状态栏（主线程；后台线程请用 notify_status）"""
         self.status_bar.config(text=message)
-        self.root.update_idletasks()
     
     def on_closing(self):
         """关闭窗口事件"""
+        if self.mosaic is not None:
+            self.mosaic.close()
         self.stop_playback()
+        self.shutdown()
+        self.ui.stop()
+        stats = self.ui.snapshot()
+        print(
+            f"界面更新: 投递 {stats['posted']}，执行 {stats['executed']}，合并 {stats['merged']}，"
+            f"丢弃 {stats['dropped']}，平均延迟 {stats['latency_ms']:.1f} ms，最大延迟 {stats['max_latency_ms']:.1f} ms"
+        )
         
-        # 关闭全屏窗口
-        if self.fullscreen_window:
-            self.fullscreen_window.destroy()
-            
         self.root.destroy()
 
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="IPTV播放器")
+    parser.add_argument("--daemon", action="store_true", help="以无界面守护进程方式运行，提供HTTP/JSON控制接口")
+    parser.add_argument("--api-token", help="控制接口的访问令牌；不设置时 /api/ 只接受本机请求")
+    parser.add_argument("--startup-profile", action="store_true", help="输出启动各阶段耗时")
+    parser.add_argument("--http-host", default="0.0.0.0", help="本地HTTP服务监听地址")
+    parser.add_argument("--http-port", type=int, default=LOCAL_HTTP_PORT, help="本地HTTP服务端口")
+    parser.add_argument("--advertise-host",
+                        help="控制接口返回的中继地址中使用的本机主机名或IP（默认取请求的Host头，其次是监听地址）")
+    parser.add_argument("--zap-budget", type=int, default=16000, help="快速换台的总带宽预算（kbps，含正在观看的频道）")
+    parser.add_argument("--mosaic-decoders", type=int, default=6, help="多画面同时解码的最大路数（含主窗口）")
+    parser.add_argument("--mosaic-budget", type=int, default=32000, help="多画面的总带宽预算（kbps，含主窗口）")
+    parser.add_argument("--mcast-iface", default="0.0.0.0", help="加入组播组使用的本机网卡地址（IPTV网卡）")
+    parser.add_argument("--record-dir", default="recordings", help="录制文件保存目录")
+    parser.add_argument("--timeshift-mb", type=int, default=512, help="时移环形文件大小（MB），决定可回看的时长")
+    parser.add_argument("--metrics", action="store_true", help="界面启动时即开启本地HTTP服务以提供 /metrics（守护进程总是提供）")
+    parser.add_argument("--playlist", action="store_true", help="界面启动时即开启本地HTTP服务以提供 /playlist.m3u（守护进程总是提供）")
+    parser.add_argument("--metrics-log", default="iptv_metrics.log", help="播放与网络指标的滚动日志文件，设为空字符串则不记录")
+    parser.add_argument("--epg", metavar="FILE", help="启动时加载的XMLTV节目单（.xml或.xml.gz），默认加载上次导入的节目单")
+    parser.add_argument("--scan", metavar="FILE", help="体检全部频道×服务器后退出，结果写入FILE（.json或.csv）")
+    parser.add_argument("--analyze", metavar="SOURCE",
+                        help="分析组播流后退出：SOURCE为组播地址（rtp://组:端口）、频道ID、TS文件或pcap文件")
+    parser.add_argument("--analyze-seconds", type=float, default=30, help="分析组播时的抓包时长（秒）")
+    parser.add_argument("--analyze-report", metavar="FILE", help="分析报告另存为JSON文件")
+    return parser.parse_args(argv)
+
 def main():
+    STARTUP_PROFILE.mark("导入模块")
+    options = parse_args()
+    STARTUP_PROFILE.enabled = options.startup_profile
+    if options.scan:
+        IPTVEngine(options).run_scan(options.scan)
+        return
+    if options.analyze:
+        IPTVEngine(options).run_analysis(options.analyze, options.analyze_seconds, options.analyze_report)
+        return
+    if options.daemon:
+        IPTVDaemon(options).run()
+        return
+    
     root = tk.Tk()
-    app = IPTVPlayer(root)
+    STARTUP_PROFILE.mark("创建窗口")
+    app = IPTVPlayer(root, options)
     
     # 设置关闭事件处理
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
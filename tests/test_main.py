@@ -0,0 +1,701 @@
+import asyncio
+import datetime
+import json
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SegmentCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = main.SegmentCache(max_bytes=10)
+        cache.put("a", b"1111")
+        cache.put("b", b"2222")
+        cache.get("a")
+        cache.put("c", b"3333")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1111")
+        self.assertEqual(cache.get("c"), b"3333")
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(len(cache), 2)
+
+    def test_replacing_key_updates_size(self):
+        cache = main.SegmentCache(max_bytes=10)
+        cache.put("a", b"1111")
+        cache.put("a", b"22")
+        self.assertEqual(cache.size, 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_skips_segment_larger_than_cache(self):
+        cache = main.SegmentCache(max_bytes=4)
+        cache.put("a", b"11")
+        cache.put("b", b"22222")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"11")
+
+
+class FakeResponse:
+    """requests响应的替身，只实现用到的属性"""
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+        self.text = content.decode("utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    """按地址返回预设内容的HTTP会话，记录请求过的地址（未知地址抛KeyError）"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def get(self, url, timeout=None):
+        self.requested.append(url)
+        page = self.pages[url]
+        return FakeResponse(url, page if isinstance(page, bytes) else page.encode("utf-8"))
+
+
+class HLSRelayTest(unittest.TestCase):
+
+    PLAYLIST_URL = "http://upstream/live/ch.m3u8"
+    SEGMENT_URL = "http://upstream/live/seg7.ts"
+
+    def setUp(self):
+        self.session = FakeSession({
+            self.PLAYLIST_URL: "#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:7\n"
+                               "#EXTINF:2.0,\nseg7.ts\n#EXTINF:2.0,\nhttp://cdn/seg8.ts\n",
+            self.SEGMENT_URL: b"\x47" * 188,
+        })
+        self.relay = main.HLSRelay(self.session, lambda key: self.PLAYLIST_URL)
+
+    def segment_ids(self, text):
+        return [line[len("/hls/seg/"):-len(".ts")] for line in text.splitlines() if not line.startswith("#")]
+
+    def test_rewrites_playlist_to_local_paths(self):
+        text = asyncio.run(self.relay._get_channel_playlist("1"))
+        self.assertIn("#EXT-X-MEDIA-SEQUENCE:7", text)
+        uris = [line for line in text.splitlines() if not line.startswith("#")]
+        self.assertEqual(len(uris), 2)
+        for uri in uris:
+            self.assertTrue(uri.startswith("/hls/seg/") and uri.endswith(".ts"), uri)
+        first, second = self.segment_ids(text)
+        self.assertEqual(self.relay._urls[first], self.SEGMENT_URL)
+        self.assertEqual(self.relay._urls[second], "http://cdn/seg8.ts")
+
+    def test_concurrent_requests_fetch_once(self):
+        async def scenario():
+            playlists = await asyncio.gather(*(self.relay._get_channel_playlist("1") for _ in range(3)))
+            resource_id = self.segment_ids(playlists[0])[0]
+            results = await asyncio.gather(*(self.relay._get_segment(resource_id) for _ in range(5)))
+            results.append(await self.relay._get_segment(resource_id))
+            return results
+
+        results = asyncio.run(scenario())
+        self.assertEqual(results, [b"\x47" * 188] * 6)
+        self.assertEqual(self.session.requested, [self.PLAYLIST_URL, self.SEGMENT_URL])
+        stats = self.relay.snapshot()
+        self.assertEqual((stats["requests"], stats["misses"], stats["coalesced"], stats["hits"]), (6, 1, 4, 1))
+        self.assertEqual(stats["bytes_upstream"], 188)
+        self.assertEqual(stats["bytes_served"], 188 * 6)
+        self.assertEqual(self.relay._inflight, {})
+
+    def test_failed_fetch_is_shared_and_retried(self):
+        async def fetch_all(resource_id):
+            return await asyncio.gather(*(self.relay._get_segment(resource_id) for _ in range(3)),
+                                        return_exceptions=True)
+
+        text = asyncio.run(self.relay._get_channel_playlist("1"))
+        resource_id = self.segment_ids(text)[1]
+        results = asyncio.run(fetch_all(resource_id))
+        self.assertTrue(all(isinstance(result, KeyError) for result in results))
+        self.assertEqual(self.session.requested.count("http://cdn/seg8.ts"), 1)
+        self.assertEqual(len(self.relay.segments), 0)
+        self.session.pages["http://cdn/seg8.ts"] = b"\x47" * 376
+        self.assertEqual(asyncio.run(fetch_all(resource_id)), [b"\x47" * 376] * 3)
+
+    def test_unknown_segment(self):
+        with self.assertRaises(KeyError):
+            asyncio.run(self.relay._get_segment("missing"))
+
+
+class LocalHTTPServerTest(unittest.TestCase):
+
+    @staticmethod
+    def request(host=None, local=("192.168.1.5", 8090)):
+        request = main.HTTPRequest("GET", "/api/streams", "HTTP/1.1", {"host": host} if host else {})
+        request.local = local
+        return request
+
+    def test_public_url_uses_host_header(self):
+        server = main.LocalHTTPServer(None, port=8090)
+        self.assertEqual(server.public_url("/hls/1.m3u8", self.request("192.168.1.5:8090")),
+                         "http://192.168.1.5:8090/hls/1.m3u8")
+        self.assertEqual(server.public_url("/hls/1.m3u8", self.request("[fd00::5]:8090")),
+                         "http://[fd00::5]:8090/hls/1.m3u8")
+        self.assertEqual(server.url("/hls/1.m3u8"), "http://127.0.0.1:8090/hls/1.m3u8")
+
+    def test_public_url_fallbacks(self):
+        server = main.LocalHTTPServer(None, port=8090)
+        # 不合法的Host头不用，改用请求到达的本机地址
+        self.assertEqual(server.public_url("/a", self.request("a b/c")), "http://192.168.1.5:8090/a")
+        self.assertEqual(server.public_url("/a", self.request(local=("fd00::5", 8090, 0, 0))),
+                         "http://[fd00::5]:8090/a")
+        bound = main.LocalHTTPServer(None, host="10.0.0.2", port=8090)
+        self.assertEqual(bound.public_url("/a", self.request()), "http://10.0.0.2:8090/a")
+
+    def test_advertise_host_wins(self):
+        server = main.LocalHTTPServer(None, port=8090, advertise_host="nas.local")
+        self.assertEqual(server.public_url("/a", self.request("192.168.1.5:8090")), "http://nas.local:8090/a")
+        server.advertise_host = "nas.local:80"
+        self.assertEqual(server.public_url("/a"), "http://nas.local:80/a")
+
+
+class ParseM3U8Test(unittest.TestCase):
+
+    def test_media_playlist(self):
+        text = (
+            "#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXT-X-MEDIA-SEQUENCE:100\n"
+            "#EXT-X-PROGRAM-DATE-TIME:2025-07-05T14:23:12Z\n#EXTINF:4.0,\na.ts\n"
+            "#EXTINF:3.5,\nhttp://cdn/b.ts\n#EXT-X-ENDLIST\n"
+        )
+        playlist = main.parse_m3u8(text, "http://host/live/index.m3u8")
+        self.assertEqual(playlist["media_sequence"], 100)
+        self.assertEqual(playlist["target_duration"], 4.0)
+        self.assertTrue(playlist["endlist"])
+        self.assertEqual(playlist["variants"], [])
+        segments = playlist["segments"]
+        self.assertEqual([segment["uri"] for segment in segments], ["http://host/live/a.ts", "http://cdn/b.ts"])
+        self.assertEqual([segment["sequence"] for segment in segments], [100, 101])
+        self.assertEqual([segment["duration"] for segment in segments], [4.0, 3.5])
+        start = datetime.datetime(2025, 7, 5, 14, 23, 12, tzinfo=datetime.timezone.utc)
+        # 没有PROGRAM-DATE-TIME的分片按前一分片顺推
+        self.assertEqual([segment["pdt"] for segment in segments], [start, start + datetime.timedelta(seconds=4)])
+
+    def test_master_playlist_lists_variants(self):
+        text = (
+            "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=800000\nlow/index.m3u8\n"
+            "#EXT-X-STREAM-INF:BANDWIDTH=2000000\nhttp://other/high.m3u8\n"
+        )
+        playlist = main.parse_m3u8(text, "http://host/live/master.m3u8")
+        self.assertEqual(playlist["variants"], ["http://host/live/low/index.m3u8", "http://other/high.m3u8"])
+        self.assertEqual(playlist["segments"], [])
+
+    def test_target_duration_defaults_to_longest_segment(self):
+        playlist = main.parse_m3u8("#EXTINF:2.0,\na.ts\n#EXTINF:6,\nb.ts\n")
+        self.assertEqual(playlist["target_duration"], 6.0)
+        self.assertEqual(playlist["media_sequence"], 0)
+        self.assertFalse(playlist["endlist"])
+        self.assertEqual([segment["pdt"] for segment in playlist["segments"]], [None, None])
+
+    def test_ignores_bad_tag_values(self):
+        text = "#EXT-X-MEDIA-SEQUENCE:abc\n#EXT-X-TARGETDURATION:3\n#EXTINF:x,\na.ts\n"
+        playlist = main.parse_m3u8(text)
+        self.assertEqual(playlist["media_sequence"], 0)
+        self.assertEqual(playlist["segments"][0]["duration"], 3.0)
+
+
+class LiveEdgeResolverTest(unittest.TestCase):
+
+    NOW = datetime.datetime(2025, 7, 5, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+    @staticmethod
+    def render(offset):
+        return f"http://server/ch.m3u8?offset={offset:g}"
+
+    @staticmethod
+    def playlist(count, start=None, duration=2.0):
+        """count个分片的播放列表，start为第一个分片的节目时间"""
+        lines = ["#EXTM3U", f"#EXT-X-TARGETDURATION:{duration:g}"]
+        for index in range(count):
+            if start is not None:
+                pdt = start + datetime.timedelta(seconds=index * duration)
+                lines.append("#EXT-X-PROGRAM-DATE-TIME:" + pdt.isoformat())
+            lines.append(f"#EXTINF:{duration},")
+            lines.append(f"seg{index}.ts")
+        return "\n".join(lines) + "\n"
+
+    def measure(self, pages):
+        self.session = FakeSession(pages)
+        resolver = main.LiveEdgeResolver(lambda: self.session)
+        info = resolver.measure("server", "1", self.render, lambda: self.NOW)
+        self.assertIs(resolver.cached("server", "1"), info)
+        self.assertIsNone(resolver.cached("other", "1"))
+        return info
+
+    def test_shift_from_program_date_time(self):
+        # 请求当前时间得到的是1分钟前的内容，直播边缘为当前时间
+        behind = self.NOW - datetime.timedelta(seconds=60)
+        info = self.measure({
+            self.render(0): self.playlist(30, behind),
+            self.render(56): self.playlist(2, behind + datetime.timedelta(seconds=56)),
+        })
+        self.assertEqual(info["shift"], 56.0)
+        self.assertEqual(info["delay"], 4.0)
+        self.assertEqual(info["target_duration"], 2.0)
+        self.assertEqual(self.session.requested, [self.render(0), self.render(56)])
+
+    def test_shift_from_segment_durations(self):
+        info = self.measure({
+            self.render(0): self.playlist(10),
+            self.render(16): self.playlist(2),
+        })
+        self.assertEqual(info["shift"], 16.0)
+        self.assertIsNone(info["delay"])
+
+    def test_failed_verification_keeps_requested_time(self):
+        info = self.measure({
+            self.render(0): self.playlist(10),
+            self.render(16): "#EXTM3U\n",
+        })
+        self.assertEqual(info["shift"], 0.0)
+
+    def test_follows_first_variant(self):
+        info = self.measure({
+            self.render(0): "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1\nsub.m3u8\n",
+            "http://server/sub.m3u8": self.playlist(2),
+        })
+        self.assertEqual(info["shift"], 0.0)
+
+
+class ChannelStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "channels.db")
+        self.store = main.ChannelStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_normalize_channel_url(self):
+        self.assertEqual(main.normalize_channel_url(" HTTP://Host:80/live?b=2&a=1#x "), "http://host:80/live?a=1&b=2")
+        self.assertEqual(main.normalize_channel_url("rtp://239.1.1.1:9000"), "rtp://239.1.1.1:9000/")
+
+    def test_duplicate_url_key_is_skipped(self):
+        first = self.store.add("湖南卫视", "HTTP://Server/live/1.m3u8?b=2&a=1")
+        self.assertIsNotNone(first)
+        self.assertIsNone(self.store.add("湖南卫视高清", "http://server/live/1.m3u8?a=1&b=2#hd"))
+        # 路径大小写不同的是另一个频道
+        self.assertIsNotNone(self.store.add("湖南卫视", "http://server/LIVE/1.m3u8"))
+        self.assertEqual([channel["name"] for channel in self.store.load()], ["湖南卫视", "湖南卫视"])
+
+    def test_add_many_skips_duplicates_within_batch(self):
+        added = self.store.add_many([
+            {"name": "A", "url": "http://s/a"},
+            {"name": "B", "url": "http://s/b"},
+            {"name": "A2", "url": "HTTP://S/a"},
+        ])
+        self.assertEqual([channel["name"] for channel in added], ["A", "B"])
+        loaded = self.store.load()
+        self.assertEqual([(channel["id"], channel["name"]) for channel in loaded],
+                         [(channel["id"], channel["name"]) for channel in added])
+
+    def test_ids_stable_after_reopen(self):
+        added = self.store.add_many([{"name": "A", "url": "http://s/a"}, {"name": "B", "url": "http://s/b"}])
+        self.store.close()
+        self.store = main.ChannelStore(self.path)
+        self.assertEqual([channel["id"] for channel in self.store.load()], [channel["id"] for channel in added])
+        self.assertEqual(self.store.add("C", "http://s/c")["id"], added[-1]["id"] + 1)
+
+    def test_migrates_legacy_json(self):
+        legacy = os.path.join(self.directory.name, "channel_config.json")
+        with open(legacy, "w", encoding="utf-8") as f:
+            json.dump([{"name": "A", "url": "http://s/a"}, {"name": "A", "url": "http://s/a"},
+                       {"name": "B", "url": "http://s/b"}], f)
+        store = main.ChannelStore(os.path.join(self.directory.name, "migrated.db"), legacy)
+        try:
+            self.assertEqual([channel["name"] for channel in store.load()], ["A", "B"])
+        finally:
+            store.close()
+
+
+class PlaylistImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def importer(self, name, text, **kwargs):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8-sig") as f:
+            f.write(text)
+        return main.PlaylistImporter(path, **kwargs)
+
+    @staticmethod
+    def channel(name, url, tvg_id="", group=""):
+        return {"name": name, "url": url, "tvg_id": tvg_id, "group": group}
+
+    def test_m3u(self):
+        importer = self.importer("list.m3u", (
+            "#EXTM3U\n"
+            '#EXTINF:-1 tvg-id="hunanws" group-title="卫视",湖南卫视\n'
+            "http://a/1.m3u8\n"
+            "#EXTGRP:地方\n"
+            '#EXTINF:-1 tvg-name="长沙新闻",\n'
+            "http://a/2.m3u8\n"
+            "\n"
+            "http://a/3.m3u8\n"
+        ))
+        self.assertEqual(importer.format, "m3u")
+        self.assertEqual(list(importer), [
+            self.channel("湖南卫视", "http://a/1.m3u8", "hunanws", "卫视"),
+            self.channel("长沙新闻", "http://a/2.m3u8", group="地方"),
+            self.channel("http://a/3.m3u8", "http://a/3.m3u8", group="地方"),
+        ])
+        self.assertEqual(importer.bytes_read, importer.total_bytes)
+
+    def test_detects_m3u_by_content(self):
+        importer = self.importer("list.txt", "#EXTM3U\n#EXTINF:-1,A\nhttp://a/1.m3u8\n")
+        self.assertEqual(importer.format, "m3u")
+
+    def test_txt(self):
+        exported = "http://124.232.231.172:8089/000000002000/201500000067/index.m3u8?starttime=20250705T142312.00Z"
+        importer = self.importer("list.txt", (
+            "频道名称\t播放地址\n"
+            f"湖南卫视\t{exported}\n"
+            "央视,#genre#\n"
+            "CCTV-1,http://b/cctv1.m3u8\n"
+            "无效行\n"
+        ), convert=main.convert_channel_url)
+        self.assertEqual(importer.format, "txt")
+        self.assertEqual(list(importer), [
+            self.channel("湖南卫视", "http://{server}/000000002000/201500000067/index.m3u8?starttime={timestamp}"),
+            self.channel("CCTV-1", "http://b/cctv1.m3u8", group="央视"),
+        ])
+
+    def test_csv_with_header(self):
+        importer = self.importer("list.csv", (
+            "频道名称,播放地址,分组,tvg-id\n"
+            "湖南卫视,http://a/1.m3u8,卫视,hunanws\n"
+            '"CCTV-1, 综合",http://a:8089/2.m3u8?starttime=20250705T142312.00Z,央视,\n'
+            "坏行,not-a-url,,\n"
+        ), convert=main.convert_channel_url)
+        self.assertEqual(importer.format, "csv")
+        self.assertEqual(list(importer), [
+            self.channel("湖南卫视", "http://a/1.m3u8", "hunanws", "卫视"),
+            self.channel("CCTV-1, 综合", "http://{server}/2.m3u8?starttime={timestamp}", group="央视"),
+        ])
+
+    def test_csv_without_header(self):
+        importer = self.importer("list.csv", "A,http://a/1.m3u8\n,http://a/2.m3u8\n")
+        self.assertEqual(list(importer), [
+            self.channel("A", "http://a/1.m3u8"),
+            self.channel("http://a/2.m3u8", "http://a/2.m3u8"),
+        ])
+
+    def test_batches(self):
+        importer = self.importer("list.txt", "".join(f"频道{index},http://a/{index}.m3u8\n" for index in range(5)))
+        self.assertEqual([len(batch) for batch in importer.batches(size=2)], [2, 2, 1])
+
+
+class TimeKeeperSelectTest(unittest.TestCase):
+
+    @staticmethod
+    def sample(offset, distance):
+        return {"offset": offset, "distance": distance}
+
+    def test_excludes_falseticker(self):
+        samples = [self.sample(0.10, 0.02), self.sample(0.11, 0.02), self.sample(0.09, 0.03), self.sample(5.0, 0.01)]
+        selected = main.TimeKeeper.select(samples)
+        self.assertEqual(sorted(sample["offset"] for sample in selected), [0.09, 0.10, 0.11])
+
+    def test_touching_intervals_overlap(self):
+        samples = [self.sample(0.0, 0.1), self.sample(0.2, 0.1), self.sample(0.1, 0.0)]
+        self.assertEqual(len(main.TimeKeeper.select(samples)), 3)
+
+    def test_without_majority_returns_smallest_distance(self):
+        samples = [self.sample(0.0, 0.01), self.sample(1.0, 0.02), self.sample(2.0, 0.005)]
+        self.assertEqual(main.TimeKeeper.select(samples), [samples[2]])
+
+    def test_two_samples_return_smallest_distance(self):
+        samples = [self.sample(0.0, 0.05), self.sample(0.3, 0.01)]
+        self.assertEqual(main.TimeKeeper.select(samples), [samples[1]])
+
+
+class TimeshiftRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ring = main.TimeshiftRing(os.path.join(self.directory.name, "ring"), 1000)
+
+    def tearDown(self):
+        self.ring.close()
+        self.directory.cleanup()
+
+    def test_wrap_evicts_oldest(self):
+        segments = [bytes([index]) * 300 for index in range(5)]
+        for segment in segments:
+            self.ring.append(segment, 2.0)
+        self.assertEqual([entry["sequence"] for entry in self.ring.index], [2, 3, 4])
+        self.assertIsNone(self.ring.get(0))
+        self.assertIsNone(self.ring.get(1))
+        self.assertEqual(bytes(self.ring.get(3)), segments[3])
+        self.assertEqual(bytes(self.ring.get(4)), segments[4])
+        self.assertEqual(self.ring.duration, 6.0)
+
+    def test_tail_segments_evicted_when_wrapping(self):
+        self.ring.append(b"a" * 600, 1.0)
+        self.ring.append(b"b" * 300, 1.0)
+        # 放不下末尾的100字节：从头写，覆盖第一个分片
+        self.ring.append(b"c" * 200, 1.0)
+        self.assertEqual([entry["sequence"] for entry in self.ring.index], [1, 2])
+        self.assertEqual(self.ring.index[-1]["offset"], 0)
+        # 写到600之后，覆盖第二个分片
+        self.ring.append(b"d" * 500, 1.0)
+        self.assertEqual([entry["sequence"] for entry in self.ring.index], [2, 3])
+
+    def test_rejects_oversized_segment(self):
+        self.assertIsNone(self.ring.append(b"x" * 1001, 1.0))
+        self.assertIsNone(self.ring.append(b"", 1.0))
+        self.assertEqual(len(self.ring.index), 0)
+
+    def test_reset_keeps_sequence_numbers(self):
+        self.ring.append(b"a" * 100, 1.0)
+        self.ring.reset()
+        self.assertIsNone(self.ring.get(0))
+        self.assertEqual(self.ring.append(b"b" * 100, 1.0), 1)
+
+
+class FakeRoot:
+    """只记录定时器的假Tk根窗口"""
+
+    def after(self, delay, func):
+        return object()
+
+    def after_cancel(self, job):
+        pass
+
+
+class UIDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = main.UIDispatcher(FakeRoot())
+        self.log = []
+
+    def record(self, name):
+        return lambda: self.log.append(name)
+
+    def test_merged_update_runs_after_later_calls(self):
+        dispatcher = self.dispatcher
+        dispatcher.call(self.record("a"))
+        dispatcher.update("status", self.record("status1"))
+        dispatcher.call(self.record("c"))
+        dispatcher.update("status", self.record("status2"))
+        dispatcher._drain()
+        self.assertEqual(self.log, ["a", "c", "status2"])
+        self.assertEqual(dispatcher.stats["merged"], 1)
+
+    def test_merged_update_keeps_position_without_later_calls(self):
+        dispatcher = self.dispatcher
+        dispatcher.update("status", self.record("status1"))
+        dispatcher.update("status", self.record("status2"))
+        dispatcher.call(self.record("c"))
+        dispatcher._drain()
+        self.assertEqual(self.log, ["status2", "c"])
+
+    def test_overflow_drops_oldest_update_but_not_calls(self):
+        dispatcher = self.dispatcher
+        dispatcher.call(self.record("call"))
+        for index in range(dispatcher.MAX_PENDING + 1):
+            dispatcher.update(index, self.record(index))
+        self.assertEqual(dispatcher.stats["dropped"], 1)
+        while dispatcher.snapshot()["pending"]:
+            dispatcher._drain()
+        self.assertEqual(self.log[0], "call")
+        self.assertEqual(self.log[1], 1)
+        self.assertEqual(len(self.log), dispatcher.MAX_PENDING + 1)
+
+    def test_drain_limits_batch_size(self):
+        dispatcher = self.dispatcher
+        for index in range(dispatcher.MAX_PER_TICK + 5):
+            dispatcher.call(self.record(index))
+        dispatcher._drain()
+        self.assertEqual(len(self.log), dispatcher.MAX_PER_TICK)
+        dispatcher._drain()
+        self.assertEqual(self.log, list(range(dispatcher.MAX_PER_TICK + 5)))
+
+
+class MosaicSchedulerTest(unittest.TestCase):
+
+    @staticmethod
+    def tile(key, source="direct", bitrate=4000, shared=False):
+        return {"key": key, "source": source, "bitrate": bitrate, "shared": shared}
+
+    def test_focus_always_full(self):
+        scheduler = main.MosaicScheduler(max_decoders=2, budget_kbps=1000)
+        levels = scheduler.plan([self.tile("a"), self.tile("b", bitrate=50000)], "b", reserved_decoders=2)
+        self.assertEqual(levels, {"a": "off", "b": "full"})
+
+    def test_source_rank_and_budget(self):
+        scheduler = main.MosaicScheduler(max_decoders=6, budget_kbps=10000)
+        tiles = [self.tile("direct", "direct"), self.tile("relay", "relay"), self.tile("multicast", "multicast"),
+                 self.tile("shared", "relay", shared=True)]
+        levels = scheduler.plan(tiles, None)
+        self.assertEqual(levels, {"multicast": "reduced", "relay": "reduced", "shared": "reduced", "direct": "off"})
+
+    def test_many_decoders_use_keyframes(self):
+        scheduler = main.MosaicScheduler(max_decoders=6, budget_kbps=100000)
+        tiles = [self.tile(str(index)) for index in range(5)]
+        levels = scheduler.plan(tiles, "0", reserved_decoders=1)
+        self.assertEqual(levels["0"], "full")
+        self.assertEqual({levels[str(index)] for index in range(1, 5)}, {"keyframe"})
+
+    def test_hysteresis_keeps_decoding_tile_near_budget(self):
+        scheduler = main.MosaicScheduler(max_decoders=6, budget_kbps=10000)
+        tiles = [self.tile("a", bitrate=5000), self.tile("b", bitrate=5500)]
+        self.assertEqual(scheduler.plan(tiles, None)["b"], "off")
+        current = {"a": "reduced", "b": "reduced"}
+        self.assertEqual(scheduler.plan(tiles, None, current=current)["b"], "reduced")
+
+    def test_hysteresis_on_keyframe_threshold(self):
+        scheduler = main.MosaicScheduler(max_decoders=8, budget_kbps=100000)
+        tiles = [self.tile(str(index)) for index in range(4)]
+        current = {str(index): "keyframe" for index in range(5)}
+        self.assertEqual(set(scheduler.plan(tiles, None, current=current).values()), {"keyframe"})
+        self.assertEqual(set(scheduler.plan(tiles, None).values()), {"reduced"})
+
+
+VIDEO_PID = 0x100
+BITRATE = 8000000
+PACKETS_PER_DATAGRAM = 7
+
+
+def ts_packet(pid, counter, pcr=None):
+    """一个188字节TS包，pcr为27MHz时钟值时带自适应字段"""
+    header = bytes([0x47, (pid >> 8) & 0x1F, pid & 0xFF])
+    if pcr is None:
+        return header + bytes([0x10 | counter]) + bytes(184)
+    raw = (pcr // 300) << 15 | 0x3F << 9 | pcr % 300
+    adaptation = bytes([7, 0x10]) + raw.to_bytes(6, "big")
+    return header + bytes([0x30 | counter]) + adaptation + bytes(176)
+
+
+def synthetic_capture(datagrams=400, drop=50, swap=120, corrupt=1403):
+    """合成RTP组播抓包：视频PID带PCR，每100包一个PAT
+
+    丢掉第drop个报文、交换第swap和swap+1个报文、把第corrupt个TS包的连续计数改错。
+    返回 [(到达时间, 报文)]。
+    """
+    counters = {}
+    packets = []
+    for index in range(datagrams * PACKETS_PER_DATAGRAM):
+        pid = 0 if index % 100 == 0 else VIDEO_PID
+        counter = counters.get(pid, 0)
+        counters[pid] = (counter + 1) % 16
+        if index == corrupt:
+            counter = (counter + 5) % 16
+        seconds = index * 188 * 8 / BITRATE
+        pcr = int(seconds * 27000000) if pid == VIDEO_PID and index % 70 == 1 else None
+        packets.append(ts_packet(pid, counter, pcr))
+    capture = []
+    for number in range(datagrams):
+        first = number * PACKETS_PER_DATAGRAM
+        seconds = first * 188 * 8 / BITRATE
+        # 序号从65530开始，覆盖16位回绕
+        header = struct.pack(">BBHII", 0x80, 33, (65530 + number) % 65536, int(seconds * 90000), 1)
+        capture.append((seconds, header + b"".join(packets[first:first + PACKETS_PER_DATAGRAM])))
+    del capture[drop]
+    capture[swap], capture[swap + 1] = capture[swap + 1], capture[swap]
+    return capture
+
+
+def analyze(capture, use_numpy):
+    analyzer = main.StreamAnalyzer("synthetic", use_numpy=use_numpy)
+    for arrival, data in capture:
+        analyzer.add_datagram(arrival, data)
+    return analyzer.analyze()
+
+
+class StreamAnalyzerTest(unittest.TestCase):
+
+    def test_python_engine_counts_known_errors(self):
+        report = analyze(synthetic_capture(), use_numpy=False)
+        rtp = report["rtp"]
+        self.assertEqual(rtp["lost"], 1)
+        self.assertEqual(rtp["reordered"], 1)
+        self.assertEqual(rtp["duplicates"], 0)
+        self.assertEqual(rtp["expected"], 400)
+        # 丢包1处、交换3处、改错的包及其后一个包2处，都在视频PID上
+        pids = {entry["pid"]: entry for entry in report["pids"]}
+        self.assertEqual(pids[VIDEO_PID]["cc_errors"], 6)
+        self.assertEqual(pids[0]["cc_errors"], 0)
+        self.assertEqual(report["ts"]["cc_errors"], 6)
+        self.assertEqual(report["ts"]["sync_errors"], 0)
+        self.assertEqual(pids[0]["packets"], 28)
+        pcr = report["pcr"][0]
+        self.assertEqual(pcr["pid"], VIDEO_PID)
+        # 丢掉的报文里有一个PCR，间隔翻倍；交换的报文让一个PCR晚到一个报文的时间
+        interval = 70 * 188 * 8 / BITRATE * 1000
+        self.assertAlmostEqual(pcr["interval_max_ms"], 2 * interval, places=3)
+        self.assertEqual(pcr["interval_errors"], 0)
+        self.assertEqual(pcr["discontinuities"], 0)
+        self.assertLess(pcr["jitter_ms"], 2 * PACKETS_PER_DATAGRAM * 188 * 8 / BITRATE * 1000)
+        self.assertAlmostEqual(report["bitrate_kbps"], BITRATE / 1000, delta=BITRATE / 1000 * 0.01)
+
+    @unittest.skipIf(numpy is None, "numpy未安装")
+    def test_numpy_engine_matches_python(self):
+        capture = synthetic_capture()
+        expected = analyze(capture, use_numpy=False)
+        actual = analyze(capture, use_numpy=True)
+        self.assertEqual(actual["engine"], "numpy")
+        for field in ("source", "datagrams", "unaligned_datagrams", "arrival", "rtp", "ts", "pcr", "pids",
+                      "duration", "bitrate_kbps"):
+            self.assertReportEqual(actual[field], expected[field], field)
+
+    def assertReportEqual(self, actual, expected, path):
+        if isinstance(expected, dict):
+            self.assertEqual(sorted(actual), sorted(expected), path)
+            for key in expected:
+                self.assertReportEqual(actual[key], expected[key], f"{path}.{key}")
+        elif isinstance(expected, list):
+            self.assertEqual(len(actual), len(expected), path)
+            for index, (left, right) in enumerate(zip(actual, expected)):
+                self.assertReportEqual(left, right, f"{path}[{index}]")
+        elif isinstance(expected, float):
+            self.assertAlmostEqual(actual, expected, places=6, msg=path)
+        else:
+            self.assertEqual(actual, expected, path)
+
+    def test_ts_file_without_datagrams(self):
+        packets = [ts_packet(VIDEO_PID, index % 16, index * 188 * 8 * 27000000 // BITRATE if index % 50 == 0 else None)
+                   for index in range(2000)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "a.ts")
+            with open(path, "wb") as f:
+                f.write(b"\x00\x01" + b"".join(packets))
+            analyzer = main.StreamAnalyzer(path, use_numpy=False)
+            analyzer.load_ts(path)
+            report = analyzer.analyze()
+        self.assertEqual(report["ts"]["packets"], 2000)
+        self.assertEqual(report["ts"]["cc_errors"], 0)
+        self.assertNotIn("rtp", report)
+        self.assertAlmostEqual(report["pcr"][0]["mux_kbps"], BITRATE / 1000, delta=1)
+
+
+if __name__ == "__main__":
+    unittest.main()